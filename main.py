@@ -13,27 +13,93 @@
 
 __author__ = "sei-mappel"
 
+import Queue
 import logging
-import math
 import os
+import resource
+import signal
 import sys
 import time
 import traceback
 from argparse import ArgumentParser
-from multiprocessing import pool, Pool, cpu_count, Process, Lock, current_process
+from functools import partial
+from multiprocessing import pool, Pool, cpu_count, Process, Lock
 
 import matplotlib.pyplot as plt
-from scipy.spatial.distance import canberra
+import numpy
 from scipy.cluster.hierarchy import *
 
+from process.pdf import PDF
+from process.similarity import FamilyMatrix, TopK
 from storage import dbgw
+from storage.ftrcache import FeatureCache
+from storage.migrate import migrate
+from storage.results import FORMATS, ResultWriter
+from storage.spill import discard_row, remove_spills, spill_prefix, spill_row, unspill_row
+from storage.writer import BATCH_SIZE, Alias, Failed, Finished, Running, RowQueue, write_rows
 from process.parsers import parse
-from util.str_utils import get_hash
+from util.file_utils import parse_extensions, walk_samples
+from util.metrics import METRICS_EVERY, BuildMetrics, Histogram, stage, take_stages
+from util.str_utils import get_file_hash, get_hash
 
 
 NUMFEATURES = 7
 lock = Lock()
 
+"""
+Family rows per scoring partition, at least. Partitions start at 1/PARTITION_SPLIT of each worker's share of the rows.
+"""
+MIN_PARTITION = 1024
+PARTITION_SPLIT = 4
+
+"""
+Family matrix and result queue of a scoring worker, either inherited at the fork or set up by init_scorer
+"""
+FAMILIES = None
+RESULTS = None
+
+"""
+Serialized pdf rows on their way from build workers to the storage writer, and how long the writer gets to finish up
+after the pool was terminated
+"""
+ROWS = None
+WRITER_GRACE = 30
+
+"""
+Seconds a build worker gets per sample by default, and how often the alarm goes off again once that time is up, in
+case a parser swallowed it
+"""
+TASK_TIMEOUT = 300
+ALARM_REPEAT = 1.0
+
+"""
+Set by the alarm in a build worker, so a sample that ran out of time is recorded as a timeout whatever the parser
+turned the alarm into
+"""
+TIMED_OUT = False
+
+"""
+Smallest --max-mem in MB, it has to leave room for the stack of the thread that feeds the row queue
+"""
+MIN_MEM = 32
+
+"""
+Content digests of a build held in memory before those the writer has stored are dropped
+"""
+MAX_SEEN = 1 << 16
+
+"""
+Feature cache of a warm scoring worker, and the (generation, rows) it currently has mapped as FAMILIES
+"""
+SCORER_CACHE = None
+SCORER_KEY = None
+
+"""
+Stored graphs a refeature worker reads and recomputes per task, and the graph database it reads them from
+"""
+REFEATURE_CHUNK = 256
+REFEATURE_DB = None
+
 
 def plock(msg):
     with lock:
@@ -54,6 +120,18 @@ def parse_file_set(fpath):
         return set([line.rstrip('\n') for line in lines if not line.startswith('#')])
 
 
+def iter_file_set(fpath):
+    """
+    parse_file_set one line at a time, for job files too big to hold in memory. Duplicate lines are left to the job
+    database.
+    """
+    with open(fpath, "r") as fin:
+        for line in fin:
+            line = line.rstrip('\n')
+            if line and not line.startswith('#'):
+                yield line
+
+
 def shutdown(pool_, job_db):
     logging.debug("Shutting down pool")
     pool_.close()
@@ -62,69 +140,249 @@ def shutdown(pool_, job_db):
     job_db.close()
 
 
-def pscore(pdf_name, thresh, ftrs, gdb_path, unique_graphs):
-    pid = current_process().pid
-    graph_db = dbgw.PdfDb(gdb_path)
-    if not graph_db.init(graph_db.table, graph_db.cols):
-        logging.error("pscore %d could not initialize db. exiting." % pid)
-        sys.exit(-1)
-
-    for edge_md5 in unique_graphs:
-        pdf_id, ftrs_b = graph_db.load_family_features(edge_md5)
-        # logging.debug("\t%s: %s" % (pdf_id, ftrs_b))
-        try:
-            can_dist = canberra(ftrs, ftrs_b)
-        except ValueError:
-            logging.error("pscore canberra calc error. likely bad features for %s or %s" % (pdf_name, pdf_id))
-        else:
-            if not thresh or can_dist <= thresh:
-                plock("%s,%s,%s,%f\n" % (pdf_name, edge_md5, pdf_id, can_dist))
-
-
-def save_score(pnum):
-    global FILES, SIMSCORES
-    FILES[pnum].write('\n'.join(SIMSCORES[pnum]))
-
-
-def calc_workload(num_jobs, num_procs):
-    if num_jobs <= num_procs:
-        return 1, num_jobs
-    chunk_size = int(math.floor(float(num_jobs) / num_procs))
-    return chunk_size, num_procs
-
-
-def calc_similarities(pdf, pdf_db, num_procs, thresh):
-    unique_graphs = [row[0] for row in pdf_db.get_unique('e_md5')]
-    unique_num = len(unique_graphs)
-    chunk_size, num_procs = calc_workload(unique_num, num_procs)
-    offsets = [x for x in range(0, unique_num, chunk_size)]
-    logging.debug("calc_sim: %d procs offsets[%d] unique_graphs[%d]" % (num_procs, len(offsets), unique_num))
-
-    procs = [Process(target=pscore, args=(
-        pdf.name, thresh, pdf.ftr_vec, pdf_db.dbpath, unique_graphs[offsets[proc]:offsets[proc] + chunk_size])) for
-             proc in range(num_procs)]
+def partitions(num_rows, num_procs, min_rows=MIN_PARTITION):
+    """ Guided self-scheduling of the family rows. Each partition is a share of the rows still left, so they shrink
+    towards min_rows as the job goes on and the workers pulling them off the pool's task queue finish together.
+
+    :return: generator of (start, end) row ranges
+    """
+    start = 0
+    while start < num_rows:
+        end = min(num_rows, start + max(min_rows, (num_rows - start) // (PARTITION_SPLIT * num_procs)))
+        yield start, end
+        start = end
+
+
+def init_scorer(dbpath, results):
+    """
+    Initializer of the warm scoring pool. Each worker keeps its own handle on the feature cache for the whole run.
+    """
+    global SCORER_CACHE, RESULTS
+    SCORER_CACHE = FeatureCache(dbpath)
+    RESULTS = results
+
+
+def start_scorer(pdf_db, num_procs, writer):
+    """
+    Fork the scoring pool once per run. Call it before anything is put on the writer's queue, so no queue lock can be
+    held by another thread at the fork.
+    """
+    return Pool(num_procs, initializer=init_scorer, initargs=(pdf_db.dbpath, writer.queue))
+
+
+def scorer_families(key):
+    """ Family matrix for a job in a scoring worker. The worker only remaps the feature cache when the parent's
+    matrix has moved to a new generation or grown since the last job.
+
+    :param key: (cache generation, rows) of the parent's matrix, or None for the matrix inherited at the fork
+    :rtype: process.similarity.FamilyMatrix
+    :raise RuntimeError: if the cache no longer has that matrix, which fails the run rather than skipping its rows
+    """
+    global FAMILIES, SCORER_KEY
+    if key is None or key == SCORER_KEY:
+        return FAMILIES
+    generation, rows = key
+    stamp = SCORER_CACHE.read_stamp()
+    if not stamp or stamp.get("generation") != generation or stamp["rows"] < rows:
+        raise RuntimeError("feature cache moved on from generation %s with %d rows" % key)
+    FAMILIES = FamilyMatrix(features=SCORER_CACHE.map_features(rows))
+    SCORER_KEY = key
+    return FAMILIES
+
+
+def calc_similarities(pdf, pdf_db, scorer, num_procs, thresh, writer, top_k=0):
+    calc_batch_similarities([(pdf.name, pdf.ftr_vec)], pdf_db, scorer, num_procs, thresh, writer, top_k)
+
+
+def pscore_block(job):
+    """
+    Hits are put on the result writer's queue a chunk at a time.
+
+    :return: with top_k, a list of (distance, row) pairs per subject
+    """
+    key, names, subjects, thresh, start, end, top_k = job
+    nearest = [TopK(top_k) for name in names]
+    families = scorer_families(key)
+    try:
+        for offset, dists in families.block_distances(subjects, start, end):
+            if top_k:
+                for sub, heap in enumerate(nearest):
+                    heap.push_chunk(offset, dists[sub], thresh)
+                continue
+            if thresh:
+                sub_idx, idx = numpy.nonzero(dists <= thresh)
+            else:
+                sub_idx, idx = numpy.indices(dists.shape).reshape((2, -1))
+            RESULTS.put((names, sub_idx, offset + idx, dists[sub_idx, idx]))
+    except ValueError as e:
+        logging.error("pscore_block canberra calc error: %s" % e)
+    if top_k:
+        return [heap.items() for heap in nearest]
+
+
+def calc_batch_similarities(pdfs, pdf_db, scorer, num_procs, thresh, writer, top_k=0):
+    """
+    Score every subject against every family as one matrix job. The family rows are cut into partitions() that the
+    warm scorer pool hands out one at a time, and each worker scores all of the subjects against the rows it pulls.
+
+    Workers map the feature cache themselves. A matrix that could not be cached is shared with a one-off pool forked
+    for this job instead.
+    """
+    global FAMILIES, RESULTS
+    families = writer.families = pdf_db.load_family_matrix()
+    generation = pdf_db.family_generation()
+    unique_num = len(families)
+
+    names, subjects = [], []
+    for name, ftr_vec in pdfs:
+        if len(ftr_vec) != families.width:
+            logging.error("calc_batch_sim bad features for %s" % name)
+            continue
+        names.append(name)
+        subjects.append(ftr_vec)
+    subjects = numpy.array(subjects, dtype=numpy.float64).reshape((len(names), families.width))
+
+    logging.debug("calc_batch_sim: %d subjects %d procs unique_graphs[%d]" % (len(names), num_procs, unique_num))
+    if not names or not unique_num:
+        return
+
+    key = (generation, unique_num) if generation else None
+    jobs = ((key, names, subjects, thresh, start, end, top_k) for start, end in partitions(unique_num, num_procs))
+    nearest = [[] for name in names]
+    p = scorer
+    if key is None:
+        FAMILIES, RESULTS = families, writer.queue
+        p = Pool(num_procs)
+    try:
+        for result in p.imap_unordered(pscore_block, jobs):
+            if top_k:
+                nearest = [TopK.merge(top_k, pair) for pair in zip(nearest, result)]
+        for name, pairs in zip(names, nearest) if top_k else []:
+            writer.put_pairs(name, pairs)
+    finally:
+        if p is not scorer:
+            p.close()
+            p.join()
+            FAMILIES = RESULTS = None
+        writer.drain()
 
-    logging.debug("nabu.calc_simil. starting  children")
 
-    plock("subject,family,candidate,score\n")
-    for proc in procs:
-        proc.start()
+def parse_subjects(argv, todo, parse_func, console):
+    paths = []
+    for pdf_id in todo:
+        if not os.path.isfile(pdf_id):
+            logging.warning("main.parse_subjects not a file: %s" % pdf_id)
+        else:
+            paths.append(pdf_id)
+    if not paths:
+        return
 
-    logging.debug("nabu.calc_simil. waiting on children")
-    for proc in procs:
-        proc.join()
+    spill = spill_prefix()
+    p = Pool(min(len(paths), argv.procs), maxtasksperchild=argv.chunk)
+    try:
+        for path, row in p.imap_unordered(partial(parse_record, parse_func, spill=spill), paths):
+            console.write("Scoring: %s\n" % path)
+            yield path, unspill_row(row)
+    finally:
+        p.close()
+        p.join()
+        remove_spills(spill)
+
+
+def index_similarities(pdfs, pdf_db, thresh, top_k, checks, writer):
+    """
+    Score subjects with the VP-tree index over the families instead of scanning all of them. With checks set, each
+    query stops after visiting that many leaves and the results are approximate; otherwise they are exact.
+    """
+    families, tree = pdf_db.load_family_index()
+    writer.families = families
+    computed = total = 0
+    for name, ftr_vec in pdfs:
+        try:
+            nearest = tree.search(ftr_vec, top_k, thresh, checks)
+        except ValueError as e:
+            logging.error("index_similarities bad features for %s: %s" % (name, e))
+            continue
+        computed += tree.stats["distances"]
+        total += tree.stats["rows"]
+        logging.debug("index_sim: %s scored %d of %d families, %.1f%% pruned" % (
+            name, tree.stats["distances"], tree.stats["rows"], 100 * tree.pruned()))
+        writer.put_pairs(name, nearest)
+    writer.drain()
+    if total:
+        sys.stderr.write("Index computed %d of %d distances, %.1f%% pruned\n" % (
+            computed, total, 100 * (1.0 - float(computed) / total)))
+
+
+def index_checks(argv):
+    """
+
+    :return: leaves each index query may visit, 0 for an exact search, or None to scan every family instead
+    """
+    if not (argv.ann or argv.exact):
+        return None
+    if not (argv.top_k or argv.thresh):
+        logging.warning("main.index_checks needs --top-k or --thresh, scoring every family instead")
+        return None
+    return 0 if argv.exact else argv.ann
+
+
+def score_batch(argv, pdf_db, todo, parse_func, writer, scorer):
+    pdfs = []
+    for path, row in parse_subjects(argv, todo, parse_func, writer.console):
+        ftr_vec = pdf_db.unpack_features(row.features)
+        logging.debug("%s: %s" % (row.name, ftr_vec))
+        pdf_db.save_row(row)
+        pdfs.append((row.name, ftr_vec))
+    checks = index_checks(argv)
+    if checks is not None:
+        index_similarities(pdfs, pdf_db, argv.thresh, argv.top_k, checks, writer)
+    else:
+        calc_batch_similarities(pdfs, pdf_db, scorer, argv.procs, argv.thresh, writer, argv.top_k)
 
 
 def score_pdfs(argv, job_db, pdf_db):
     todo = parse_file_set(argv.fin)
 
-    parse_func = parse.get_parser(argv.parser)
+    parse_func = parse.get_parser(argv.parser, argv.graph_only)
     if not parse_func:
         logging.error("main.score_pdfs did not find valid parser: %s" % argv.parser)
         sys.exit(1)
 
+    writer = ResultWriter(argv.out, argv.format)
+    try:
+        writer.open()
+    except IOError as e:
+        logging.error("main.score_pdfs could not open output %s: %s" % (argv.out, e))
+        sys.exit(1)
+    scorer = start_scorer(pdf_db, argv.procs, writer) if index_checks(argv) is None else None
+    try:
+        try:
+            if argv.batch:
+                score_batch(argv, pdf_db, todo, parse_func, writer, scorer)
+            else:
+                score_each(argv, pdf_db, todo, parse_func, writer, scorer)
+        finally:
+            if scorer:
+                scorer.close()
+                scorer.join()
+            writer.close()
+    except Exception as e:
+        # Whatever scoring ran into afterwards, output that could not be written is what failed the run
+        if writer.error is not None:
+            logging.error("main.score_pdfs could not write the scores: %s" % writer.error)
+            sys.stderr.write("Writing scores failed: %s\n" % writer.error)
+            sys.exit(1)
+        if not isinstance(e, RuntimeError):
+            raise
+        logging.error("main.score_pdfs scoring failed: %s" % e)
+        sys.stderr.write("Scoring failed: %s\n" % e)
+        sys.exit(1)
+
+
+def score_each(argv, pdf_db, todo, parse_func, writer, scorer):
     for pdf_id in todo:
-        sys.stdout.write("Scoring: %s\n" % pdf_id)
+        writer.console.write("Scoring: %s\n" % pdf_id)
         if not os.path.isfile(pdf_id):
             logging.warning("main.score_pdfs not a file: %s" % pdf_id)
             continue
@@ -133,68 +391,394 @@ def score_pdfs(argv, job_db, pdf_db):
         logging.debug("%s: %s" % (pdf.name, pdf.ftr_vec))
 
         pdf_db.save(pdf)
-        calc_similarities(pdf, pdf_db, argv.procs, argv.thresh)
+        checks = index_checks(argv)
+        if checks is not None:
+            index_similarities([(pdf.name, pdf.ftr_vec)], pdf_db, argv.thresh, argv.top_k, checks, writer)
+        else:
+            calc_similarities(pdf, pdf_db, scorer, argv.procs, argv.thresh, writer, argv.top_k)
 
 
 def build_graphdb(argv, job_db, pdf_db):
-    if not argv.update:
-        done = job_db.get_completed(argv.job_id)
-        argv.todo.difference_update(done)
-        del done
+    if argv.dir:
+        if not os.path.isdir(argv.fin):
+            sys.stderr.write("%s is not a directory\n" % argv.fin)
+            sys.exit(1)
+        samples = walk_samples(argv.fin, parse_extensions(argv.ext), argv.min_size, argv.max_size)
+    elif os.access(argv.fin, os.R_OK):
+        samples = iter_file_set(argv.fin)
+    else:
+        sys.stderr.write("Could not read required job input file\n")
+        sys.exit(1)
+    reset = job_db.reset(argv.job_id, argv.update)
+    if reset and not argv.update:
+        logging.warning("main.build_graphdb %d samples were left unfinished by an earlier build, redoing them" % reset)
 
     cnt = 0
-    total_jobs = len(argv.todo)
-    sys.stdout.write("Total jobs: %s\n" % total_jobs)
-    if total_jobs <= 0:
-        sys.stdout.write("No work to do. Exiting\n")
-        sys.exit(0)
-
     logging.debug("Available processes: %s" % argv.procs)
 
-    num_procs = min(total_jobs, argv.procs)
-    p = Pool(num_procs, maxtasksperchild=argv.chunk)
-    logging.debug("Pool size: %d with tasks per child %d" % (num_procs, argv.chunk))
-
-    pfunc = parse.get_parser(argv.parser)
+    pfunc = parse.get_parser(argv.parser, argv.graph_only)
     if not pfunc:
         logging.error("main.build_graphdb could not find parser: %s" % argv.parser)
         sys.exit(1)
 
+    """
+    The writer opens its own connections. sqlite connections must not be open across the fork, or the writer would
+    inherit their lock bookkeeping without holding the locks, and a close here could checkpoint away its WAL.
+    """
+    pdf_db.close()
+    job_db.close()
+
+    global ROWS
+    ROWS = RowQueue()
+    metrics = BuildMetrics(argv.metrics, argv.metrics_every, Histogram.shared())
+    writer = Process(target=write_rows, args=(ROWS, pdf_db.dbpath, job_db.dbpath, argv.job_id, argv.commit_every,
+                                              metrics.commits.counts))
+    # Killed rather than waited for if we die before stop_writer, its open batch is redone on resume
+    writer.daemon = True
+    writer.start()
+
+    # Workers are replaced every argv.chunk samples, so whatever a sample that timed out or ran out of memory left
+    # behind does not outlive its worker for long
+    p = Pool(argv.procs, initializer=init_parser, initargs=(argv.max_mem,), maxtasksperchild=argv.chunk)
+    logging.debug("Pool size: %d with tasks per child %d" % (argv.procs, argv.chunk))
+
+    spill = spill_prefix()
+    stats = {"duplicates": 0}
+    jobs = unique_jobs(pending_jobs(argv.job_id, samples, job_db.dbpath), pdf_db.dbpath, stats, stored=not argv.update)
+    terminated = False
     try:
-        for pdf in p.imap_unordered(pfunc, argv.todo):
+        for path, status, size, seconds, stages in p.imap_unordered(
+                partial(parse_row, pfunc, spill=spill, timeout=argv.timeout), jobs):
             cnt += 1
-            sys.stdout.write("%7d/%7d\r" % (cnt, total_jobs))
-            logging.debug("%s: %s/%s" % (pdf.name, cnt, total_jobs))
-            pdf_db.save(pdf)
-            job_db.mark_complete(args.job_id, pdf.path)
+            metrics.add(status, size, seconds, stages)
+            sys.stdout.write("%7d\r" % cnt)
+            logging.debug("%s: %s" % (path, cnt))
+            if metrics.due():
+                metrics.duplicates = stats["duplicates"]
+                metrics.queue_depth = ROWS.qsize()
+                metrics.report(sys.stdout)
+            if not writer.is_alive():
+                raise RuntimeError("storage writer exited with %s" % writer.exitcode)
     except KeyboardInterrupt:
         logging.warning("\nTerminating pool...\n")
         sys.stderr.write("\nTerminating pool...\n")
         p.terminate()
+        terminated = True
     except pool.MaybeEncodingError as e:
         logging.error("main.build_graphdb imap error: %s" % e)
-        sys.stderr.write("\nError in processing pool (%s of %s completed):\n%s\n" % (cnt, total_jobs, e))
+        sys.stderr.write("\nError in processing pool (%s completed):\n%s\n" % (cnt, e))
         p.terminate()
+        terminated = True
     except Exception as e:
         sys.stderr.write("\nUnhandled error building PDF DB: %s\n%s\n" % (traceback.format_exc(), repr(e)))
         p.terminate()
+        terminated = True
     finally:
-        sys.stdout.write("\nCompleted: %7d/%7d\n" % (cnt, total_jobs))
+        if cnt + stats["duplicates"] or terminated:
+            sys.stdout.write("\nCompleted: %7d (%d duplicates not parsed)\n" % (
+                cnt + stats["duplicates"], stats["duplicates"]))
+        else:
+            sys.stdout.write("No work to do\n")
         shutdown(p, job_db)
+        stop_writer(writer, terminated)
+        ROWS = None
+        if cnt + stats["duplicates"]:
+            metrics.duplicates = stats["duplicates"]
+            metrics.queue_depth = 0
+            metrics.report(sys.stdout)
+        if job_db.init(job_db.table, job_db.cols):
+            counts = job_db.counts(argv.job_id)
+            if counts.get(dbgw.FAILED) or counts.get(dbgw.TIMEOUT):
+                sys.stdout.write("Failed: %d, timed out: %d (see the job database for errors)\n" % (
+                    counts.get(dbgw.FAILED, 0), counts.get(dbgw.TIMEOUT, 0)))
+            job_db.close()
+        removed = remove_spills(spill)
+        if removed:
+            logging.warning("main.build_graphdb removed %d spill files that were never stored" % removed)
+
+
+def parse_record(pfunc, path, spill=None):
+    """
+    Pool worker. Parses a sample and reduces it to its path and storage.dbgw.PdfRow, which is all the parent needs.
+    The PDF itself, with its element tree, never goes back through the pool. With a spill prefix, big fields of the
+    row are written to spill files and only their handles are sent.
+    """
+    pdf = pfunc(path)
+    with stage("row"):
+        row = dbgw.PdfDb.make_row(pdf)
+        return pdf.path, spill_row(row, spill) if spill else row
+
+
+def pending_jobs(job_name, paths, dbpath):
+    """
+    Streaming resume check. Samples are handed on as they are read, skipping those the job database has seen already.
+
+    The pool consumes this from its task handler thread, so it opens its own connection there.
+
+    :return: generator of sample paths
+    """
+    job_db = dbgw.JobDb(dbpath)
+    if not job_db.init(job_db.table, job_db.cols):
+        # An exception here would kill the task handler and hang the pool
+        logging.error("main.pending_jobs could not open %s, nothing to dispatch" % dbpath)
+        return
+    try:
+        for path in job_db.unfinished(job_name, paths):
+            yield path
+    finally:
+        job_db.close()
 
 
-def draw_clusters(argv, graph_db):
-    unique_graphs = [row[0] for row in graph_db.get_unique('e_md5')]
-    unique_num = len(unique_graphs)
-
-    logging.info('draw_clusters: Clustering %d graphs' % unique_num)
-    x = []
-    for edge_md5 in unique_graphs:
-        pdf_id, ftrs_b = graph_db.load_family_features(edge_md5)
-        if not ftrs_b:
-            sys.stderr.write("PDF has empty feature set: %s" % pdf_id)
+def unique_jobs(paths, dbpath, stats, stored=True):
+    """
+    Hash every sample before it is dispatched. A sample whose content is already stored, or already on its way in this
+    run, goes to the storage writer as an Alias instead of being parsed again.
+
+    The pool consumes this from its task handler thread, so it opens its own read connection there. Digests of this
+    run are forgotten once the writer has stored them, so memory stays flat however long the job file is.
+
+    :param stored: also alias samples whose content was stored by an earlier build, False when redoing a build
+
+    :return: generator of (path, content MD5) to parse
+    """
+    pdf_db = dbgw.PdfDb(dbpath)
+    if not pdf_db.init(pdf_db.table, pdf_db.cols):
+        logging.error("main.unique_jobs could not open %s, only deduplicating within this run" % dbpath)
+        pdf_db = None
+    seen = set()
+    limit = MAX_SEEN
+    try:
+        for path in paths:
+            try:
+                content_md5 = get_file_hash(path)
+            except (IOError, OSError) as e:
+                logging.warning("main.unique_jobs could not hash %s: %s" % (path, e))
+                yield path, None
+                continue
+            if content_md5 in seen or (stored and pdf_db and pdf_db.lookup_content(content_md5)):
+                stats["duplicates"] += 1
+                ROWS.put((path, content_md5, Alias(os.path.basename(path))))
+                continue
+            seen.add(content_md5)
+            if len(seen) >= limit and pdf_db:
+                seen = set([md5 for md5 in seen if not pdf_db.lookup_content(md5)])
+                limit = max(MAX_SEEN, 2 * len(seen))
+            yield path, content_md5
+    finally:
+        if pdf_db:
+            pdf_db.close()
+
+
+class ParseTimeout(BaseException):
+    """
+    Raised in a build worker by SIGALRM when a sample takes longer than --timeout. It is not an Exception, so the
+    parsers' catch-all handlers cannot swallow it and carry on with half a document.
+    """
+    pass
+
+
+def alarm(signum, frame):
+    global TIMED_OUT
+    TIMED_OUT = True
+    raise ParseTimeout()
+
+
+def address_space():
+    """
+
+    :return: bytes of address space this process uses, 0 if it cannot tell
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[0]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return 0
+
+
+def init_parser(max_mem):
+    """
+    Build worker initializer. Sets up the timeout alarm and lets the address space of the worker grow by at most
+    max_mem MB, so a sample that balloons gets a MemoryError instead of taking the machine down. The cap is on top of
+    what the worker already uses, which with numpy and friends loaded is a few hundred MB before it parses anything.
+    """
+    signal.signal(signal.SIGALRM, alarm)
+    if max_mem > 0:
+        limit = address_space() + (max(max_mem, MIN_MEM) << 20)
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+        except ValueError as e:
+            logging.error("main.init_parser could not cap memory at %d MB: %s" % (max_mem, e))
+
+
+def parse_row(pfunc, job, spill=None, timeout=0):
+    """
+    Build worker. Hands the parsed record straight to the storage writer, so only the path and a few metrics come back
+    through the pool. A sample that takes longer than timeout seconds or cannot be parsed is recorded as such instead.
+
+    :return: path, failure status or None, bytes, seconds taken and seconds per metrics.STAGES
+    """
+    global TIMED_OUT
+    path, content_md5 = job
+    started = time.time()
+    ROWS.put((path, content_md5, Running(started)))
+    take_stages()
+    TIMED_OUT = False
+    try:
+        try:
+            if timeout > 0:
+                signal.setitimer(signal.ITIMER_REAL, timeout, ALARM_REPEAT)
+            path, row = parse_record(pfunc, path, spill)
+        finally:
+            # An alarm going off in here still lands in the handlers below
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except (ParseTimeout, Exception) as e:
+        # Cleanup code in the parsers can replace the alarm with an error of its own, so go by the flag
+        if TIMED_OUT:
+            logging.error("main.parse_row gave up on %s after %ss" % (path, timeout))
+            row = Failed("timed out after %ss" % timeout, dbgw.TIMEOUT)
         else:
-            x.append(ftrs_b)
+            logging.error("main.parse_row could not parse %s: %s" % (path, e))
+            row = Failed("%s: %s" % (e.__class__.__name__, e), dbgw.FAILED)
+    seconds = time.time() - started
+    try:
+        ROWS.put((path, content_md5, row))
+    except Exception as e:
+        # e.g. a MemoryError pickling a large row under --max-mem. The sample fails rather than being left running.
+        logging.error("main.parse_row could not hand over the row of %s: %s" % (path, e))
+        discard_row(row)
+        row = Failed("could not hand over the row: %s: %s" % (e.__class__.__name__, e), dbgw.FAILED)
+        ROWS.put((path, content_md5, row))
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    return path, row.status if isinstance(row, Failed) else None, size, seconds, take_stages()
+
+
+def stop_writer(writer, terminated):
+    """
+    Let the storage writer commit what it has and exit. A worker killed by terminate() may have left half a row in the
+    queue, or the queue locked, which would leave the writer or us waiting forever, so it only gets WRITER_GRACE
+    seconds in that case. Whatever it had not committed is redone on resume.
+    """
+    if writer.is_alive():
+        try:
+            ROWS.put((None, None, Finished(not terminated)), WRITER_GRACE if terminated else None)
+        except Queue.Full:
+            logging.error("main.stop_writer could not reach the storage writer")
+    writer.join(WRITER_GRACE if terminated else None)
+    if writer.is_alive():
+        logging.error("main.stop_writer storage writer did not finish, terminating it")
+        writer.terminate()
+        writer.join()
+    if writer.exitcode:
+        sys.stderr.write("Storage writer failed (%s), see the log\n" % writer.exitcode)
+
+
+def build_index(argv, pdf_db):
+    families = pdf_db.load_family_matrix()
+    generation = pdf_db.ftr_cache.generation() if pdf_db.ftr_cache.fresh() else None
+    tree = pdf_db.ftr_index.rebuild(families, generation)
+    sys.stdout.write("Indexed %d families: %d nodes, %d leaves, depth %d\n" % (
+        tree.size, len(tree.vp), tree.leaves, tree.depth()))
+    if generation is None:
+        sys.stderr.write("Feature cache could not be written, index was not saved\n")
+
+
+def init_refeature(dbpath):
+    """
+    Initializer of the refeature pool. Each worker reads the graphs through its own connection.
+    """
+    global REFEATURE_DB
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    REFEATURE_DB = dbgw.PdfDb(dbpath)
+    if not REFEATURE_DB.init(REFEATURE_DB.table, REFEATURE_DB.cols):
+        logging.error("main.init_refeature could not open %s" % dbpath)
+
+
+def refeature_rows(bounds):
+    """ Refeature worker. Recomputes the feature vectors of the stored graphs of a chunk of the pdfs table.
+
+    :param bounds: first and last rowid of the chunk
+    :return: (packed features, pdf_id) of each graph, and the number of graphs that failed
+    """
+    pdf = PDF("")
+    rows = []
+    failed = 0
+    for name, verts, edges in REFEATURE_DB.chunk(*bounds):
+        try:
+            # A sample that did not parse has no graph, and keeps its empty vector
+            ftrs = pdf.aggregate_ftr_matrix(pdf.get_graph_features(verts, edges)) if verts else []
+        except Exception as e:
+            logging.error("main.refeature_rows could not compute features of %s: %s" % (name, e))
+            failed += 1
+            continue
+        rows.append((numpy.asarray(ftrs, dtype=dbgw.FEATURE_DTYPE).tostring(), name))
+    return rows, failed
+
+
+def refeature_graphdb(argv, pdf_db):
+    """ Recompute the feature vector of every stored graph, e.g. after a change to PDF.aggregate_ftr_matrix, without
+    parsing a single sample again. Workers read REFEATURE_CHUNK graphs at a time with PdfDb.chunk and send back the
+    packed vectors, and they are updated in place here as they come, a chunk per transaction. The rowid ranges of the
+    chunks are taken up front; updates do not move rows, so they hold while it runs. A build must not run at the same
+    time.
+
+    The feature cache is invalidated before the first update and after the last, and the family index with it. If it is
+    interrupted, the rows hold old and new vectors; run it again.
+    """
+    total = pdf_db.size()
+    if total <= 0:
+        sys.stdout.write("No graphs to refeature\n")
+        return
+    # The pool's task thread hands the ranges out, and it may not use our connection
+    ranges = list(pdf_db.rowid_ranges(REFEATURE_CHUNK))
+    pdf_db.ftr_cache.invalidate()
+    # The workers open their own connections, none may be open across the fork
+    pdf_db.close()
+    p = Pool(argv.procs, initializer=init_refeature, initargs=(pdf_db.dbpath,))
+    if not pdf_db.init(pdf_db.table, pdf_db.cols):
+        p.terminate()
+        sys.exit(1)
+
+    start = time.time()
+    done = failed = 0
+    terminated = False
+    try:
+        for rows, errors in p.imap_unordered(refeature_rows, ranges):
+            if not pdf_db.update_features(rows):
+                raise RuntimeError("could not update %d feature vectors" % len(rows))
+            done += len(rows)
+            failed += errors
+            sys.stdout.write("%7d\r" % done)
+    except KeyboardInterrupt:
+        sys.stderr.write("\nTerminating pool...\n")
+        p.terminate()
+        terminated = True
+    except Exception as e:
+        logging.error("main.refeature_graphdb error: %s" % e)
+        sys.stderr.write("\nError refeaturing graphs: %s\n" % e)
+        p.terminate()
+        terminated = True
+    finally:
+        if not terminated:
+            p.close()
+        p.join()
+        pdf_db.ftr_cache.invalidate()
+    elapsed = time.time() - start
+    sys.stdout.write("\nRefeatured %d of %d graphs in %.1fs (%.1f/s), %d failed\n" % (
+        done, total, elapsed, done / max(elapsed, 1e-9), failed))
+    if terminated:
+        sys.stderr.write("Stopped early, the rows hold old and new feature vectors until refeature is run again\n")
+        sys.exit(1)
+
+
+def draw_clusters(argv, graph_db):
+    families = graph_db.load_family_matrix()
+
+    logging.info('draw_clusters: Clustering %d graphs' % len(families))
+    x = families.features
 
     try:
         plock("Linkage...\n")
@@ -203,7 +787,7 @@ def draw_clusters(argv, graph_db):
         dendrogram(z, color_threshold=2)
     except ValueError as e:
         sys.stderr.write("SciPy linkage ValueError: %s\n" % e)
-        if not x:
+        if not len(x):
             sys.stderr.write("No PDF feature sets found. Empty or incorrect graph database?\n")
     else:
         plock("Showtime\n")
@@ -211,9 +795,13 @@ def draw_clusters(argv, graph_db):
 
 
 def main(args):
+    if args.action in ["build", "score"] and not args.fin:
+        sys.stderr.write("%s needs a line separated text file of samples%s\n" % (
+            args.action, " or, with --dir, a directory" if args.action == "build" else ""))
+        sys.exit(1)
+
     if args.fin:
         args.job_id = get_hash(os.path.abspath(args.fin) + args.action)
-        args.todo = parse_file_set(args.fin)
 
     job_db = dbgw.JobDb(os.path.join(args.dbdir, args.jobdb))
     pdf_db = dbgw.PdfDb(os.path.join(args.dbdir, args.graphdb))
@@ -223,6 +811,12 @@ def main(args):
         logging.error("main.main could not initialize db. exiting.")
         sys.exit(1)
 
+    if args.action == "migrate":
+        sys.exit(0 if migrate(pdf_db) else 1)
+    if pdf_db.outdated():
+        sys.stderr.write("%s has an older schema, run: python main.py [options] migrate\n" % pdf_db.dbpath)
+        sys.exit(1)
+
     start = time.clock()
     if args.action == "build":
         logging.info("main.main Building graph database")
@@ -232,6 +826,14 @@ def main(args):
         logging.info("main.main Scoring graphs")
         score_pdfs(args, job_db, pdf_db)
         logging.info("Scoring finished in ~ %.3f" % (time.clock() - start))
+    elif args.action == "index":
+        logging.info("main.main Indexing graph families")
+        build_index(args, pdf_db)
+        logging.info("Indexing finished in ~ %.3f" % (time.clock() - start))
+    elif args.action == "refeature":
+        logging.info("main.main Recomputing graph features")
+        refeature_graphdb(args, pdf_db)
+        logging.info("Refeaturing finished in ~ %.3f" % (time.clock() - start))
     elif args.action == "cluster":
         logging.info("main.main Clustering graphs")
         sys.stdout.write("This feature is under construction.\n")
@@ -243,9 +845,20 @@ if __name__ == "__main__":
     argparser = ArgumentParser()
 
     argparser.add_argument('action',
-                           help="build | score | cluster (under construction)")
+                           help="build | score | index | migrate | refeature | cluster (under construction)")
     argparser.add_argument('fin',
-                           help="line separated text file of samples to run")
+                           nargs='?',
+                           help="line separated text file of samples to run, or a directory with build --dir")
+    argparser.add_argument('-a', '--ann',
+                           type=int,
+                           default=0,
+                           metavar='CHECKS',
+                           help="Score: approximate search of the family index, visiting at most CHECKS leaves per "
+                                "subject. Needs --top-k or --thresh.")
+    argparser.add_argument('--batch',
+                           action='store_true',
+                           default=False,
+                           help="Score: parse every subject first, then score them all in one pass")
     argparser.add_argument('-b', '--beginning',
                            action='store_true',
                            default=False,
@@ -254,6 +867,39 @@ if __name__ == "__main__":
                            type=int,
                            default=1,
                            help="Chunk size in jobs. Default is num_procs * 1")
+    argparser.add_argument('--commit-every',
+                           type=int,
+                           default=BATCH_SIZE,
+                           help="Build: documents saved per database transaction. Default is %d" % BATCH_SIZE)
+    argparser.add_argument('--dir',
+                           action='store_true',
+                           default=False,
+                           help="Build: fin is a directory tree to walk for samples instead of a job file")
+    argparser.add_argument('--ext',
+                           default=None,
+                           help="Build --dir: only take files with these comma separated extensions, e.g. pdf,bin")
+    argparser.add_argument('--max-mem',
+                           type=int,
+                           default=0,
+                           help="Build: let each parsing process grow by at most this many MB of address space. "
+                                "Default is no cap")
+    argparser.add_argument('--metrics',
+                           default=None,
+                           help="Build: keep build metrics in this file, Prometheus text if it ends in .prom, JSON "
+                                "otherwise")
+    argparser.add_argument('--metrics-every',
+                           type=float,
+                           default=METRICS_EVERY,
+                           help="Build: seconds between stats lines and metrics file updates, 0 for only at the end. "
+                                "Default is %d" % METRICS_EVERY)
+    argparser.add_argument('--min-size',
+                           type=int,
+                           default=0,
+                           help="Build --dir: skip files smaller than this many bytes")
+    argparser.add_argument('--max-size',
+                           type=int,
+                           default=0,
+                           help="Build --dir: skip files larger than this many bytes. Default is no limit")
     argparser.add_argument('-d', '--debug',
                            action='store_true',
                            default=False,
@@ -261,6 +907,15 @@ if __name__ == "__main__":
     argparser.add_argument('-g', '--graphdb',
                            default='nabu-graphdb.sqlite',
                            help='Graph database filename. Default is nabu-graphdb.sqlite')
+    argparser.add_argument('-x', '--exact',
+                           action='store_true',
+                           default=False,
+                           help="Score: exact search of the family index. Needs --top-k or --thresh.")
+    argparser.add_argument('--graph-only',
+                           action='store_true',
+                           default=False,
+                           help="Build/score: parse samples straight into their graphs, without building their XML "
+                                "or writing it to xml-output")
     argparser.add_argument('-j', '--jobdb',
                            default='nabu-jobs.sqlite',
                            help='Job database filename. Default is nabu-jobs.sqlite')
@@ -273,6 +928,13 @@ if __name__ == "__main__":
     argparser.add_argument('--logdir',
                            default='logs',
                            help="Logging directory. Default is .../nabu/logs/")
+    argparser.add_argument('-o', '--out',
+                           default=None,
+                           help="Score: write results to this file instead of stdout")
+    argparser.add_argument('--format',
+                           choices=FORMATS,
+                           default='csv',
+                           help="Score: result format, one of %s. Default is csv" % " | ".join(FORMATS))
     argparser.add_argument('--parser',
                            default='pdfminer',
                            help="Type of pdf parser to use. Default is pdfminer")
@@ -284,6 +946,15 @@ if __name__ == "__main__":
                            type=int,
                            default=0,
                            help="Threshold which reports only graphs with similarities at or below this value.")
+    argparser.add_argument('-k', '--top-k',
+                           type=int,
+                           default=0,
+                           help="Report only the k closest families for each subject. Combines with --thresh.")
+    argparser.add_argument('--timeout',
+                           type=float,
+                           default=TASK_TIMEOUT,
+                           help="Build: give up on a sample after this many seconds, 0 for never. "
+                                "Default is %d" % TASK_TIMEOUT)
     argparser.add_argument('-u', '--update',
                            default=False,
                            action='store_true',
@@ -0,0 +1,387 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+"""
+Compact form of the graph of a parsed PDF. PDF.get_nodes_edges gives vertices as (label, [tag, ...]) with every tag
+under the object, and edges as (label, label), so each label and tag string is held, and pickled, over and over. Here
+every label is held once and nodes are numbers into the label table, every tag is held once and tags are numbers into
+a vocabulary, and vertices, tags and edges are NumPy columns of those numbers, each of the narrowest type that holds
+it. Objects of a kind have the same tags, so each distinct tag list is held once too, and a vertex points to its list.
+
+Packed, the vertex blob holds the labels of the vertices and the edge blob only numbers into them, along with the few
+labels that are only in edges. Both are a header of column lengths followed by the columns, raw deflated.
+"""
+
+import struct
+import zlib
+
+import networkx
+import numpy
+
+from util.str_utils import get_hash
+
+"""
+Types a column of numbers may have, the first that holds its largest value is used. Little-endian so the packed form
+is the same on any machine.
+"""
+COLUMN_DTYPES = ["<u1", "<u2", "<u4"]
+
+"""
+zlib level of the packed vertex and edge lists. They are raw deflate streams, without zlib's header and checksum.
+"""
+PACK_LEVEL = 6
+
+
+def column(values):
+    """
+
+    :param values: non-negative integers
+    :return: the values as an array of the first of COLUMN_DTYPES that holds them
+    :rtype: numpy.ndarray
+    """
+    values = numpy.asarray(values, dtype=numpy.int64)
+    top = int(values.max()) if len(values) else 0
+    for dtype in COLUMN_DTYPES:
+        if top <= numpy.iinfo(dtype).max:
+            return values.astype(dtype)
+    raise ValueError("column value %d does not fit in %s" % (top, COLUMN_DTYPES[-1]))
+
+
+def string_columns(strings):
+    """
+
+    :param strings: byte strings
+    :return: their lengths and their bytes, as two columns
+    """
+    return column([len(s) for s in strings]), numpy.frombuffer("".join(strings), dtype=COLUMN_DTYPES[0])
+
+
+def strings(lengths, data):
+    """ Inverse of string_columns """
+    data = data.tostring()
+    ends = numpy.cumsum(lengths, dtype=numpy.int64).tolist()
+    return [data[lo:hi] for lo, hi in zip([0] + ends[:-1], ends)]
+
+
+def pack_columns(columns):
+    """ The columns as one string: the item size of their lengths and of each, their lengths, then their bytes. The
+    lengths are a column themselves.
+
+    :type columns: list of numpy.ndarray
+    :rtype: str
+    """
+    lengths = column([len(col) for col in columns])
+    sizes = [lengths.itemsize] + [col.itemsize for col in columns]
+    return "".join([struct.pack("<%dB" % len(sizes), *sizes), lengths.tostring()] + [col.tostring() for col in columns])
+
+
+def unpack_columns(data, count):
+    """ Inverse of pack_columns
+
+    :param count: number of columns packed
+    :rtype: list of numpy.ndarray
+    """
+    sizes = struct.unpack_from("<%dB" % (count + 1), data)
+    pos = count + 1
+    lengths = numpy.frombuffer(data, dtype="<u%d" % sizes[0], count=count, offset=pos)
+    pos += lengths.nbytes
+    columns = []
+    for size, length in zip(sizes[1:], lengths.tolist()):
+        col = numpy.frombuffer(data, dtype="<u%d" % size, count=length, offset=pos)
+        pos += col.nbytes
+        columns.append(col)
+    if pos != len(data):
+        raise ValueError("unpack_columns %d bytes left over" % (len(data) - pos))
+    return columns
+
+
+def deflate(data):
+    compressor = zlib.compressobj(PACK_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def inflate(blob):
+    return zlib.decompress(str(blob), -zlib.MAX_WBITS)
+
+
+class CompactGraph(object):
+    """
+    labels holds each node label once, those of vertices first, in the order they first appear, and count is how many
+    belong to vertices. vertices has the node of each entry of the vertex list, duplicates included, and tag_lists the
+    tag list of the entry. The tags of list i are tags[tag_offsets[i]:tag_offsets[i + 1]], as numbers into vocab.
+    Edge i goes from node src[i] to node dst[i].
+    """
+
+    def __init__(self, labels, count, vertices, tag_lists, vocab, tag_offsets, tags, src, dst):
+        self.labels = labels
+        self.count = count
+        self.vertices = vertices
+        self.tag_lists = tag_lists
+        self.vocab = vocab
+        self.tag_offsets = tag_offsets
+        self.tags = tags
+        self.src = src
+        self.dst = dst
+
+    @classmethod
+    def from_lists(cls, v, e):
+        """
+
+        :param v: vertices (label, [tag, ...]), as from PDF.get_nodes_edges
+        :param e: edges (label, label)
+        :rtype: CompactGraph
+        """
+        labels, index = [], {}
+        vocab, vocab_index = [], {}
+        lists, list_index = [], {}
+
+        def node(label):
+            if label not in index:
+                index[label] = len(labels)
+                labels.append(label)
+            return index[label]
+
+        def tag(name):
+            if name not in vocab_index:
+                vocab_index[name] = len(vocab)
+                vocab.append(name)
+            return vocab_index[name]
+
+        def tag_list(attrs):
+            attrs = tuple(attrs)
+            if attrs not in list_index:
+                list_index[attrs] = len(lists)
+                lists.append([tag(name) for name in attrs])
+            return list_index[attrs]
+
+        vertices = column([node(label) for label, attrs in v])
+        tag_lists = column([tag_list(attrs) for label, attrs in v])
+        count = len(labels)
+        tag_offsets = column(numpy.cumsum([0] + [len(tags) for tags in lists]))
+        tags = column([t for tags in lists for t in tags])
+        src = column([node(label) for label, _ in e])
+        dst = column([node(label) for _, label in e])
+        return cls(labels, count, vertices, tag_lists, vocab, tag_offsets, tags, src, dst)
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """
+
+        :param graph: graph with the tags of each node in its "contains" attribute, as from to_networkx
+        :type graph: networkx.Graph
+        :rtype: CompactGraph
+        """
+        v = [(label, attrs.get("contains", [])) for label, attrs in graph.nodes_iter(data=True)]
+        return cls.from_lists(v, graph.edges())
+
+    def to_lists(self):
+        """
+
+        :return: the vertex and edge lists the graph was made from
+        """
+        labels, vocab = self.labels, self.vocab
+        tags = [vocab[t] for t in self.tags.tolist()]
+        offsets = self.tag_offsets.tolist()
+        v = [(labels[n], tags[offsets[i]:offsets[i + 1]])
+             for n, i in zip(self.vertices.tolist(), self.tag_lists.tolist())]
+        e = [(labels[s], labels[d]) for s, d in zip(self.src.tolist(), self.dst.tolist())]
+        return v, e
+
+    def to_networkx(self):
+        """ The graph PDF.get_graph_features_networkx builds from the vertex and edge lists
+
+        :rtype: networkx.Graph
+        """
+        graph = networkx.Graph()
+        for label, attrs in self.to_lists()[0]:
+            graph.add_node(label, contains=attrs)
+        labels = self.labels
+        graph.add_edges_from([(labels[s], labels[d]) for s, d in zip(self.src.tolist(), self.dst.tolist())])
+        return graph
+
+    @property
+    def nbytes(self):
+        """ Bytes held by the columns, the label and tag strings aside """
+        return sum([col.nbytes for col in [self.vertices, self.tag_lists, self.tag_offsets, self.tags, self.src,
+                                           self.dst]])
+
+    def vertex_columns(self):
+        # Vertices are numbered as they first appear, so without duplicate labels they are 0, 1, 2... and left out
+        vertices = self.vertices
+        if len(vertices) == self.count and numpy.array_equal(vertices, numpy.arange(self.count)):
+            vertices = vertices[:0]
+        label_lens, label_data = string_columns(self.labels[:self.count])
+        vocab_lens, vocab_data = string_columns(self.vocab)
+        return [label_lens, label_data, vertices, self.tag_lists, column(numpy.diff(self.tag_offsets)), self.tags,
+                vocab_lens, vocab_data]
+
+    def pack_vertices(self):
+        """ The vertex list packed for the vertices column of the pdfs table, with the labels of the graph's vertices.
+        It depends on nothing but the vertex list.
+
+        :rtype: str
+        """
+        return deflate(pack_columns(self.vertex_columns()))
+
+    def pack_edges(self):
+        """ The edge list packed for the edges column of the pdfs table, as numbers into the labels of pack_vertices
+        and of the nodes that are only in edges, which it holds.
+
+        :rtype: str
+        """
+        return deflate(pack_columns(list(string_columns(self.labels[self.count:])) + [self.src, self.dst]))
+
+    def digests(self):
+        """ MD5 of the vertex list and of the edge list, for the v_md5 and e_md5 columns of the pdfs table. The edge
+        blob numbers its nodes by the vertex list, so the edge digest is taken over the edges with their nodes numbered
+        again in the order they first appear in them instead: equal edge lists have equal digests, whatever their
+        vertices.
+
+        :return: vertex MD5, edge MD5
+        """
+        ends = numpy.empty(2 * len(self.src), dtype=numpy.int64)
+        ends[0::2], ends[1::2] = self.src, self.dst
+        nodes, first, renumbered = numpy.unique(ends, return_index=True, return_inverse=True)
+        order = numpy.argsort(first, kind="mergesort")
+        rank = numpy.empty(len(order), dtype=numpy.int64)
+        rank[order] = numpy.arange(len(order))
+        renumbered = rank[renumbered]
+        labels = [self.labels[n] for n in nodes[order].tolist()]
+        edges = list(string_columns(labels)) + [column(renumbered[0::2]), column(renumbered[1::2])]
+        return get_hash(pack_columns(self.vertex_columns())), get_hash(pack_columns(edges))
+
+    @classmethod
+    def unpack(cls, v_blob, e_blob):
+        """
+
+        :param v_blob: from pack_vertices
+        :param e_blob: from pack_edges
+        :rtype: CompactGraph
+        """
+        label_lens, label_data, vertices, tag_lists, list_lens, tags, vocab_lens, vocab_data = unpack_columns(
+            inflate(v_blob), 8)
+        extra_lens, extra_data, src, dst = unpack_columns(inflate(e_blob), 4)
+        labels = strings(label_lens, label_data)
+        count = len(labels)
+        if not len(vertices) and len(tag_lists):
+            vertices = column(numpy.arange(count))
+        labels.extend(strings(extra_lens, extra_data))
+        tag_offsets = column(numpy.cumsum(numpy.concatenate([[0], list_lens])))
+        return cls(labels, count, vertices, tag_lists, strings(vocab_lens, vocab_data), tag_offsets, tags, src, dst)
+
+
+class GraphBuilder(object):
+    """
+    Takes the start, data and end calls of an xml.etree.ElementTree.TreeBuilder, for PDFMinerParser to build the graph
+    of a PDF without building its element tree. It keeps what PDF.get_nodes_edges and PDF.get_javascript would take
+    from the tree, as the elements go by: the tags and references of each object under the root, the first reference
+    under the first Root element, and the text of the js elements. Tag mismatches fail the way TreeBuilder fails them.
+    """
+
+    def __init__(self):
+        self.stack = []
+        self.visited = set([()])
+        self.objects = []
+        self.edges = []
+        self.missing = []
+        self.src_id = None
+        self.tags = None
+        self.root_depth = None
+        self.root_done = False
+        self.rootid = None
+        self.js = []
+        self.text = None
+
+    def flush(self):
+        # Data after the start of a js element and before the next start or end is its text, as in TreeBuilder
+        if self.text is not None:
+            self.js.append("".join(self.text) if self.text else None)
+            self.text = None
+
+    def start(self, tag, attrs):
+        """
+
+        :return: the attributes, which PDFMinerParser may set more of like it does on an element
+        :rtype: Attributes
+        """
+        self.flush()
+        depth = len(self.stack)
+        self.stack.append(tag)
+        if depth == 1 and tag == "object":
+            src_id = attrs.get("id")
+            while src_id in self.visited:
+                src_id += '_'
+            self.visited.add(src_id)
+            self.src_id, self.tags = src_id, [tag]
+            self.objects.append((src_id, self.tags))
+        elif self.tags is not None:
+            self.tags.append(tag)
+        if tag == "Root" and self.root_depth is None and depth > 0:
+            self.root_depth = depth
+        elif tag == "ref":
+            dst_id = attrs.get("id")
+            if self.root_depth is not None and not self.root_done:
+                self.rootid, self.root_done = dst_id, True
+            if self.tags is not None:
+                if dst_id not in self.visited:
+                    self.missing.append(dst_id)
+                self.edges.append((self.src_id, dst_id))
+        elif tag == "js":
+            self.text = []
+        return Attributes(attrs)
+
+    def data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def end(self, tag):
+        self.flush()
+        last = self.stack.pop()
+        depth = len(self.stack)
+        if depth == 1:
+            self.tags = None
+        if self.root_depth == depth:
+            # Only the first reference under the first Root counts, and there may be none
+            self.root_done = True
+        assert last == tag, "end tag mismatch (expected %s, got %s)" % (last, tag)
+
+    def close(self):
+        """
+
+        :return: vertices and edges, as PDF.get_nodes_edges makes them from the element tree
+        """
+        assert len(self.stack) == 0, "missing end tags"
+        v = [("PDF", ["start"])]
+        rootid = self.rootid
+        if not rootid:
+            rootid = 'missing_root'
+            v.append((rootid, ["root"]))
+        v.extend(self.objects)
+        v.extend([(dst_id, ['missing_target']) for dst_id in self.missing if dst_id not in self.visited])
+        return v, [("PDF", rootid)] + self.edges
+
+    def get_javascript(self):
+        """
+
+        :return: what PDF.get_javascript finds in the element tree
+        """
+        return "\n".join([text or '' for text in self.js])
+
+
+class Attributes(dict):
+    """
+    Stands in for the element GraphBuilder.start does not build
+    """
+
+    def set(self, key, value):
+        self[key] = value
@@ -0,0 +1,223 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+"""
+NetSimile node features for every node of a graph at once, from its sparse adjacency matrix A (self-loops on the
+diagonal, no weights). They are exactly what PDF.get_graph_features_networkx computes node by node, in the same node
+order and down to the last bit:
+
+    degree        row length of A, self-loops counting twice as networkx does
+    cl_coef       T / (d (d - 1)), with d the degree without self-loops and T the ordered pairs of neighbours that
+                  are linked, the diagonal of B B B for B = A without its diagonal
+    avg_two_hops  A . degree / degree
+    avg_cl_coef   A . cl_coef / degree, summed in networkx's neighbour order
+    ego_size      d + T / 2 + A . loops, the edges among the node and its neighbours
+    ego_out       A . rowlen - rowsum(A A o A), neighbour links leaving the neighbour list
+    ego_nbrs      nnz(A A + A) - rowlen, the nodes those links reach
+
+The products are taken a block of rows at a time. Blocks are cut by how many entries their products can have, at most
+the sum of the row lengths of each row's neighbours, rather than by rows: a row next to a hub has as many as the hub
+has neighbours. A row over the cap on its own is a block of its own, of at most one entry per node.
+
+python -m process.netsimile <graph db> [limit] checks it against networkx over the stored graphs.
+"""
+
+import sys
+import time
+
+import numpy
+from scipy import sparse
+
+"""
+Entries the products of a block of rows may have, at about 12 bytes each
+"""
+BLOCK_ENTRIES = 1 << 21
+
+
+def adjacency(v, e):
+    """ The graph networkx.Graph would build from v and e, as a CSR matrix. Rows and each row's entries are in the
+    order networkx iterates nodes and neighbours, which is the order a plain dict gives them when they are inserted
+    the way Graph.add_node and Graph.add_edge do.
+
+    :param v: vertices (label, [attrib]), as from PDF.get_nodes_edges
+    :param e: edges (label, label)
+    :return: node labels in order, adjacency matrix
+    """
+    adj = {}
+    for label, attrs in v:
+        if label not in adj:
+            adj[label] = {}
+    for src, dst in e:
+        if src not in adj:
+            adj[src] = {}
+        if dst not in adj:
+            adj[dst] = {}
+        adj[src][dst] = True
+        adj[dst][src] = True
+
+    labels = list(adj)
+    index = dict((label, idx) for idx, label in enumerate(labels))
+    indptr = numpy.zeros(len(labels) + 1, dtype=numpy.int32)
+    indices = []
+    for idx, label in enumerate(labels):
+        indices.extend([index[nbr] for nbr in adj[label]])
+        indptr[idx + 1] = len(indices)
+    indices = numpy.array(indices, dtype=numpy.int32)
+    # Entries stay in insertion order, scipy only sorts them when asked to
+    matrix = sparse.csr_matrix((numpy.ones(len(indices)), indices, indptr), shape=(len(labels), len(labels)))
+    return labels, matrix
+
+
+def blocks(work, cap):
+    """ Cut rows into consecutive blocks of at most cap work, or of one row when that row alone is over it
+
+    :param work: entries the product of each row may have
+    :return: (first row, row past the last) of each block
+    """
+    ends = numpy.cumsum(work)
+    lo = 0
+    while lo < len(work):
+        base = ends[lo - 1] if lo else 0
+        hi = max(lo + 1, int(numpy.searchsorted(ends, base + cap, side="right")))
+        yield lo, hi
+        lo = hi
+
+
+def node_features(matrix):
+    """
+
+    :param matrix: from adjacency
+    :return: list of NUMFEATURES lists, one value per node, of the same types networkx gives
+    """
+    num = matrix.shape[0]
+    rowlen = numpy.diff(matrix.indptr).astype(numpy.int64)
+    loops = (matrix.diagonal() > 0).astype(numpy.int64)
+    degree = rowlen + loops
+    plain = matrix.tocoo()
+    keep = plain.row != plain.col
+    plain = sparse.csr_matrix((plain.data[keep], (plain.row[keep], plain.col[keep])), shape=matrix.shape)
+    dplain = rowlen - loops
+
+    pairs = numpy.zeros(num, dtype=numpy.int64)
+    inside = numpy.zeros(num, dtype=numpy.int64)
+    reach = numpy.zeros(num, dtype=numpy.int64)
+    work = matrix.dot(rowlen.astype(numpy.float64)).astype(numpy.int64) + rowlen
+    for lo, hi in blocks(work, BLOCK_ENTRIES):
+        rows, plain_rows = matrix[lo:hi], plain[lo:hi]
+        two = rows.dot(matrix)
+        inside[lo:hi] = numpy.asarray(two.multiply(rows).sum(axis=1)).ravel()
+        reach[lo:hi] = (two + rows).getnnz(axis=1)
+        pairs[lo:hi] = numpy.asarray(plain_rows.dot(plain).multiply(plain_rows).sum(axis=1)).ravel()
+
+    possible = (dplain * (dplain - 1)).astype(numpy.float64)
+    cl_coef = numpy.zeros(num)
+    linked = pairs != 0
+    cl_coef[linked] = pairs[linked] / possible[linked]
+
+    # Sums over the neighbours in CSR order, which is networkx's order, so the floating point sums come out the same
+    two_hops = matrix.dot(degree.astype(numpy.float64))
+    nbrs_cl_coef = matrix.dot(cl_coef)
+    avg_two_hops = numpy.zeros(num)
+    avg_cl_coef = numpy.zeros(num)
+    some = degree != 0
+    avg_two_hops[some] = two_hops[some] / degree[some]
+    avg_cl_coef[some] = nbrs_cl_coef[some] / degree[some]
+
+    ego_size = dplain + pairs // 2 + matrix.dot(loops.astype(numpy.float64)).astype(numpy.int64)
+    ego_out = matrix.dot(rowlen.astype(numpy.float64)).astype(numpy.int64) - inside
+    ego_nbrs = reach - rowlen
+
+    return [col.tolist() for col in [degree, cl_coef, avg_two_hops, avg_cl_coef, ego_size, ego_out, ego_nbrs]]
+
+
+def graph_features(v, e):
+    """ Drop-in for PDF.get_graph_features_networkx
+
+    :return: a vector of features per node feature, one value per node
+    """
+    labels, matrix = adjacency(v, e)
+    return node_features(matrix)
+
+
+def validate(pairs, reference, aggregate):
+    """ Compare graph_features to the networkx implementation
+
+    :param pairs: iterable of (name, vertices, edges)
+    :param reference: networkx implementation taking (vertices, edges)
+    :param aggregate: turns node features into the feature vector
+    :return: (graphs, mismatching names, seconds networkx took, seconds graph_features took)
+    """
+    graphs = 0
+    bad = []
+    slow = fast = 0.0
+    for name, v, e in pairs:
+        graphs += 1
+        start = time.time()
+        expected = reference(v, e)
+        slow += time.time() - start
+        start = time.time()
+        got = graph_features(v, e)
+        fast += time.time() - start
+        same = [[repr(x) for x in ftr] for ftr in expected] == [[repr(x) for x in ftr] for ftr in got]
+        if not same or numpy.array(aggregate(expected)).tostring() != numpy.array(aggregate(got)).tostring():
+            bad.append(name)
+    return graphs, bad, slow, fast
+
+
+def random_graphs(count, seed=0):
+    """ Small random graphs with the odd cases stored graphs rarely have: self-loops, repeated edges, isolated nodes
+    and edges to nodes that are not in the vertex list
+
+    :return: generator of (name, vertices, edges)
+    """
+    rng = numpy.random.RandomState(seed)
+    for idx in xrange(count):
+        num = int(rng.randint(1, 60))
+        v = [(str(node), []) for node in xrange(num)]
+        e = [(str(src), str(dst)) for src, dst in rng.randint(0, num + 3, size=(int(rng.randint(0, 4 * num)), 2))]
+        yield "random-%d" % idx, v, e
+
+
+if __name__ == "__main__":
+    from process.pdf import PDF
+    from storage.dbgw import PdfDb
+
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: python -m process.netsimile <graph db> [limit]\n")
+        sys.exit(1)
+    pdf_db = PdfDb(sys.argv[1])
+    if not pdf_db.init(pdf_db.table, pdf_db.cols):
+        sys.exit(1)
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else pdf_db.size()
+    pdf = PDF("")
+
+    def stored():
+        left = limit
+        for first, last in pdf_db.rowid_ranges(256):
+            if left <= 0:
+                return
+            rows = pdf_db.chunk(first, last)[:left]
+            left -= len(rows)
+            for name, v, e in rows:
+                yield name, v, e
+
+    ok = True
+    for label, pairs in [("stored", stored()), ("random", random_graphs(200))]:
+        graphs, bad, slow, fast = validate(pairs, pdf.get_graph_features_networkx, pdf.aggregate_ftr_matrix)
+        sys.stdout.write("%s: %d graphs, %d differ, networkx %.3fs, sparse %.3fs\n" % (
+            label, graphs, len(bad), slow, fast))
+        for name in bad[:20]:
+            sys.stdout.write("  %s\n" % name)
+        ok = ok and not bad
+    pdf_db.close()
+    sys.exit(0 if ok else 1)
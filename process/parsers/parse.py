@@ -11,19 +11,26 @@
 #  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
 #  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
 
+from functools import partial
 
-def get_pdfminer():
+
+def get_pdfminer(graph_only=False):
     import pdfminer
-    return pdfminer.parse_and_hash
+    return partial(pdfminer.parse_and_hash, graph_only=True) if graph_only else pdfminer.parse_and_hash
 
 
-def get_peepdf():
+def get_peepdf(graph_only=False):
     pass
 
 
 PARSER_FACTORY_FUNCS = {'pdfminer': get_pdfminer, 'peepdf': get_peepdf}
 
 
-def get_parser(type_):
+def get_parser(type_, graph_only=False):
+    """
+
+    :param graph_only: the parser builds only the graph of each PDF, see --graph-only
+    :return: function parsing a sample path into a process.pdf.PDF
+    """
     factory = PARSER_FACTORY_FUNCS.get(type_)
-    return factory()
+    return factory(graph_only)
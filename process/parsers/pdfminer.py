@@ -19,9 +19,9 @@ import gzip
 import numpy
 import os
 import re
-import pickle
 import signal
 import sys
+import time
 """
 It's tempting to use cElementTree, but don't. It is not compatible with multiprocessing because it cannot be pickled.
 from xml.etree.cElementTree import tostring, ElementTree
@@ -33,7 +33,9 @@ from lib.parse.pdfminer.pdfdocument import PDFDocument
 from lib.parse.pdfminer.pdfparser import PDFParser
 from lib.parse.pdfminer.psparser import PSKeyword, PSLiteral, PSEOF, PSException
 
+from process.graph import GraphBuilder
 from process.pdf import PDF
+from util.metrics import add_stage, stage
 from util.str_utils import getJavascript, isFlash
 
 
@@ -60,33 +62,14 @@ def sigint_handler(signal, frame):
     sys.exit(0)
 
 
-def pdf_error_xml(pdfpath, err):
-    tb = TreeBuilder()
-    tb.start("pdf", {"path": pdfpath, "type": "error"})
-    tb.data("%s" % err)
-    return tb.end("pdf")
-
-def check_pdf_retval(pdf):
-    """
-    Certain PDFs will be unpickleable, which means they cannot be sent back through the multiprocessing.Pool for
-    handling in the main function. If you try they will raise a MaybeEncodingError, and there is currently no
-    good way to recover from these exceptions and continue processing the rest of the samples. So, the check is done
-    here.
+def parse_and_hash(pdfpath, graph_only=False):
     """
-    try:
-        if len(pickle.dumps(pdf)) >= pow(2, 31) - 1:
-            pdf = PDF(pdf.path, pdf.name)
-            pdf.xml = pdf_error_xml(pdf.path, "Parsed PDF size overlows 32 bit int result capacity")
-    except Exception as e:
-        sys.stderr.write("PDF cannot be returned to main process for storage in database: %s: %s\n" % (pdf.name, e))
-        pdf = PDF(pdf.path, pdf.name)
-        pdf.xml = pdf_error_xml(pdf.path, str(e))
-    return pdf
-
 
-def parse_and_hash(pdfpath):
+    :param graph_only: build only the graph, no element tree, and write no XML file
+    :rtype: process.pdf.PDF
+    """
     signal.signal(signal.SIGINT, sigint_handler)
-    parser = PDFMinerParser()
+    parser = PDFMinerParser(graph_only)
     pdf = PDF(pdfpath, os.path.basename(pdfpath))
 
     try:
@@ -96,11 +79,13 @@ def parse_and_hash(pdfpath):
     except Exception as e:
         sys.stderr.write("PDFMiner uncaught error: %s: %s\n" % (pdf.name, e))
 
-    if pdf.parsed and pdf.xml != '':
+    if pdf.parsed and (pdf.xml != '' or pdf.v):
         try:
             pdf.set_feature_vector()
         except AttributeError as e:
             sys.stderr.write("Attribute Error: %s\n" % e)
+        if graph_only:
+            return pdf
         fout = os.path.join(OUTPUTDIR, "%s.xml.zip" % pdf.name)
         try:
             gzfp = gzip.open(fout, "wb", compresslevel=4)
@@ -108,21 +93,32 @@ def parse_and_hash(pdfpath):
             # logging.error("Parse and hash error opening xml output file: %s\n\t%s" % (fout, e))
             sys.stderr.write("Parse and hash error opening xml output file: %s\n\t%s\n" % (fout, e))
         else:
-            pdf.save_xml(gzfp)
-            gzfp.close()
+            with stage("xml_file"):
+                pdf.save_xml(gzfp)
+                gzfp.close()
 
-    return check_pdf_retval(pdf)
+    return pdf
 
 
 class PDFMinerParser(object):
 
-    def __init__(self):
-        self.treebuild = TreeBuilder()
+    def __init__(self, graph_only=False):
+        """
+
+        :param graph_only: parse into the vertices and edges of the PDF, with a process.graph.GraphBuilder, instead of
+                           an element tree
+        """
+        self.graph_only = graph_only
+        self.treebuild = GraphBuilder() if graph_only else TreeBuilder()
 
     @staticmethod
     def esc(s):
         return ESC_PAT.sub(lambda m: '&#%d;' % ord(m.group(0)), s)
 
+    def encode(self, s):
+        # Nothing reads the text of string and data elements off a graph
+        return '' if self.graph_only else self.esc(s).encode(ENC)
+
     def add_xml_node(self, tag, attrs, data):
         if not attrs:
             attrs = {}
@@ -166,7 +162,7 @@ class PDFMinerParser(object):
             self.treebuild.end("list")
 
         elif isinstance(obj, str):
-            self.add_xml_node("string", obj_attrs.update({"enc": ENC}), self.esc(obj).encode(ENC))
+            self.add_xml_node("string", obj_attrs.update({"enc": ENC}), self.encode(obj))
 
         elif isinstance(obj, pdftypes.PDFStream):
             self.treebuild.start("stream", obj_attrs)
@@ -191,7 +187,7 @@ class PDFMinerParser(object):
                 if js:
                     self.add_xml_node("js", {"enc": ENC, "size": str(len(js))}, js)
                 else:
-                    self.add_xml_node("data", {"enc": ENC, "size": str(len(data))}, self.esc(data).encode(ENC))
+                    self.add_xml_node("data", {"enc": ENC, "size": str(len(data))}, self.encode(data))
 
             self.treebuild.end("stream")
 
@@ -216,8 +212,10 @@ class PDFMinerParser(object):
             loc = xref.get_pos(objid)[1]
         except KeyError:
             loc = "FREE"
-        finally:
-            return loc
+        except Exception:
+            # Left UNKNOWN; only the build timeout, which is not an Exception, gets past here
+            pass
+        return loc
 
     def read_pdf_block(self, parser, pos, length=512):
         obj_data = "UNKNOWN"
@@ -225,8 +223,9 @@ class PDFMinerParser(object):
             obj_data = parser.read_n_from(pos, length)
         except TypeError:
             obj_data = "ERROR: Could not read PDF data from pos: %s for %s bytes" % (pos, length)
-        finally:
-            return obj_data
+        except Exception:
+            pass
+        return obj_data
 
     def end_xml_node(self, tag):
         try:
@@ -239,6 +238,7 @@ class PDFMinerParser(object):
                     self.end_xml_node(expected_tag)
 
     def parse(self, pdf):
+        start = time.time()
         try:
             fp = open(pdf.path, 'rb')
         except IOError as e:
@@ -257,59 +257,75 @@ class PDFMinerParser(object):
             self.treebuild.end("pdf")
             pdf.parsed = True
             return
+        finally:
+            add_stage("read", time.time() - start)
 
         if doc.found_eof and doc.eof_distance > 3:
             pdf.blob = parser.read_from_end(doc.eof_distance).encode("base64")
 
-        for xref in doc.xrefs:
-            for objid in xref.get_objids():
-
-                if objid in visited:
-                    continue
-
-                visited.add(objid)
-
-                obj_attrs = {"id": str(objid), "type": "normal"}
-                obj_data = ''
-                obj_xml = self.treebuild.start("object", obj_attrs)
-                obj_loc = self.get_obj_loc(xref, objid)
-                obj_xml.set("location", str(obj_loc))
-
-                try:
-                    self.dump(doc.getobj(objid))
-                except pdftypes.PDFObjectNotFound as e:
-                    obj_xml.set("type", "malformed")
-                    obj_data = self.read_pdf_block(parser, obj_loc, 4096).replace("<", "0x3C")
-                except TypeError:
-                    obj_xml.set("type", "unknown")
-                    obj_data = self.read_pdf_block(parser, obj_loc).replace("<", "0x3C")
-                except Exception as e:
-                    obj_xml.set("type", "exception")
-                    obj_data = self.read_pdf_block(parser, obj_loc).replace("<", "0x3C")
-                    self.add_xml_node("exception", {}, str(e))
-
-                try:
-                    obj_data.decode("ascii")
-                except UnicodeDecodeError:
-                    obj_data = obj_data.encode("base64")
-
-                self.treebuild.data(obj_data)
-
-                #self.end_xml_node("object")
-                try:
-                    self.treebuild.end("object")
-                except (AssertionError, TypeError):
-                    return
-
-            self.treebuild.start("trailer", {})
-            self.dump(xref.trailer)
-            self.treebuild.end("trailer")
+        start = time.time()
+        tokenize = 0.0
+        try:
+            for xref in doc.xrefs:
+                for objid in xref.get_objids():
+
+                    if objid in visited:
+                        continue
+
+                    visited.add(objid)
+
+                    obj_attrs = {"id": str(objid), "type": "normal"}
+                    obj_data = ''
+                    obj_xml = self.treebuild.start("object", obj_attrs)
+                    obj_loc = self.get_obj_loc(xref, objid)
+                    obj_xml.set("location", str(obj_loc))
+
+                    try:
+                        tokenizing = time.time()
+                        obj = doc.getobj(objid)
+                        tokenize += time.time() - tokenizing
+                        self.dump(obj)
+                    except pdftypes.PDFObjectNotFound as e:
+                        obj_xml.set("type", "malformed")
+                        obj_data = self.read_pdf_block(parser, obj_loc, 4096).replace("<", "0x3C")
+                    except TypeError:
+                        obj_xml.set("type", "unknown")
+                        obj_data = self.read_pdf_block(parser, obj_loc).replace("<", "0x3C")
+                    except Exception as e:
+                        obj_xml.set("type", "exception")
+                        obj_data = self.read_pdf_block(parser, obj_loc).replace("<", "0x3C")
+                        self.add_xml_node("exception", {}, str(e))
+
+                    try:
+                        obj_data.decode("ascii")
+                    except UnicodeDecodeError:
+                        obj_data = obj_data.encode("base64")
+
+                    self.treebuild.data(obj_data)
+
+                    #self.end_xml_node("object")
+                    try:
+                        self.treebuild.end("object")
+                    except (AssertionError, TypeError):
+                        return
+
+                self.treebuild.start("trailer", {})
+                self.dump(xref.trailer)
+                self.treebuild.end("trailer")
 
-        self.treebuild.end("pdf")
+            self.treebuild.end("pdf")
 
-        pdf.xml = self.treebuild.close()
+            if self.graph_only:
+                pdf.v, pdf.e = self.treebuild.close()
+                pdf.js = self.treebuild.get_javascript()
+            else:
+                pdf.xml = self.treebuild.close()
 
-        pdf.errors = doc.errors
-        pdf.bytes_read = parser.BYTES
-        pdf.parsed = True
-        fp.close()
+            pdf.errors = doc.errors
+            pdf.bytes_read = parser.BYTES
+            pdf.parsed = True
+            fp.close()
+        finally:
+            # Whatever was not spent reading objects went into the element tree, or the graph
+            add_stage("tokenize", tokenize)
+            add_stage("xml", time.time() - start - tokenize)
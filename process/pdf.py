@@ -21,6 +21,8 @@ import sys
 import traceback
 from xml.parsers.expat import ExpatError
 from xml.dom import minidom
+from process.netsimile import graph_features
+from util.metrics import stage
 from util.str_utils import prettify_dict, check_decoding
 
 """
@@ -38,6 +40,31 @@ Number of features used in the NetSimile paper
 """
 NUMFEATURES = 7
 
+"""
+Names of the node features and of the statistics aggregated over each one. Feature i of ftr_vec is aggregate
+i % len(AGGREGATES) of node feature i // len(AGGREGATES), e.g. FEATURE_NAMES[1] is "degree_mean".
+"""
+NODE_FEATURES = ["degree", "cl_coef", "avg_two_hops", "avg_cl_coef", "ego_size", "ego_out", "ego_nbrs"]
+AGGREGATES = ["median", "mean", "std", "skew", "kurtosis"]
+FEATURE_NAMES = ["%s_%s" % (node, agg) for node in NODE_FEATURES for agg in AGGREGATES]
+
+
+class GraphContext(object):
+    """
+    Degree, clustering coefficient and neighbours of every node of a networkx graph, computed once per graph, so the
+    node features read them from tables instead of recomputing them for each neighbour of each node
+    """
+    def __init__(self, graph):
+        """
+
+        :type graph: networkx.Graph
+        """
+        self.graph = graph
+        self.neighbors = dict((node, list(nbrs)) for node, nbrs in graph.adjacency_iter())
+        self.nbr_sets = dict((node, set(nbrs)) for node, nbrs in self.neighbors.items())
+        self.degree = graph.degree()
+        self.clustering = networkx.clustering(graph)
+
 
 class PDF(object):
     """
@@ -59,9 +86,11 @@ class PDF(object):
         self.ftr_vec = []
 
     def set_feature_vector(self):
-        verts, edges = self.get_nodes_edges()
-        ftr_matrix = self.get_graph_features(verts, edges)
-        self.ftr_vec = self.aggregate_ftr_matrix(ftr_matrix)
+        with stage("graph"):
+            verts, edges = self.get_nodes_edges()
+        with stage("features"):
+            ftr_matrix = self.get_graph_features(verts, edges)
+            self.ftr_vec = self.aggregate_ftr_matrix(ftr_matrix)
 
     def get_root(self):
         rootid = None
@@ -117,7 +146,20 @@ class PDF(object):
         return self.v, self.e
 
     def get_graph_features(self, v, e):
-        """ Graph features based on NetSimile paper
+        """ Graph features based on NetSimile paper, computed for all nodes at once with sparse matrices. Gives exactly
+        what get_graph_features_networkx gives.
+
+        :param v: set of vertices (label, [attrib])
+        :type v:  list
+        :param e: edges in the graph (vertex, vertex)
+        :type e: list
+        :return: a vector of features
+        :rtype: list
+        """
+        return graph_features(v, e)
+
+    def get_graph_features_networkx(self, v, e):
+        """ Graph features based on NetSimile paper, node by node with networkx. Reference for process.netsimile.
 
         :param v: set of vertices (label, [attrib])
         :type v:  list
@@ -136,18 +178,20 @@ class PDF(object):
         Transforms matrix from paper, so that each row is a feature, and each col is a node
         """
         features = [[] for i in range(NUMFEATURES)]
+        context = GraphContext(graph)
         for node in graph.nodes_iter():
-            for idx, ftr in enumerate(self.get_node_features(graph, node)):
+            for idx, ftr in enumerate(self.get_node_features(context, node)):
                 features[idx].append(ftr)
 
         return features
 
-    def get_node_features(self, graph, node):
+    def get_node_features(self, context, node):
         """  Node features based on NetSimile paper
-        :param node:
-        :type node:
-        :return:
-        :rtype:
+        :param context: tables of the graph the node is in
+        :type context: GraphContext
+        :param node: node label
+        :return: the NUMFEATURES features of the node
+        :rtype: list
         """
         """
         degree of node
@@ -158,17 +202,18 @@ class PDF(object):
         number of outgoing edges from ego(node)
         number of neighbors(ego(node))
         """
-        neighbors = graph.neighbors(node)
+        neighbors = context.neighbors[node]
+        nbr_set = context.nbr_sets[node]
 
-        degree = graph.degree(node)
+        degree = context.degree[node]
 
-        cl_coef = networkx.clustering(graph, node)
+        cl_coef = context.clustering[node]
 
         nbrs_two_hops = 0.0
         nbrs_cl_coef = 0.0
         for neighbor in neighbors:
-            nbrs_two_hops += graph.degree(neighbor)
-            nbrs_cl_coef += networkx.clustering(graph, neighbor)
+            nbrs_two_hops += context.degree[neighbor]
+            nbrs_cl_coef += context.clustering[neighbor]
 
         try:
             avg_two_hops = nbrs_two_hops / degree
@@ -177,17 +222,23 @@ class PDF(object):
             avg_two_hops = 0.0
             avg_cl_coef = 0.0
 
-        egonet = networkx.ego_graph(graph, node)
-
-        ego_size = egonet.size()
+        """
+        The egonet is the node and its neighbours. Its edges are counted from the neighbour tables instead of building
+        it with networkx.ego_graph, a self-loop counting twice in the degree sum as it does in Graph.size
+        """
+        egonet = nbr_set | set([node])
 
+        ego_degrees = 0
         ego_out = 0
         ego_nbrs = set()
         for ego_node in egonet:
-            for nbr in graph.neighbors(ego_node):
-                if nbr not in neighbors:
+            for nbr in context.neighbors[ego_node]:
+                if nbr in egonet:
+                    ego_degrees += 2 if nbr == ego_node else 1
+                if nbr not in nbr_set:
                     ego_out += 1
                     ego_nbrs.add(nbr)
+        ego_size = ego_degrees / 2
 
         return [degree, cl_coef, avg_two_hops, avg_cl_coef, ego_size, ego_out, len(ego_nbrs)]
 
@@ -275,5 +326,7 @@ class PDF(object):
             sys.stderr.write("PDF.save_xml: UNCAUGHT EXCEPTION: %s: %s\n" % (self.name, e))
             new_xml_str = str(e)
         finally:
-            fp.write(new_xml_str)
-            fp.flush()
+            # Still a Document when the try was cut short, by the build timeout for one
+            if isinstance(new_xml_str, basestring):
+                fp.write(new_xml_str)
+                fp.flush()
@@ -0,0 +1,199 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import heapq
+import logging
+from itertools import chain
+
+import numpy
+
+
+"""
+Rows of the family matrix scored per numpy operation. Bounds the temporaries to a few MB per worker.
+"""
+CHUNK_ROWS = 16384
+
+"""
+Cells (subjects x rows x features) scored per numpy operation when a block of subjects is scored together.
+"""
+BLOCK_CELLS = CHUNK_ROWS * 64
+
+
+def canberra_rows(u, matrix):
+    """ Canberra distance from u to every row of matrix
+
+    Matches scipy.spatial.distance.canberra, including dropping the 0/0 (nan) terms from the sum.
+
+    :param u: feature vector
+    :type u: numpy.ndarray
+    :param matrix: 2D array of feature vectors, one per row
+    :type matrix: numpy.ndarray
+    :return: distances, one per row
+    :rtype: numpy.ndarray
+    """
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        dist = numpy.abs(matrix - u) / (numpy.abs(matrix) + numpy.abs(u))
+    return numpy.nansum(dist, axis=1)
+
+
+def canberra_block(subjects, matrix):
+    """ Canberra distance from every subject to every row of matrix
+
+    :param subjects: 2D array of subject feature vectors, one per row
+    :type subjects: numpy.ndarray
+    :param matrix: 2D array of feature vectors, one per row
+    :type matrix: numpy.ndarray
+    :return: distances, one row per subject and one column per matrix row
+    :rtype: numpy.ndarray
+    """
+    u = subjects[:, numpy.newaxis, :]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        dist = numpy.abs(matrix - u) / (numpy.abs(matrix) + numpy.abs(u))
+    return numpy.nansum(dist, axis=2)
+
+
+class TopK(object):
+    """
+    Bounded max-heap of the k closest (distance, row) pairs seen so far.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def worst(self):
+        """
+
+        :return: distance a row has to beat to get in, inf until the heap is full
+        """
+        if len(self.heap) < self.k:
+            return numpy.inf
+        return -self.heap[0][0]
+
+    def push(self, dist, row):
+        item = (-dist, row)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, item)
+        elif item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+
+    def push_chunk(self, offset, dists, thresh=0):
+        """ Offer a chunk of distances, only its k smallest can make it into the heap
+
+        :param offset: row of dists[0]
+        :param dists: distances from FamilyMatrix.distances
+        :type dists: numpy.ndarray
+        :param thresh: ignore distances above this when set
+        """
+        if dists.size > self.k:
+            idx = numpy.argpartition(dists, self.k - 1)[:self.k]
+        else:
+            idx = numpy.arange(dists.size)
+        for i in idx:
+            dist = dists[i]
+            if dist < self.worst() and (not thresh or dist <= thresh):
+                self.push(float(dist), offset + int(i))
+
+    def items(self):
+        """
+
+        :return: (distance, row) pairs, closest first
+        """
+        return sorted((-neg_dist, row) for neg_dist, row in self.heap)
+
+    @staticmethod
+    def merge(k, results):
+        """ Merge the items() of several heaps, e.g. one per worker
+
+        :return: the k closest (distance, row) pairs overall
+        """
+        return heapq.nsmallest(k, chain(*results))
+
+
+class FamilyMatrix(object):
+    """
+    Feature vectors of every graph family (unique e_md5) held in one contiguous float64 matrix. Row i belongs to
+    families[i] and was taken from the pdf candidates[i].
+    """
+
+    def __init__(self, families=None, candidates=None, features=None):
+        self.families = families or []
+        self.candidates = candidates or []
+        if features is None:
+            features = numpy.empty((0, 0), dtype=numpy.float64)
+        self.features = features
+
+    def __len__(self):
+        return len(self.features)
+
+    @property
+    def width(self):
+        return self.features.shape[1]
+
+    @classmethod
+    def load(cls, pdf_db):
+        """ Read every family representative with a single query
+
+        Vectors that are empty or not the same length as the first good vector are skipped, they are the ones that
+        used to raise ValueError inside canberra.
+
+        :param pdf_db: graph database
+        :type pdf_db: storage.dbgw.PdfDb
+        :rtype: FamilyMatrix
+        """
+        families, candidates, rows = [], [], []
+        width = 0
+        for edge_md5, pdf_id, ftrs in pdf_db.load_families():
+            if not width and len(ftrs):
+                width = len(ftrs)
+            if not len(ftrs) or len(ftrs) != width:
+                logging.error("FamilyMatrix.load bad features for %s (%s)" % (pdf_id, edge_md5))
+                continue
+            families.append(edge_md5)
+            candidates.append(pdf_id)
+            rows.append(ftrs)
+        features = numpy.array(rows, dtype=numpy.float64).reshape((len(rows), width))
+        return cls(families, candidates, features)
+
+    def distances(self, ftrs, start=0, end=None, chunk=CHUNK_ROWS):
+        """ Canberra distances from ftrs to the rows in [start, end), a chunk at a time
+
+        :param ftrs: subject feature vector
+        :type ftrs: list
+        :return: generator of (row offset, distances)
+        """
+        if end is None:
+            end = len(self)
+        u = numpy.asarray(ftrs, dtype=numpy.float64)
+        if u.shape != (self.width,):
+            raise ValueError("Subject has %d features, families have %d" % (u.size, self.width))
+        for offset in xrange(start, end, chunk):
+            yield offset, canberra_rows(u, self.features[offset:min(offset + chunk, end)])
+
+    def block_distances(self, subjects, start=0, end=None, cells=BLOCK_CELLS):
+        """ Canberra distances from every subject to the rows in [start, end), a chunk of rows at a time
+
+        :param subjects: 2D array of subject feature vectors, one per row
+        :type subjects: numpy.ndarray
+        :return: generator of (row offset, subjects x rows distances)
+        """
+        if end is None:
+            end = len(self)
+        if subjects.ndim != 2 or subjects.shape[1] != self.width:
+            raise ValueError("Subjects have %s features, families have %d" % (subjects.shape[1:], self.width))
+        chunk = max(1, cells // max(1, subjects.size))
+        for offset in xrange(start, end, chunk):
+            yield offset, canberra_block(subjects, self.features[offset:min(offset + chunk, end)])
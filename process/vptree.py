@@ -0,0 +1,204 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import heapq
+
+import numpy
+
+from process.similarity import TopK, canberra_rows
+
+
+"""
+Rows per leaf. Leaves are scored with one vectorized call, so they can be fairly large.
+"""
+LEAF_SIZE = 64
+
+"""
+Slack on the triangle inequality bounds so rounding never prunes a row sitting exactly on the radius.
+"""
+EPSILON = 1e-9
+
+
+class VPTree(object):
+    """
+    Vantage point tree over the rows of a feature matrix. Canberra distance is a metric, so the triangle inequality
+    bounds every row under a node by its distance to the node's vantage point.
+
+    Nodes are kept in flat arrays so the tree can be saved with numpy.savez and loaded without unpickling. The tree
+    covers rows [0, size) of the matrix; rows appended after it was built are the tail, which every query scans.
+    """
+
+    arrays = ["vp", "in_hi", "out_lo", "out_hi", "inner", "outer", "lo", "hi", "order"]
+
+    def __init__(self, features, vp, in_hi, out_lo, out_hi, inner, outer, lo, hi, order):
+        self.features = features
+        self.vp = vp
+        self.in_hi = in_hi
+        self.out_lo = out_lo
+        self.out_hi = out_hi
+        self.inner = inner
+        self.outer = outer
+        self.lo = lo
+        self.hi = hi
+        self.order = order
+        self.size = len(order)
+        self.stats = {}
+
+    @property
+    def tail(self):
+        return len(self.features) - self.size
+
+    @property
+    def leaves(self):
+        return int((self.vp < 0).sum())
+
+    def depth(self):
+        depth, level = 0, [0] if len(self.vp) else []
+        while level:
+            depth += 1
+            level = [child for node in level if self.vp[node] >= 0 for child in (self.inner[node], self.outer[node])]
+        return depth
+
+    def pruned(self):
+        """
+
+        :return: fraction of the rows the last search did not have to compute a distance for
+        """
+        if not self.stats.get("rows"):
+            return 0.0
+        return max(0.0, 1.0 - float(self.stats["distances"]) / self.stats["rows"])
+
+    @classmethod
+    def build(cls, features, leaf_size=LEAF_SIZE, seed=0):
+        """
+
+        :param features: 2D array of feature vectors, usually FamilyMatrix.features
+        :type features: numpy.ndarray
+        :rtype: VPTree
+        """
+        rng = numpy.random.RandomState(seed)
+        order = numpy.arange(len(features), dtype=numpy.int64)
+        nodes = []
+        todo = []
+
+        def new_node(lo, hi):
+            nodes.append([-1, 0.0, 0.0, 0.0, -1, -1, lo, hi])
+            todo.append(len(nodes) - 1)
+            return len(nodes) - 1
+
+        if len(order):
+            new_node(0, len(order))
+        while todo:
+            node = todo.pop()
+            lo, hi = nodes[node][6], nodes[node][7]
+            if hi - lo <= leaf_size:
+                continue
+            rows = order[lo:hi]
+            vp = rows[rng.randint(hi - lo)]
+            dists = canberra_rows(features[vp], features[rows])
+            mu = numpy.median(dists)
+            inside = dists <= mu
+            num_in = int(inside.sum())
+            if num_in == hi - lo:
+                # Every row is the same distance away, nothing to split on
+                continue
+            order[lo:hi] = numpy.concatenate([rows[inside], rows[~inside]])
+            nodes[node][:4] = [vp, dists[inside].max(), dists[~inside].min(), dists[~inside].max()]
+            nodes[node][4] = new_node(lo, lo + num_in)
+            nodes[node][5] = new_node(lo + num_in, hi)
+
+        cols = zip(*nodes) if nodes else [[] for i in range(8)]
+        ints = [numpy.array(col, dtype=numpy.int64) for col in cols[4:]]
+        floats = [numpy.array(col, dtype=numpy.float64) for col in cols[1:4]]
+        return cls(features, numpy.array(cols[0], dtype=numpy.int64), *(floats + ints + [order]))
+
+    def save(self, path, **extra):
+        numpy.savez(path, **dict([(name, getattr(self, name)) for name in self.arrays] + extra.items()))
+
+    @classmethod
+    def load(cls, path, features):
+        """
+
+        :return: the tree and the rest of the arrays saved with it
+        """
+        npz = numpy.load(path)
+        try:
+            data = dict((name, npz[name]) for name in npz.files)
+        finally:
+            npz.close()
+        tree = cls(features, *[data.pop(name) for name in cls.arrays])
+        return tree, data
+
+    def search(self, ftrs, k=0, radius=0, checks=0):
+        """ Best-first search for the k nearest rows, or every row within radius, or both
+
+        :param ftrs: subject feature vector
+        :param k: number of nearest rows to keep
+        :param radius: only keep rows at or below this distance when set
+        :param checks: stop after visiting this many leaves, approximate but bounded. 0 searches exhaustively.
+        :return: (distance, row) pairs, closest first
+        """
+        q = numpy.asarray(ftrs, dtype=numpy.float64)
+        if q.shape != self.features.shape[1:]:
+            raise ValueError("Subject has %d features, families have %s" % (q.size, self.features.shape[1:]))
+        nearest = TopK(k) if k else None
+        hits = []
+        computed = leaves = 0
+
+        def offer(rows, dists):
+            if nearest is not None:
+                for i in numpy.flatnonzero(dists <= radius) if radius else xrange(dists.size):
+                    if dists[i] < nearest.worst():
+                        nearest.push(float(dists[i]), int(rows[i]))
+            else:
+                hits.extend((float(dists[i]), int(rows[i])) for i in numpy.flatnonzero(dists <= radius))
+
+        def reach():
+            limit = nearest.worst() if nearest is not None else numpy.inf
+            if radius:
+                limit = min(limit, radius)
+            return limit * (1 + EPSILON) + EPSILON
+
+        if self.tail:
+            rows = numpy.arange(self.size, len(self.features))
+            offer(rows, canberra_rows(q, self.features[self.size:]))
+            computed += rows.size
+
+        heap = [(0.0, 0)] if len(self.vp) else []
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if bound > reach():
+                break
+            vp = self.vp[node]
+            if vp < 0:
+                rows = self.order[self.lo[node]:self.hi[node]]
+                offer(rows, canberra_rows(q, self.features[rows]))
+                computed += rows.size
+                leaves += 1
+                if checks and leaves >= checks:
+                    break
+                continue
+            dist = canberra_rows(q, self.features[vp:vp + 1])[0]
+            computed += 1
+            inner = max(bound, dist - self.in_hi[node])
+            outer = max(bound, self.out_lo[node] - dist, dist - self.out_hi[node])
+            limit = reach()
+            if inner <= limit:
+                heapq.heappush(heap, (inner, self.inner[node]))
+            if outer <= limit:
+                heapq.heappush(heap, (outer, self.outer[node]))
+
+        self.stats = {"rows": len(self.features), "distances": computed, "leaves": leaves}
+        if nearest is not None:
+            return nearest.items()
+        return sorted(hits)
@@ -16,22 +16,89 @@ import json
 import logging
 import sqlite3
 import sys
+from collections import namedtuple
+from itertools import islice
+
+import numpy
+
+from process.graph import CompactGraph
+from process.pdf import FEATURE_NAMES
+from process.similarity import FamilyMatrix
+from ftrcache import FeatureCache
+from ftrindex import FeatureIndex
+
+"""
+Schema of the graph database, kept in sqlite's user_version. 0 is the original layout with pickled feature vectors,
+1 stores them as packed little-endian float64, 2 stores vertices and edges packed by process.graph.CompactGraph
+instead of pickled lists. storage/migrate.py brings older databases up to date.
+"""
+SCHEMA_VERSION = 2
+FEATURE_DTYPE = "<f8"
+
+"""
+One row of the pdfs table, serialized and hashed by PdfDb.make_row. Every field is a plain string, so it is cheap to
+send between processes. v_md5 and e_md5 are the MD5 of the vertex and edge lists, see CompactGraph.digests.
+"""
+PdfRow = namedtuple("PdfRow", ["name", "v_md5", "e_md5", "vertices", "edges", "js", "features"])
+
+
+"""
+Job statuses. Resume skips samples that are done, failed or timed out, -u/--update redoes them too.
+"""
+QUEUED, RUNNING, DONE, FAILED, TIMEOUT = "queued", "running", "done", "failed", "timeout"
+
+"""
+Samples queued per transaction by the resume check
+"""
+JOB_CHUNK = 500
+
+
+def chunks(iterable, size):
+    """
+
+    :return: generator of lists of up to size items
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def sql_feature(blob, key):
+    """ SQL function ftr(features, key), e.g. "select pdf_id from pdfs where ftr(features, 'degree_mean') > 10"
+
+    :param blob: packed feature vector
+    :param key: feature index, or one of process.pdf.FEATURE_NAMES
+    :return: the feature, or NULL if the vector does not have it
+    """
+    try:
+        idx = FEATURE_NAMES.index(key) if isinstance(key, basestring) else int(key)
+        ftrs = PdfDb.unpack_features(blob)
+        return float(ftrs[idx]) if 0 <= idx < len(ftrs) else None
+    except (TypeError, ValueError):
+        return None
 
-from util.str_utils import get_hash
 
 class NabuDb(object):
 
     table = "unknown"
     cols = []
+    # WAL lets readers carry on while a build writes, and with it synchronous=NORMAL only syncs at checkpoints
+    pragmas = ["journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY", "cache_size=-65536"]
 
     def __init__(self, dbpath):
         self.dbpath = dbpath
         self.conn = None
+        self.batched = False
 
     def init(self, table, cols):
         cmd = "create table if not exists %s(%s)" % (table, ','.join(cols))
         try:
             self.conn = sqlite3.connect(self.dbpath)
+            for pragma in self.pragmas:
+                self.conn.execute("pragma %s" % pragma)
             self.conn.execute(cmd)
         except sqlite3.Error as e:
             logging.error("NabuDb.init error (%s): %s\n%s" % (self.dbpath, e, cmd))
@@ -52,10 +119,24 @@ class NabuDb(object):
             return []
         else:
             rows = c.fetchall()
-            self.conn.commit()
+            if not self.batched:
+                self.conn.commit()
             c.close()
             return rows
 
+    def begin(self):
+        """ Hold back commits until commit(), so a batch of statements shares one transaction """
+        self.batched = True
+
+    def commit(self):
+        self.batched = False
+        try:
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error("NabuDb.commit error: %s" % e)
+            return False
+        return True
+
     def size(self):
         cmd = "select count(*) from %s" % self.table
         rows = self.query(cmd, ())
@@ -70,7 +151,11 @@ class NabuDb(object):
         return rows
 
     def close(self):
-        self.conn.close()
+        try:
+            self.conn.close()
+        except sqlite3.ProgrammingError as e:
+            # A generator owning the connection was closed from another thread, e.g. when a pool was terminated
+            logging.warning("NabuDb.close error: %s" % e)
 
     @staticmethod
     def serialize(data):
@@ -126,17 +211,108 @@ class NabuDb(object):
 class JobDb(NabuDb):
 
     table = "jobs"
-    cols = ["job_name text", "sample_path text"]
+    cols = ["job_name text", "sample_path text", "status text not null default '%s'" % QUEUED, "error text",
+            "duration real", "primary key (job_name, sample_path)"]
+
+    def init(self, table, cols):
+        if not super(JobDb, self).init(table, cols):
+            return False
+        try:
+            if "status" not in [col[1] for col in self.conn.execute("pragma table_info(%s)" % table)]:
+                self.upgrade(table, cols)
+            self.conn.execute("create index if not exists %s_status on %s(job_name, status)" % (table, table))
+        except sqlite3.Error as e:
+            logging.error("JobDb.init error (%s): %s" % (self.dbpath, e))
+            return False
+        return True
+
+    def upgrade(self, table, cols):
+        """ The original jobs table only listed completed samples, without a key. Rebuild it with statuses. """
+        logging.info("JobDb.upgrade adding job statuses to %s" % self.dbpath)
+        isolation_level = self.conn.isolation_level
+        # Python 2's sqlite3 commits before every DDL statement, so the transaction has to be managed by hand
+        self.conn.isolation_level = None
+        try:
+            self.conn.execute("begin immediate")
+            try:
+                self.conn.execute("alter table %s rename to %s_old" % (table, table))
+                self.conn.execute("create table %s(%s)" % (table, ','.join(cols)))
+                self.conn.execute("insert or ignore into %s(job_name, sample_path, status) "
+                                  "select job_name, sample_path, '%s' from %s_old" % (table, DONE, table))
+                self.conn.execute("drop table %s_old" % table)
+            except sqlite3.Error:
+                self.conn.execute("rollback")
+                raise
+            self.conn.execute("commit")
+        finally:
+            self.conn.isolation_level = isolation_level
 
     def get_completed(self, job_name):
-        cmd = "select sample_path from %s where job_name=?" % self.table
-        rows = set([row[0] for row in self.query(cmd, (job_name,))])
+        cmd = "select sample_path from %s where job_name=? and status=?" % self.table
+        rows = set([row[0] for row in self.query(cmd, (job_name, DONE))])
         return rows
 
-    def mark_complete(self, job_name, sample):
-        cmd = "insert into %s values(?, ?)" % self.table
-        rv = self.query(cmd, (job_name, sample))
-        return rv
+    def unfinished(self, job_name, samples, chunk=JOB_CHUNK):
+        """ Streaming resume check. Each sample is queued with an insert that is ignored when the primary key is taken,
+        which it is when the sample is finished or came up earlier in the same run. Neither the job file nor the
+        finished samples are ever held in memory. Call reset first, so samples an earlier build queued but never
+        finished count as new.
+
+        :param samples: iterable of sample paths, read as needed
+        :return: generator of the samples to do
+        """
+        cmd = "insert or ignore into %s(job_name, sample_path) values(?, ?)" % self.table
+        for paths in chunks(samples, chunk):
+            try:
+                with self.conn:
+                    todo = [path for path in paths if self.conn.execute(cmd, (job_name, path)).rowcount]
+            except sqlite3.Error as e:
+                logging.error("JobDb.unfinished error: %s" % e)
+                todo = paths
+            for path in todo:
+                yield path
+
+    def reset(self, job_name, everything=False):
+        """ Forget the samples of a job that are queued, or were left running by a build that died
+
+        :param everything: forget the finished samples too, so they are all redone
+        :return: number of samples forgotten
+        """
+        cmd = "delete from %s where job_name=?" % self.table
+        if not everything:
+            cmd += " and status in ('%s', '%s')" % (QUEUED, RUNNING)
+        try:
+            with self.conn:
+                return self.conn.execute(cmd, (job_name,)).rowcount
+        except sqlite3.Error as e:
+            logging.error("JobDb.reset error: %s" % e)
+            return 0
+
+    def counts(self, job_name):
+        """
+
+        :return: dict of status to number of samples
+        """
+        cmd = "select status, count(*) from %s where job_name=? group by status" % self.table
+        return dict(self.query(cmd, (job_name,)))
+
+    def mark_complete(self, job_name, sample, duration=None):
+        return self.mark_many(job_name, [(sample, DONE, None, duration)])
+
+    def mark_many(self, job_name, statuses):
+        """
+
+        :param statuses: (sample path, status, error text, duration in seconds) tuples
+        :return: success
+        """
+        cmd = "insert or replace into %s(job_name, sample_path, status, error, duration) values(?, ?, ?, ?, ?)" % (
+            self.table)
+        try:
+            self.conn.executemany(cmd, [(job_name,) + tuple(status) for status in statuses])
+        except sqlite3.Error as e:
+            logging.error("JobDb.mark_many error: %s" % e)
+            return False
+        return self.batched or self.commit()
 
 
 class XmlDb(NabuDb):
@@ -162,6 +338,96 @@ class PdfDb(NabuDb):
 
     table = "pdfs"
     cols = ["pdf_id primary key", "v_md5", "e_md5", "vertices", "edges", "js", "features"]
+    # MD5 of each stored sample file's contents, so byte-identical samples are only parsed once
+    content_table = "content"
+    content_cols = ["md5 primary key", "pdf_id"]
+
+    def __init__(self, dbpath):
+        super(PdfDb, self).__init__(dbpath)
+        self.ftr_cache = FeatureCache(dbpath, self.db_state)
+        self.ftr_index = FeatureIndex(dbpath)
+        self.cache_synced = False
+        self.pending = []
+
+    def init(self, table, cols):
+        if not super(PdfDb, self).init(table, cols):
+            return False
+        try:
+            self.conn.execute("create table if not exists %s(%s)" % (self.content_table, ','.join(self.content_cols)))
+            self.conn.execute("create index if not exists %s_pdf_id on %s(pdf_id)" % ((self.content_table,) * 2))
+        except sqlite3.Error as e:
+            logging.error("PdfDb.init error (%s): %s" % (self.dbpath, e))
+            return False
+        self.conn.create_function("ftr", 2, sql_feature)
+        if not self.schema_version() and self.size() == 0:
+            self.set_schema_version(SCHEMA_VERSION)
+        return True
+
+    def db_state(self):
+        """
+
+        :return: row count and last rowid of the pdfs table. insert or replace always takes a new rowid, so any save
+                 changes it. Statements that update rows in place must invalidate the feature cache themselves.
+        """
+        rows = self.query("select count(*), max(rowid) from %s" % self.table, ())
+        return list(rows[0]) if rows else None
+
+    def schema_version(self):
+        return self.conn.execute("pragma user_version").fetchone()[0]
+
+    def set_schema_version(self, version):
+        self.conn.execute("pragma user_version = %d" % version)
+        self.conn.commit()
+
+    def outdated(self):
+        return self.schema_version() < SCHEMA_VERSION
+
+    @staticmethod
+    def pack_features(ftrs):
+        return buffer(numpy.asarray(ftrs, dtype=FEATURE_DTYPE).tostring())
+
+    @staticmethod
+    def unpack_features(blob):
+        """
+
+        :return: feature vector, a read-only view of the blob
+        :rtype: numpy.ndarray
+        """
+        return numpy.frombuffer(blob or "", dtype=FEATURE_DTYPE)
+
+    @staticmethod
+    def pack_graph(v, e):
+        """
+
+        :param v: vertices (label, [tag, ...])
+        :param e: edges (label, label)
+        :return: MD5 of the vertices and of the edges, packed vertices and edges
+        """
+        graph = CompactGraph.from_lists(v, e)
+        v_md5, e_md5 = graph.digests()
+        return v_md5, e_md5, graph.pack_vertices(), graph.pack_edges()
+
+    @staticmethod
+    def unpack_graph(v_blob, e_blob):
+        """
+
+        :return: the graph, or None if the blobs cannot be unpacked
+        :rtype: process.graph.CompactGraph
+        """
+        try:
+            return CompactGraph.unpack(v_blob, e_blob)
+        except Exception as e:
+            logging.error("PdfDb.unpack_graph error: %s" % e)
+            return None
+
+    @classmethod
+    def unpack_lists(cls, v_blob, e_blob):
+        """
+
+        :return: vertex and edge lists, as PDF.get_nodes_edges gives them, empty if the blobs cannot be unpacked
+        """
+        graph = cls.unpack_graph(v_blob, e_blob)
+        return graph.to_lists() if graph is not None else ([], [])
 
     def save(self, pdf):
         """
@@ -170,44 +436,192 @@ class PdfDb(NabuDb):
         :type pdf: process.pdf.PDF
         :return: boolean value for success
         """
+        return self.save_row(self.make_row(pdf))
+
+    @classmethod
+    def make_row(cls, pdf):
+        """ Serialize and hash a parsed pdf into its row of the pdfs table. Build workers do this, so the storage
+        writer only has to insert.
+
+        :type pdf: process.pdf.PDF
+        :rtype: PdfRow
+        """
+        v_md5, e_md5, v, e = cls.pack_graph(pdf.v, pdf.e)
+        ftrs = numpy.asarray(pdf.ftr_vec, dtype=FEATURE_DTYPE).tostring()
+        js = cls.serializeJSON(pdf.get_javascript())
+        return PdfRow(pdf.name, v_md5, e_md5, v, e, js, ftrs)
+
+    def save_row(self, row, content_md5=None):
+        """
+
+        :type row: PdfRow
+        :param content_md5: MD5 of the sample file, recorded for lookup_content
+        :return: boolean value for success
+        """
         cmd = "insert or replace into %s values(?, ?, ?, ?, ?, ?, ?)" % self.table
-        v = self.serialize(pdf.v)
-        v_md5 = get_hash(v)
-        e = self.serialize(pdf.e)
-        e_md5 = get_hash(e)
-        ftrs = self.serialize(pdf.ftr_vec)
-        js = self.serializeJSON(pdf.get_javascript())
-        rv = self.query(cmd, (pdf.name, v_md5, e_md5, v, e, js, ftrs))
+        name, v_md5, e_md5, v, e, js, ftrs = row
+        cached = not self.batched and self.ftr_cache.fresh()
+        rv = self.query(cmd, (name, v_md5, e_md5, buffer(v), buffer(e), js, buffer(ftrs)))
+        if content_md5:
+            self.save_content(content_md5, name)
+        self.cache_saved(cached, e_md5, name, ftrs)
         return rv
 
+    def save_content(self, content_md5, pdf_id):
+        # The pdf_id may have held another file before, whose content it no longer stands for
+        self.query("delete from %s where pdf_id=? and md5!=?" % self.content_table, (pdf_id, content_md5))
+        self.query("insert or replace into %s values(?, ?)" % self.content_table, (content_md5, pdf_id))
+
+    def lookup_content(self, content_md5):
+        """
+
+        :return: pdf_id of the stored sample with this content, or None
+        """
+        rows = self.query("select pdf_id from %s where md5=?" % self.content_table, (content_md5,))
+        return rows[0][0] if rows else None
+
+    def copy_row(self, content_md5, name):
+        """ Save the row of a stored sample again under another name, for a byte-identical sample
+
+        :return: success, False if no sample with this content is stored (yet)
+        """
+        cmd = "select p.pdf_id, p.e_md5, p.features from %s c join %s p on p.pdf_id = c.pdf_id where c.md5=?" % (
+            self.content_table, self.table)
+        rows = self.query(cmd, (content_md5,))
+        if not rows:
+            return False
+        source, e_md5, ftrs = rows[0]
+        if source != name:
+            cached = not self.batched and self.ftr_cache.fresh()
+            cmd = "insert or replace into %s select ?, v_md5, e_md5, vertices, edges, js, features from %s " \
+                  "where pdf_id=?" % (self.table, self.table)
+            self.query(cmd, (name, source))
+            self.query("delete from %s where pdf_id=?" % self.content_table, (name,))
+            self.cache_saved(cached, e_md5, name, ftrs)
+        return True
+
+    def cache_saved(self, cached, e_md5, name, ftrs):
+        """ Bring the feature cache up to date with a row that was just saved
+
+        :param cached: whether the cache was fresh before the save
+        """
+        if self.batched:
+            self.pending.append((e_md5, name, self.unpack_features(ftrs)))
+        elif cached and self.ftr_cache.append(e_md5, name, self.unpack_features(ftrs)):
+            self.ftr_index.insert(self.ftr_cache)
+
+    def begin(self):
+        """ Saves until commit() share one transaction, and reach the feature cache once it is committed """
+        super(PdfDb, self).begin()
+        self.cache_synced = self.ftr_cache.fresh()
+        self.pending = []
+
+    def commit(self):
+        rv = super(PdfDb, self).commit()
+        pending, self.pending = self.pending, []
+        if rv and self.cache_synced and self.ftr_cache.extend(pending):
+            self.ftr_index.insert(self.ftr_cache)
+        return rv
+
+    def update_features(self, rows):
+        """ Replace the feature vectors of stored pdfs in place, in one transaction. Updates keep the rowid, so the
+        feature cache cannot see them, and is invalidated.
+
+        :param rows: (packed features, pdf_id)
+        :return: success
+        """
+        try:
+            with self.conn:
+                self.conn.executemany("update %s set features=? where pdf_id=?" % self.table,
+                                      [(buffer(ftrs), name) for ftrs, name in rows])
+        except sqlite3.Error as e:
+            logging.error("PdfDb.update_features error: %s" % e)
+            return False
+        finally:
+            self.ftr_cache.invalidate()
+        return True
+
     def load_family_features(self, edge_md5):
         cmd = "select pdf_id, features from %s where e_md5=? limit 1" % self.table
         rows = self.query(cmd, (edge_md5,))
         if rows:
-            pdf_id, f_json = rows[0]
-            f_list = self.deserialize(f_json)
+            pdf_id, f_blob = rows[0]
+            f_list = self.unpack_features(f_blob).tolist()
         else:
             pdf_id, f_list = '', ''
         return pdf_id, f_list
 
+    def load_families(self):
+        """
+
+        :return: (e_md5, pdf_id, features) for one pdf of every unique graph, read with a single query
+        """
+        cmd = "select e_md5, pdf_id, features from %s group by e_md5" % self.table
+        return [(e_md5, pdf_id, self.unpack_features(ftrs)) for e_md5, pdf_id, ftrs in self.query(cmd, ())]
+
+    def load_family_matrix(self):
+        """
+
+        :return: every family feature vector, mapped from the feature cache which is rebuilt first if it is stale
+        :rtype: process.similarity.FamilyMatrix
+        """
+        if self.ftr_cache.fresh() or self.ftr_cache.rebuild(self):
+            return self.ftr_cache.load()
+        return FamilyMatrix.load(self)
+
+    def load_family_index(self):
+        """
+
+        :return: the family matrix and the VP-tree over it, which is built or rebuilt first as needed
+        :rtype: (process.similarity.FamilyMatrix, process.vptree.VPTree)
+        """
+        families = self.load_family_matrix()
+        return families, self.ftr_index.get(families, self.family_generation())
+
+    def family_generation(self):
+        """
+
+        :return: generation of the feature cache the family matrix is mapped from, None if it is read from the pdfs
+        """
+        return self.ftr_cache.generation() if self.ftr_cache.fresh() else None
+
     def load_pdf_graph(self, pdf):
         cmd = "select pdf_id, v_md5, e_md5, vertices, edges, features from %s where pdf_id=?" % self.table
         rows = self.query(cmd, (pdf,))
         if rows:
-            graph_md5, v_md5, e_md5, v_json, e_json, f_json = rows[0]
-            v_set = self.deserialize(v_json)
-            e_set = self.deserialize(e_json)
-            f_list = self.deserialize(f_json)
+            graph_md5, v_md5, e_md5, v_json, e_json, f_blob = rows[0]
+            v_set, e_set = self.unpack_lists(v_json, e_json)
+            f_list = self.unpack_features(f_blob).tolist()
             return graph_md5, v_md5, e_md5, v_set, e_set, f_list
         else:
             logging.debug("PDF not found: %s" % pdf)
             return ['' for i in range(6)]
 
-    def chunk(self, limit, offset):
-        cmd = "select pdf_id, vertices, edges from %s limit %d offset %d" % (self.table, limit, offset)
-        rows = self.query(cmd, ())
+    def rowid_ranges(self, size):
+        """ Cut the table into chunks of consecutive rows, each found by a seek on rowid rather than by counting past
+        the rows before it
+
+        :return: generator of the first and last rowid of each chunk of up to size rows
+        """
+        cmd = "select min(rowid), max(rowid) from (select rowid from %s where rowid > ? order by rowid limit %d)" % (
+            self.table, size)
+        last = 0
+        while True:
+            rows = self.query(cmd, (last,))
+            if not rows or rows[0][0] is None:
+                return
+            yield rows[0]
+            last = rows[0][1]
+
+    def chunk(self, first, last):
+        """
+
+        :return: [pdf_id, vertices, edges] of the rows from rowid first to last, in rowid order
+        """
+        cmd = "select pdf_id, vertices, edges from %s where rowid between ? and ? order by rowid" % self.table
+        rows = self.query(cmd, (first, last))
         for idx, (pdf, v, e) in enumerate(rows):
-            rows[idx] = [pdf, self.deserialize(v), self.deserialize(e)]
+            rows[idx] = [pdf] + list(self.unpack_lists(v, e))
         return rows
 
 if __name__ == "__main__":
@@ -0,0 +1,211 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import json
+import logging
+import os
+
+import numpy
+
+from process.similarity import FamilyMatrix
+
+
+class FeatureCache(object):
+    """
+    Family feature matrix cached next to the graph database so scoring does not have to unpickle the pdfs table.
+
+    <graphdb>.ftrs.f8      raw float64 rows, one per family, mapped read-only with numpy.memmap
+    <graphdb>.ftrs.idx     e_md5<TAB>pdf_id, one line per row
+    <graphdb>.ftrs.stamp   row count, width and the state of the database when the cache was synced
+
+    The cache is only trusted while the database still matches the stamp. PdfDb.save appends to a fresh cache and
+    re-stamps it; any other change to the database makes the next reader rebuild it. The state comes from PdfDb, which
+    knows what a change looks like in the pdfs table; without it, the stat of the sqlite file is used. The file alone
+    is not enough in WAL mode, where commits land in the -wal file and sqlite deletes that file on the last close.
+
+    Every rebuild gets a new generation. Appends keep it, so anything keyed on row numbers (e.g. the VP-tree index)
+    stays valid for as long as the generation does.
+    """
+
+    dtype = numpy.float64
+
+    def __init__(self, dbpath, db_state=None):
+        self.dbpath = dbpath
+        self.db_state = db_state or self.db_stat
+        self.path = dbpath + ".ftrs.f8"
+        self.idx_path = dbpath + ".ftrs.idx"
+        self.stamp_path = dbpath + ".ftrs.stamp"
+        self.stamp = None
+        self.families = None
+        self.candidates = None
+
+    def db_stat(self):
+        rv = []
+        for path in [self.dbpath, self.dbpath + "-wal"]:
+            try:
+                st = os.stat(path)
+            except OSError:
+                rv.append(None)
+            else:
+                rv.append([st.st_size, st.st_mtime])
+        return rv
+
+    def read_stamp(self):
+        try:
+            with open(self.stamp_path, "r") as fp:
+                self.stamp = json.load(fp)
+        except (IOError, ValueError):
+            self.stamp = None
+        return self.stamp
+
+    def generation(self):
+        return self.stamp.get("generation") if self.stamp else None
+
+    def write_stamp(self, rows, width, generation=None):
+        self.stamp = {"rows": rows, "width": width, "idx": os.path.getsize(self.idx_path), "db": self.db_state(),
+                      "generation": generation or self.generation()}
+        tmp = self.stamp_path + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump(self.stamp, fp)
+        os.rename(tmp, self.stamp_path)
+
+    def invalidate(self):
+        self.stamp = self.families = self.candidates = None
+        try:
+            os.remove(self.stamp_path)
+        except OSError:
+            pass
+
+    def fresh(self):
+        db_state = self.db_state()
+        if self.stamp is None or self.stamp.get("db") != db_state:
+            # Another process may have synced the cache since we last looked
+            self.families = self.candidates = None
+            self.read_stamp()
+        return db_state is not None and self.stamp is not None and self.stamp.get("db") == db_state and self.synced()
+
+    def synced(self):
+        """ Whether the files still hold what the stamp says. An append that died before re-stamping leaves them
+        longer, a truncated file shorter.
+        """
+        try:
+            return os.path.getsize(self.path) == self.stamp["rows"] * self.stamp["width"] * \
+                numpy.dtype(self.dtype).itemsize and os.path.getsize(self.idx_path) == self.stamp["idx"]
+        except OSError:
+            return False
+
+    def rebuild(self, pdf_db):
+        """ Rewrite the cache from the pdfs table
+
+        :param pdf_db: graph database the cache belongs to
+        :type pdf_db: storage.dbgw.PdfDb
+        :return: success
+        """
+        families = FamilyMatrix.load(pdf_db)
+        try:
+            families.features.astype(self.dtype).tofile(self.path + ".tmp")
+            with open(self.idx_path + ".tmp", "w") as fp:
+                for row in zip(families.families, families.candidates):
+                    fp.write("%s\t%s\n" % row)
+            os.rename(self.path + ".tmp", self.path)
+            os.rename(self.idx_path + ".tmp", self.idx_path)
+            self.write_stamp(len(families), families.width, os.urandom(8).encode("hex"))
+        except (IOError, OSError) as e:
+            logging.error("FeatureCache.rebuild could not write %s: %s" % (self.path, e))
+            self.invalidate()
+            return False
+        self.families = set(families.families)
+        self.candidates = dict(zip(families.candidates, families.families))
+        return True
+
+    def read_index(self, rows):
+        families, candidates = [], []
+        with open(self.idx_path, "r") as fp:
+            for idx, line in enumerate(fp):
+                if idx >= rows:
+                    break
+                edge_md5, _, pdf_id = line.rstrip("\n").partition("\t")
+                families.append(edge_md5)
+                candidates.append(pdf_id)
+        return families, candidates
+
+    def load(self):
+        """ Map the cached matrix read-only. Pages are shared with every other process mapping the same file.
+
+        :rtype: process.similarity.FamilyMatrix
+        """
+        families, candidates = self.read_index(self.stamp["rows"])
+        return FamilyMatrix(families, candidates, self.map_features(self.stamp["rows"]))
+
+    def map_features(self, rows):
+        """ Map the first rows of the cached matrix, which must not be more than the stamp has """
+        width = self.stamp["width"]
+        if not rows:
+            return numpy.empty((0, width), dtype=self.dtype)
+        return numpy.memmap(self.path, dtype=self.dtype, mode="r", shape=(rows, width))
+
+    def append(self, edge_md5, pdf_id, ftrs):
+        """ Add a newly saved pdf to a cache that was fresh before the save, then re-stamp it
+
+        :return: success, the cache is invalidated otherwise
+        """
+        return self.extend([(edge_md5, pdf_id, ftrs)])
+
+    def extend(self, saved):
+        """ Add a batch of newly saved pdfs to a cache that was fresh before they were saved, then re-stamp it once
+
+        :param saved: (e_md5, pdf_id, features) of each pdf, in the order they were saved
+        :return: success, the cache is invalidated otherwise
+        """
+        rows, width = self.stamp["rows"], self.stamp["width"]
+        if not self.synced():
+            self.invalidate()
+            return False
+
+        if self.families is None:
+            families, candidates = self.read_index(rows)
+            self.families = set(families)
+            self.candidates = dict(zip(candidates, families))
+
+        new_ftrs, new_idx = [], []
+        for edge_md5, pdf_id, ftrs in saved:
+            if self.candidates.get(pdf_id, edge_md5) != edge_md5:
+                # A family representative was replaced with a different graph
+                self.invalidate()
+                return False
+            if edge_md5 in self.families:
+                continue
+            if not width and len(ftrs):
+                width = len(ftrs)
+            if not len(ftrs) or len(ftrs) != width:
+                logging.error("FeatureCache.extend bad features for %s (%s)" % (pdf_id, edge_md5))
+                continue
+            new_ftrs.append(ftrs)
+            new_idx.append("%s\t%s\n" % (edge_md5, pdf_id))
+            self.families.add(edge_md5)
+            self.candidates[pdf_id] = edge_md5
+
+        if new_ftrs:
+            try:
+                with open(self.path, "ab") as fp:
+                    numpy.asarray(new_ftrs, dtype=self.dtype).tofile(fp)
+                with open(self.idx_path, "a") as fp:
+                    fp.write("".join(new_idx))
+            except IOError as e:
+                logging.error("FeatureCache.extend could not write %s: %s" % (self.path, e))
+                self.invalidate()
+                return False
+            rows += len(new_ftrs)
+
+        self.write_stamp(rows, width)
+        return True
@@ -0,0 +1,111 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import logging
+import os
+
+import numpy
+
+from process.vptree import VPTree
+
+
+"""
+Rebuild once the unindexed tail is this big, as a fraction of the indexed rows (or MIN_TAIL rows, if larger).
+"""
+TAIL_FRACTION = 0.1
+MIN_TAIL = 4096
+
+
+class FeatureIndex(object):
+    """
+    VP-tree over the rows of the feature cache, saved as <graphdb>.vptree.npz. The tree is only valid for the cache
+    generation it was built from.
+
+    New families are inserted by PdfDb.save appending them to the cache, where they become the tree's tail. Queries
+    scan the tail exhaustively, and the tree is rebuilt once the tail outgrows TAIL_FRACTION of it.
+    """
+
+    def __init__(self, dbpath):
+        self.path = dbpath + ".vptree.npz"
+        self.tree = None
+        self.generation = None
+        self.size = None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    @staticmethod
+    def overgrown(size, rows):
+        return rows - size > max(MIN_TAIL, TAIL_FRACTION * size)
+
+    def saved_size(self, generation):
+        """
+
+        :return: rows covered by the saved tree, or None if it is missing or from another generation
+        """
+        try:
+            npz = numpy.load(self.path)
+            try:
+                saved, size = str(npz["generation"]), int(npz["size"])
+            finally:
+                npz.close()
+        except (IOError, OSError, KeyError, ValueError) as e:
+            logging.debug("FeatureIndex.saved_size %s: %s" % (self.path, e))
+            return None
+        return size if generation and saved == generation else None
+
+    def rebuild(self, families, generation):
+        tree = VPTree.build(families.features)
+        if generation:
+            try:
+                tree.save(self.path, generation=generation, size=tree.size)
+            except (IOError, OSError) as e:
+                logging.error("FeatureIndex.rebuild could not write %s: %s" % (self.path, e))
+        self.tree, self.generation, self.size = tree, generation, tree.size
+        return tree
+
+    def get(self, families, generation):
+        """ Tree for this generation of the cache, rebuilt first if it is missing, stale or overgrown
+
+        :param families: matrix the tree is built over, usually mapped from the feature cache
+        :type families: process.similarity.FamilyMatrix
+        :param generation: feature cache generation, None for a matrix that is not cached
+        :rtype: process.vptree.VPTree
+        """
+        if generation is None:
+            return self.rebuild(families, generation)
+        if self.generation != generation or self.tree is None:
+            self.tree = None
+            self.generation = generation
+            self.size = self.saved_size(generation)
+            if self.size is not None and self.size <= len(families):
+                self.tree = VPTree.load(self.path, families.features)[0]
+        if self.tree is None or self.overgrown(self.tree.size, len(families)):
+            return self.rebuild(families, generation)
+        self.tree.features = families.features
+        return self.tree
+
+    def insert(self, ftr_cache):
+        """ Called after PdfDb.save appended to the feature cache. Only maintains an index that already exists.
+
+        :type ftr_cache: storage.ftrcache.FeatureCache
+        """
+        if not ftr_cache.stamp or not self.exists():
+            return
+        generation = ftr_cache.generation()
+        if self.generation != generation:
+            self.tree = None
+            self.generation = generation
+            self.size = self.saved_size(generation)
+        if self.size is not None and self.overgrown(self.size, ftr_cache.stamp["rows"]):
+            self.rebuild(ftr_cache.load(), generation)
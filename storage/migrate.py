@@ -0,0 +1,105 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import cPickle
+import logging
+import sys
+import time
+
+"""
+Rows rewritten per statement batch while migrating
+"""
+BATCH_ROWS = 1024
+
+
+def features_to_blob(pdf_db, conn):
+    """ Schema 1: features go from a cPickle'd list to packed float64 """
+    last = 0
+    cmd = "select rowid, features from %s where rowid > ? order by rowid limit %d" % (pdf_db.table, BATCH_ROWS)
+    while True:
+        rows = conn.execute(cmd, (last,)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for rowid, pickled in rows:
+            try:
+                ftrs = cPickle.loads(str(pickled)) if pickled else []
+            except Exception as e:
+                logging.error("migrate.features_to_blob bad features in row %d: %s" % (rowid, e))
+                ftrs = []
+            updates.append((pdf_db.pack_features(ftrs), rowid))
+        conn.executemany("update %s set features=? where rowid=?" % pdf_db.table, updates)
+        last = rows[-1][0]
+
+
+def graphs_to_compact(pdf_db, conn):
+    """ Schema 2: vertices and edges go from cPickle'd lists to process.graph.CompactGraph, and v_md5 and e_md5 are
+    taken again by CompactGraph.digests. Rows with equal lists still get equal hashes, so families stay the same.
+    """
+    last = 0
+    cmd = "select rowid, vertices, edges from %s where rowid > ? order by rowid limit %d" % (pdf_db.table, BATCH_ROWS)
+    while True:
+        rows = conn.execute(cmd, (last,)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for rowid, v_pickled, e_pickled in rows:
+            try:
+                verts = cPickle.loads(str(v_pickled)) if v_pickled else []
+                edges = cPickle.loads(str(e_pickled)) if e_pickled else []
+            except Exception as e:
+                logging.error("migrate.graphs_to_compact bad graph in row %d: %s" % (rowid, e))
+                verts, edges = [], []
+            v_md5, e_md5, v, e = pdf_db.pack_graph(verts, edges)
+            updates.append((v_md5, e_md5, buffer(v), buffer(e), rowid))
+        conn.executemany("update %s set v_md5=?, e_md5=?, vertices=?, edges=? where rowid=?" % pdf_db.table, updates)
+        last = rows[-1][0]
+
+
+"""
+(schema version, step that brings the previous version up to it), in order
+"""
+MIGRATIONS = [(1, features_to_blob), (2, graphs_to_compact)]
+
+
+def migrate(pdf_db):
+    """ Bring the graph database up to dbgw.SCHEMA_VERSION. Each step commits together with its version number, so an
+    interrupted migration can simply be run again.
+
+    :type pdf_db: storage.dbgw.PdfDb
+    :return: success
+    """
+    conn = pdf_db.conn
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, step in MIGRATIONS:
+            if pdf_db.schema_version() >= version:
+                continue
+            start = time.time()
+            sys.stdout.write("Migrating %s to schema %d (%s)\n" % (pdf_db.dbpath, version, step.__name__))
+            conn.execute("begin immediate")
+            try:
+                step(pdf_db, conn)
+                conn.execute("pragma user_version = %d" % version)
+            except Exception as e:
+                conn.execute("rollback")
+                logging.error("migrate.migrate %s failed: %s" % (step.__name__, e))
+                sys.stderr.write("Migration to schema %d failed: %s\n" % (version, e))
+                return False
+            conn.execute("commit")
+            pdf_db.ftr_cache.invalidate()
+            sys.stdout.write("Schema %d done in %.3fs\n" % (version, time.time() - start))
+    finally:
+        conn.isolation_level = isolation_level
+    return True
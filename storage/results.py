@@ -0,0 +1,190 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import gzip
+import json
+import logging
+import sys
+import threading
+import time
+from multiprocessing import JoinableQueue
+
+import numpy
+
+
+FORMATS = ["csv", "csv.gz", "columnar"]
+HEADER = "subject,family,candidate,score\n"
+COLUMNAR_MAGIC = "NABU-RESULTS 1\n"
+
+"""
+Blocks that may wait for the writer. Workers block on put once it is full, which bounds the memory held by results.
+"""
+MAX_BLOCKS = 64
+
+
+class ResultWriter(threading.Thread):
+    """
+    Single consumer of scoring results. Workers put blocks of (subject names, subject index, family row, score) arrays
+    on the bounded queue and the writer thread formats them, so workers never share a lock or flush per line.
+
+    Family rows refer to the FamilyMatrix in self.families. Set it before scoring against a matrix, and drain() before
+    swapping it for another.
+
+    The first error writing the output is kept in self.error and raised again by put, drain() and close(). Blocks
+    queued after it are taken off the queue but not written, so workers blocked on a full queue do not hang.
+
+    columnar output is a COLUMNAR_MAGIC line followed by one frame per block. Each frame is a JSON line giving the row
+    count and the name, numpy dtype and byte length of each column, followed by the raw bytes of the columns.
+    """
+
+    def __init__(self, path=None, fmt="csv", maxsize=MAX_BLOCKS):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.fmt = fmt
+        self.queue = JoinableQueue(maxsize)
+        self.families = None
+        self.fp = None
+        self.raw = None
+        self.rows = 0
+        self.blocks = 0
+        self.bytes = 0
+        self.max_depth = 0
+        self.started = None
+        self.error = None
+
+    @property
+    def console(self):
+        """ Stream for progress messages, stderr when stdout is carrying binary results """
+        return sys.stdout if self.path or self.fmt == "csv" else sys.stderr
+
+    def open(self):
+        self.raw = self.fp = open(self.path, "wb") if self.path else sys.stdout
+        if self.fmt == "csv.gz":
+            self.fp = gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=4)
+        self.write(COLUMNAR_MAGIC if self.fmt == "columnar" else HEADER)
+        self.started = time.time()
+        self.start()
+
+    def write(self, data):
+        self.fp.write(data)
+        self.bytes += len(data)
+
+    def put(self, subjects, sub_idx, rows, dists):
+        """ Queue a block from the parent. Worker processes put the same tuple on self.queue directly. """
+        self.check()
+        self.queue.put((subjects, sub_idx, rows, dists))
+
+    def put_pairs(self, subject, pairs):
+        """ Queue the (distance, row) pairs of one subject, e.g. from TopK.items """
+        rows = numpy.array([row for dist, row in pairs], dtype=numpy.int64)
+        dists = numpy.array([dist for dist, row in pairs], dtype=numpy.float64)
+        self.put([subject], numpy.zeros(len(pairs), dtype=numpy.intp), rows, dists)
+
+    def check(self):
+        """ Raise the error the output failed with, if any """
+        if self.error is not None:
+            raise self.error
+
+    def failed(self, e):
+        logging.error("ResultWriter could not write to %s: %s" % (self.path or "stdout", e))
+        if self.error is None:
+            self.error = e
+
+    def drain(self):
+        """ Wait until every queued block has been written """
+        self.queue.join()
+        self.check()
+        try:
+            self.fp.flush()
+        except Exception as e:
+            self.failed(e)
+        self.check()
+
+    def run(self):
+        while True:
+            block = self.queue.get()
+            try:
+                if block is None:
+                    return
+                if self.error is not None:
+                    continue
+                try:
+                    self.max_depth = max(self.max_depth, self.queue.qsize() + 1)
+                except NotImplementedError:
+                    pass
+                self.write_block(*block)
+            except Exception as e:
+                self.failed(e)
+            finally:
+                self.queue.task_done()
+
+    def write_block(self, subjects, sub_idx, rows, dists):
+        if not len(rows):
+            return
+        if self.fmt == "columnar":
+            self.write_frame(subjects, sub_idx, rows, dists)
+        else:
+            families, candidates = self.families.families, self.families.candidates
+            self.write("".join(["%s,%s,%s,%f\n" % (subjects[sub], families[row], candidates[row], dist)
+                                for sub, row, dist in zip(sub_idx.tolist(), rows.tolist(), dists.tolist())]))
+        self.rows += len(rows)
+        self.blocks += 1
+
+    def write_frame(self, subjects, sub_idx, rows, dists):
+        families, candidates = self.families.families, self.families.candidates
+        rows = rows.tolist()
+        cols = [("subject", numpy.array(subjects, dtype=str)[sub_idx]),
+                ("family", numpy.array([families[row] for row in rows], dtype=str)),
+                ("candidate", numpy.array([candidates[row] for row in rows], dtype=str)),
+                ("score", numpy.asarray(dists, dtype=numpy.float64))]
+        frame = {"rows": len(rows), "columns": [[name, col.dtype.str, col.nbytes] for name, col in cols]}
+        self.write(json.dumps(frame) + "\n")
+        for name, col in cols:
+            self.write(col.tostring())
+
+    def close(self):
+        """ Write whatever is still queued, close the output and report a summary on stderr, or raise self.error """
+        if self.started is None:
+            return
+        self.queue.put(None)
+        self.join()
+        try:
+            try:
+                if self.fmt == "csv.gz":
+                    # Closing the GzipFile writes the trailer but leaves the underlying file open
+                    self.fp.close()
+            finally:
+                if self.path:
+                    self.raw.close()
+                else:
+                    self.raw.flush()
+        except Exception as e:
+            self.failed(e)
+        self.check()
+        sys.stderr.write("Wrote %d scores in %d blocks (%d bytes %s, deepest queue %d) in %.3fs\n" % (
+            self.rows, self.blocks, self.bytes, self.fmt, self.max_depth, time.time() - self.started))
+
+
+def read_columnar(fp):
+    """ Read back a columnar result file
+
+    :param fp: file opened in binary mode
+    :return: generator of dicts of column name to numpy array, one per block
+    """
+    if fp.readline() != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar results file")
+    for line in iter(fp.readline, ""):
+        frame = json.loads(line)
+        yield dict((name, numpy.frombuffer(fp.read(nbytes), dtype=dtype))
+                   for name, dtype, nbytes in frame["columns"])
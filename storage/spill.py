@@ -0,0 +1,116 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import glob
+import logging
+import os
+import tempfile
+
+
+"""
+Row fields at least this many bytes are handed over in a spill file instead of through the pipe
+"""
+SPILL_BYTES = 1 << 20
+
+"""
+Spill files go to shared memory when there is one, so handing a payload over never touches a disk
+"""
+SPILL_DIR = "/dev/shm" if os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+
+
+class Spill(object):
+    """
+    Handle to a field written to a spill file. It pickles as its path and size, whatever the size of the field.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def read(self):
+        """ Read the field back and remove the file, it can only be read once """
+        try:
+            with open(self.path, "rb") as fp:
+                data = fp.read()
+        finally:
+            self.discard()
+        if len(data) != self.size:
+            raise IOError("Spill file %s is %d bytes, expected %d" % (self.path, len(data), self.size))
+        return data
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def spill_prefix(spill_dir=SPILL_DIR):
+    """
+
+    :return: prefix for the spill files of this run, so remove_spills can find whatever is left of them
+    """
+    return os.path.join(spill_dir, "nabu-spill-%d-" % os.getpid())
+
+
+def spill_row(row, prefix, limit=SPILL_BYTES):
+    """ Replace the big string fields of a row with Spill handles. A field that cannot be spilled (e.g. the spill
+    directory is full) is left in the row.
+
+    :type row: storage.dbgw.PdfRow
+    :param prefix: from spill_prefix
+    :return: row of the same type
+    """
+    fields = []
+    for value in row:
+        if isinstance(value, str) and len(value) >= limit:
+            try:
+                fd, path = tempfile.mkstemp(prefix=os.path.basename(prefix), dir=os.path.dirname(prefix))
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(value)
+            except (IOError, OSError) as e:
+                logging.warning("spill.spill_row could not spill %d bytes of %s: %s" % (len(value), row[0], e))
+            else:
+                value = Spill(path, len(value))
+        fields.append(value)
+    return row.__class__(*fields)
+
+
+def unspill_row(row):
+    """ Read the spilled fields of a row back in, removing their files
+
+    :return: row of the same type
+    """
+    fields = [value.read() if isinstance(value, Spill) else value for value in row]
+    return row.__class__(*fields)
+
+
+def discard_row(row):
+    for value in row:
+        if isinstance(value, Spill):
+            value.discard()
+
+
+def remove_spills(prefix):
+    """ Remove the spill files nobody read, e.g. when a worker or the storage writer was killed
+
+    :return: number of files removed
+    """
+    removed = 0
+    for path in glob.glob(prefix + "*"):
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
@@ -0,0 +1,251 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import Queue
+import cPickle
+import logging
+import signal
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import BoundedSemaphore, Lock, Pipe
+
+from dbgw import DONE, FAILED, RUNNING, JobDb, PdfDb
+from spill import discard_row, unspill_row
+from util.metrics import Histogram
+
+
+"""
+Documents saved per transaction by default
+"""
+BATCH_SIZE = 256
+
+"""
+Rows that may wait for the storage writer. Build workers block on put once it is full.
+"""
+MAX_ROWS = 1024
+
+"""
+Stands in for the row of a sample whose content is already stored under another name
+"""
+Alias = namedtuple("Alias", ["name"])
+
+"""
+Sent by a build worker when it starts on a sample (with the time it started), and instead of the row when the sample
+could not be parsed (with the error and dbgw.FAILED or dbgw.TIMEOUT)
+"""
+Running = namedtuple("Running", ["started"])
+Failed = namedtuple("Failed", ["error", "status"])
+
+"""
+Last message of a build, as the row of (None, None, row). complete is False when the pool was terminated: samples
+still running are then left running, for the next resume to redo. Otherwise a sample whose row never came is recorded
+as failed.
+"""
+Finished = namedtuple("Finished", ["complete"])
+
+
+class RowQueue(object):
+    """
+    Bounded queue of rows for the storage writer. multiprocessing.Queue pickles and sends in a feeder thread, where an
+    error (e.g. a MemoryError under --max-mem) kills the thread and the row is silently lost. put here pickles and
+    writes the row in the calling thread, so it either gets the row to the writer or raises. Any number of processes
+    may put, only the writer gets.
+    """
+
+    def __init__(self, maxsize=MAX_ROWS):
+        self.maxsize = maxsize
+        self.reader, self.writer = Pipe(duplex=False)
+        self.lock = Lock()
+        self.slots = BoundedSemaphore(maxsize)
+
+    def put(self, obj, timeout=None):
+        """
+
+        :param timeout: seconds to wait for room in the queue, and for other processes to finish their put
+        :raise Queue.Full: if that took longer than timeout
+        """
+        data = cPickle.dumps(obj, protocol=2)
+        # Blocks while maxsize rows are waiting for the writer
+        if not self.slots.acquire(True, timeout):
+            raise Queue.Full
+        try:
+            if not self.lock.acquire(True, timeout):
+                raise Queue.Full
+            try:
+                self.writer.send_bytes(data)
+            finally:
+                self.lock.release()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def get(self):
+        data = self.reader.recv_bytes()
+        self.slots.release()
+        return cPickle.loads(data)
+
+    def qsize(self):
+        return self.maxsize - self.slots.get_value()
+
+
+class BatchWriter(object):
+    """
+    Groups the saves and job completions of a build into one transaction per batch_size documents, instead of a
+    commit per statement.
+
+    The graph database is committed before the job database. If the build dies mid-batch, the documents of the batch
+    are either not saved at all or saved but not marked complete. Either way they are parsed again on resume, and
+    saving them again replaces the same rows.
+
+    Job statuses go in with the same commit: samples workers started on since the last batch as running, finished ones
+    as done, failed or timed out, with the seconds since their worker started on them.
+    """
+
+    def __init__(self, pdf_db, job_db, job_name, batch_size=BATCH_SIZE, commits=None):
+        """
+
+        :type pdf_db: storage.dbgw.PdfDb
+        :type job_db: storage.dbgw.JobDb
+        :param commits: counts of a util.metrics.Histogram to observe commit latencies into
+        """
+        self.pdf_db = pdf_db
+        self.job_db = job_db
+        self.job_name = job_name
+        self.batch_size = max(1, batch_size)
+        self.pending = []
+        self.started = {}
+        self.batches = 0
+        self.commits = Histogram(commits)
+
+    def save(self, path, row, content_md5=None):
+        """
+
+        :param path: sample path, marked complete once the row is committed
+        :param row: from PdfDb.make_row
+        :param content_md5: MD5 of the sample file
+        """
+        if not self.pdf_db.batched:
+            self.pdf_db.begin()
+        self.pdf_db.save_row(row, content_md5)
+        self.add(path)
+
+    def alias(self, path, content_md5, name):
+        """ Save a byte-identical copy of a stored sample under its own name, without parsing it
+
+        :return: success, False if the content is not stored yet
+        """
+        if not self.pdf_db.batched:
+            self.pdf_db.begin()
+        if not self.pdf_db.copy_row(content_md5, name):
+            return False
+        self.add(path)
+        return True
+
+    def running(self, path, started):
+        self.started[path] = started
+
+    def fail(self, path, error, status=FAILED):
+        self.add(path, status, error)
+
+    def add(self, path, status=DONE, error=None):
+        started = self.started.pop(path, None)
+        self.pending.append((path, status, error, time.time() - started if started else None))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Commit the open batch, if any
+
+        :return: success
+        """
+        if not self.pending:
+            if self.pdf_db.batched:
+                self.pdf_db.commit()
+            return True
+        pending, self.pending = self.pending, []
+        start = time.time()
+        if self.pdf_db.batched and not self.pdf_db.commit():
+            logging.error("BatchWriter.flush could not commit %d documents, they will be redone" % len(pending))
+            return False
+        self.batches += 1
+        running = [(path, RUNNING, None, None) for path in self.started]
+        marked = self.job_db.mark_many(self.job_name, running + pending)
+        self.commits.observe(time.time() - start)
+        return marked
+
+
+def write_rows(rows, pdf_dbpath, job_dbpath, job_name, batch_size=BATCH_SIZE, commits=None):
+    """ Storage writer process of a build, the only process writing to the databases while it runs. Build workers
+    put (sample path, content MD5, PdfDb.make_row) tuples on rows, and the writer saves them in batches until it gets
+    Finished (or None). Fields that were spilled are read back from their spill files here. Running and Failed come in
+    place of the row to update the status of a sample.
+
+    Duplicate samples come with an Alias instead of a row. If the sample they duplicate is still in flight, they wait
+    until every row is in. Any that still have nothing to copy are left for the next resume.
+
+    It keeps taking rows even if it cannot open the databases, so workers never block on a queue nobody reads.
+
+    :type rows: RowQueue
+    :param commits: shared counts of a util.metrics.Histogram for commit latencies
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pdf_db, job_db = PdfDb(pdf_dbpath), JobDb(job_dbpath)
+    writer = None
+    if pdf_db.init(pdf_db.table, pdf_db.cols) and job_db.init(job_db.table, job_db.cols):
+        writer = BatchWriter(pdf_db, job_db, job_name, batch_size, commits)
+    else:
+        logging.error("writer.write_rows could not initialize db, dropping rows")
+    saved = 0
+    waiting = []
+    complete = False
+    for path, content_md5, row in iter(rows.get, None):
+        if isinstance(row, Finished):
+            complete = row.complete
+            break
+        if writer is None:
+            discard_row(row)
+            continue
+        try:
+            if isinstance(row, Running):
+                writer.running(path, row.started)
+                continue
+            if isinstance(row, Failed):
+                writer.fail(path, row.error, row.status)
+                continue
+            if isinstance(row, Alias):
+                if not writer.alias(path, content_md5, row.name):
+                    waiting.append((path, content_md5, row.name))
+                    continue
+            else:
+                writer.save(path, unspill_row(row), content_md5)
+            saved += 1
+        except Exception as e:
+            logging.error("writer.write_rows could not save %s: %s" % (path, e))
+            discard_row(row)
+    if writer is None:
+        sys.exit(1)
+    for path, content_md5, name in waiting:
+        if writer.alias(path, content_md5, name):
+            saved += 1
+        else:
+            logging.error("writer.write_rows no stored sample has the content of %s, it will be redone" % path)
+    if complete:
+        for path in list(writer.started):
+            logging.error("writer.write_rows never got the row of %s" % path)
+            writer.fail(path, "its row never reached the storage writer")
+    ok = writer.flush()
+    pdf_db.close()
+    job_db.close()
+    logging.info("writer.write_rows saved %d rows in %d batches" % (saved, writer.batches))
+    sys.exit(0 if ok else 1)
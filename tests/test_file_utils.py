@@ -0,0 +1,111 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from util.file_utils import parse_extensions, walk_samples
+
+"""
+Sample files of the test tree and their sizes
+"""
+FILES = {
+    "a.pdf": 100,
+    "b.PDF": 200,
+    "c.bin": 300,
+    "d": 10,
+    "empty.pdf": 0,
+    "sub/e.pdf": 99,
+    "sub/f.bin": 101,
+    "sub/deeper/g.pdf": 1000,
+    "sub/deeper/h.txt": 100,
+}
+
+
+class WalkSamplesTest(unittest.TestCase):
+    """
+    walk_samples finds the same files a plain os.walk with the same filters does
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        for name, size in FILES.items():
+            path = os.path.join(self.tmp, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as fp:
+                fp.write("x" * size)
+        os.mkdir(os.path.join(self.tmp, "no-samples"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def walk(self, *args, **kwargs):
+        return sorted(os.path.relpath(path, self.tmp) for path in walk_samples(self.tmp, *args, **kwargs))
+
+    def test_parse_extensions(self):
+        self.assertEqual(parse_extensions(""), ())
+        self.assertEqual(parse_extensions(None), ())
+        self.assertEqual(parse_extensions("pdf, .BIN,,"), (".pdf", ".bin"))
+
+    def test_all(self):
+        self.assertEqual(self.walk(), sorted(FILES))
+        for path in walk_samples(self.tmp):
+            self.assertTrue(isinstance(path, str))
+
+    def test_extensions(self):
+        self.assertEqual(self.walk(parse_extensions("pdf")),
+                         ["a.pdf", "b.PDF", "empty.pdf", "sub/deeper/g.pdf", "sub/e.pdf"])
+        self.assertEqual(self.walk(parse_extensions(".bin,txt")), ["c.bin", "sub/deeper/h.txt", "sub/f.bin"])
+        self.assertEqual(self.walk(parse_extensions("doc")), [])
+
+    def test_sizes(self):
+        # Both limits are inclusive
+        self.assertEqual(self.walk(min_size=100), ["a.pdf", "b.PDF", "c.bin", "sub/deeper/g.pdf",
+                                                   "sub/deeper/h.txt", "sub/f.bin"])
+        self.assertEqual(self.walk(min_size=101), ["b.PDF", "c.bin", "sub/deeper/g.pdf", "sub/f.bin"])
+        self.assertEqual(self.walk(max_size=100), ["a.pdf", "d", "empty.pdf", "sub/deeper/h.txt", "sub/e.pdf"])
+        self.assertEqual(self.walk(max_size=99), ["d", "empty.pdf", "sub/e.pdf"])
+        self.assertEqual(self.walk(min_size=100, max_size=100), ["a.pdf", "sub/deeper/h.txt"])
+        self.assertEqual(self.walk(min_size=101, max_size=100), [])
+        # 0 is no limit, so an empty file is only skipped by a minimum
+        self.assertEqual(self.walk(min_size=0, max_size=0), sorted(FILES))
+        self.assertEqual(self.walk(min_size=1, max_size=10), ["d"])
+
+    def test_extensions_and_sizes(self):
+        self.assertEqual(self.walk(parse_extensions("pdf"), 100, 999), ["a.pdf", "b.PDF"])
+
+    def test_symlinks(self):
+        os.symlink(os.path.join(self.tmp, "sub"), os.path.join(self.tmp, "link"))
+        os.symlink(os.path.join(self.tmp, "a.pdf"), os.path.join(self.tmp, "no-samples", "a-link.pdf"))
+        linked = sorted(FILES.keys() + ["no-samples/a-link.pdf"])
+        self.assertEqual(self.walk(), linked)
+        self.assertEqual(self.walk(followlinks=True),
+                         sorted(linked + ["link/e.pdf", "link/f.bin", "link/deeper/g.pdf", "link/deeper/h.txt"]))
+        # A link is filtered on the size of its target
+        self.assertEqual(self.walk(parse_extensions("pdf"), min_size=100, max_size=100),
+                         ["a.pdf", "no-samples/a-link.pdf"])
+
+    def test_missing(self):
+        logging.disable(logging.WARNING)
+        try:
+            self.assertEqual(list(walk_samples(os.path.join(self.tmp, "missing"))), [])
+        finally:
+            logging.disable(logging.NOTSET)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from process.similarity import FamilyMatrix
+from storage import dbgw
+from storage.dbgw import PdfDb, PdfRow
+
+
+def make_row(name, family, value):
+    ftrs = numpy.arange(len(dbgw.FEATURE_NAMES), dtype=dbgw.FEATURE_DTYPE) + value
+    return PdfRow(name, "v-" + family, family, "vertices", "edges", "", ftrs.tostring())
+
+
+class FeatureCacheTest(unittest.TestCase):
+    """
+    The feature cache of a PdfDb is extended by saves and rebuilt, with a new generation, after any other change
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tmp, "nabu-graphdb.sqlite")
+        self.pdf_db = self.open_db()
+        for idx in xrange(3):
+            self.pdf_db.save_row(make_row("pdf-%d" % idx, "fam-%d" % idx, idx))
+        self.cache = self.pdf_db.ftr_cache
+        self.assertFalse(self.cache.fresh())
+        self.check()
+        self.generation = self.pdf_db.family_generation()
+        self.assertTrue(self.generation)
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        self.pdf_db.close()
+        shutil.rmtree(self.tmp)
+
+    def open_db(self):
+        pdf_db = PdfDb(self.dbpath)
+        self.assertTrue(pdf_db.init(pdf_db.table, pdf_db.cols))
+        return pdf_db
+
+    def check(self):
+        """ The family matrix from the cache has the rows the pdfs table has """
+        cached = self.pdf_db.load_family_matrix()
+        self.assertTrue(self.cache.fresh())
+        self.assertTrue(isinstance(cached.features, numpy.memmap))
+        table = FamilyMatrix.load(self.pdf_db)
+        self.assertEqual(sorted(zip(cached.families, cached.candidates, cached.features.tolist())),
+                         sorted(zip(table.families, table.candidates, table.features.tolist())))
+        return cached
+
+    def test_extend(self):
+        self.pdf_db.save_row(make_row("pdf-3", "fam-3", 3))
+        self.pdf_db.begin()
+        self.pdf_db.save_row(make_row("pdf-4", "fam-4", 4))
+        # Another member of a family that is cached already adds no row
+        self.pdf_db.save_row(make_row("pdf-5", "fam-0", 0))
+        self.pdf_db.save_row(make_row("pdf-6", "fam-6", 6))
+        self.assertTrue(self.pdf_db.commit())
+        self.assertTrue(self.cache.fresh())
+        self.assertEqual(self.cache.stamp["rows"], 6)
+        cached = self.check()
+        self.assertEqual(cached.families[3:], ["fam-3", "fam-4", "fam-6"])
+        self.assertEqual(self.pdf_db.family_generation(), self.generation)
+
+        # Another process sees the same cache
+        other = self.open_db()
+        try:
+            self.assertTrue(other.ftr_cache.fresh())
+            self.assertEqual(other.family_generation(), self.generation)
+        finally:
+            other.close()
+
+    def assertRebuilt(self):
+        self.assertFalse(self.cache.fresh())
+        self.check()
+        self.assertNotEqual(self.pdf_db.family_generation(), self.generation)
+
+    def test_delete(self):
+        self.pdf_db.query("delete from %s where pdf_id='pdf-2'" % PdfDb.table, ())
+        self.assertRebuilt()
+
+    def test_delete_first(self):
+        # Only the row count changes, not the last rowid
+        self.pdf_db.query("delete from %s where pdf_id='pdf-0'" % PdfDb.table, ())
+        self.assertRebuilt()
+
+    def test_replace(self):
+        # Saved with another graph, the representative of fam-1 is gone
+        self.pdf_db.save_row(make_row("pdf-1", "fam-9", 9))
+        self.assertRebuilt()
+        self.assertEqual(sorted(self.pdf_db.load_family_matrix().families), ["fam-0", "fam-2", "fam-9"])
+
+    def test_replace_elsewhere(self):
+        # Replaced behind the cache's back, only the last rowid changes
+        other = self.open_db()
+        try:
+            other.query("insert or replace into %s select * from %s where pdf_id='pdf-0'" % ((PdfDb.table,) * 2), ())
+        finally:
+            other.close()
+        self.assertRebuilt()
+
+    def test_update_features(self):
+        ftrs = numpy.ones(len(dbgw.FEATURE_NAMES), dtype=dbgw.FEATURE_DTYPE)
+        self.assertTrue(self.pdf_db.update_features([(ftrs.tostring(), "pdf-2")]))
+        self.assertRebuilt()
+
+    def test_truncated(self):
+        with open(self.cache.path, "r+b") as fp:
+            fp.truncate(os.path.getsize(self.cache.path) - 8)
+        self.assertRebuilt()
+
+    def test_truncated_extend(self):
+        # A cache that was fresh when the batch began, and is truncated by the time it is committed
+        self.pdf_db.begin()
+        self.pdf_db.save_row(make_row("pdf-3", "fam-3", 3))
+        with open(self.cache.idx_path, "r+b") as fp:
+            fp.truncate(0)
+        self.assertTrue(self.pdf_db.commit())
+        self.assertEqual(self.cache.stamp, None)
+        self.assertRebuilt()
+
+    def test_unfinished_append(self):
+        # Rows appended by a save that died before re-stamping
+        with open(self.cache.path, "ab") as fp:
+            fp.write("\0" * 8 * len(dbgw.FEATURE_NAMES))
+        self.assertRebuilt()
+
+
+if __name__ == "__main__":
+    unittest.main()
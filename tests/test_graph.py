@@ -0,0 +1,126 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import cPickle
+import unittest
+import zlib
+
+import networkx
+import numpy
+
+from process.graph import CompactGraph, column, pack_columns, unpack_columns
+from process.netsimile import random_graphs
+
+
+def pdf_graph(objects, seed=0):
+    """ Vertex and edge lists shaped like PDF.get_nodes_edges gives them """
+    rng = numpy.random.RandomState(seed)
+    kinds = [["object", "dict", "Type", "literal", "Pages", "ref"], ["object", "stream", "props", "dict", "data"],
+             ["object", "list", "ref", "ref", "number"], ["object", "dict", "Font", "dict", "F1", "ref"]]
+    v = [("PDF", ["start"])] + [(str(i), list(kinds[rng.randint(len(kinds))])) for i in xrange(1, objects + 1)]
+    e = [("PDF", "1")] + [(str(i), str(rng.randint(1, objects + 1))) for i in xrange(1, objects + 1)
+                          for ref in xrange(rng.randint(0, 3))]
+    v.append(("%d" % (objects + 5), ["missing_target"]))
+    e.append(("2", "%d" % (objects + 5)))
+    return v, e
+
+
+class CompactGraphTest(unittest.TestCase):
+
+    def roundtrip(self, v, e):
+        graph = CompactGraph.from_lists(v, e)
+        self.assertEqual(graph.to_lists(), (v, e))
+        unpacked = CompactGraph.unpack(graph.pack_vertices(), graph.pack_edges())
+        self.assertEqual(unpacked.to_lists(), (v, e))
+        return graph
+
+    def test_roundtrip(self):
+        for objects in [1, 10, 300, 70000]:
+            self.roundtrip(*pdf_graph(objects))
+        for name, v, e in random_graphs(50):
+            self.roundtrip([(label, ["object"] * (len(label) % 3)) for label, attrs in v], e)
+
+    def test_odd_lists(self):
+        self.roundtrip([], [])
+        self.roundtrip([("a", [])], [])
+        # Edges to nodes that are not vertices, duplicate vertices, self-loops and repeated edges
+        self.roundtrip([], [("a", "b"), ("a", "b")])
+        self.roundtrip([("a", ["x"]), ("a", ["x"]), ("b", [])], [("a", "c"), ("c", "c")])
+        self.roundtrip([("", [""]), ("\x00\xff", ["\n", ""])], [("", "\x00\xff")])
+
+    def test_labels_held_once(self):
+        v, e = pdf_graph(300)
+        graph = self.roundtrip(v, e)
+        edges = zlib.decompress(graph.pack_edges(), -zlib.MAX_WBITS)
+        for label in ["PDF", "17", "123"]:
+            self.assertNotIn(label, edges)
+        # Only labels that are not vertices are held with the edges
+        graph = self.roundtrip(v, e + [("1", "only-in-edges")])
+        self.assertIn("only-in-edges", zlib.decompress(graph.pack_edges(), -zlib.MAX_WBITS))
+        self.assertEqual(graph.labels[graph.count:], ["only-in-edges"])
+
+    def test_narrow_columns(self):
+        self.assertEqual(column([]).dtype, numpy.dtype("<u1"))
+        self.assertEqual(column([0, 255]).dtype, numpy.dtype("<u1"))
+        self.assertEqual(column([256]).dtype, numpy.dtype("<u2"))
+        self.assertEqual(column([70000]).dtype, numpy.dtype("<u4"))
+        self.assertRaises(ValueError, column, [2 ** 32])
+        graph = CompactGraph.from_lists(*pdf_graph(100))
+        self.assertEqual(graph.src.dtype, numpy.dtype("<u1"))
+        self.assertEqual(graph.tags.dtype, numpy.dtype("<u1"))
+        self.assertEqual(CompactGraph.from_lists(*pdf_graph(1000)).src.dtype, numpy.dtype("<u2"))
+
+    def test_columns(self):
+        columns = [column([]), column([1, 2, 3]), column([70000, 0]), column(range(300))]
+        unpacked = unpack_columns(pack_columns(columns), len(columns))
+        self.assertEqual([col.tolist() for col in unpacked], [col.tolist() for col in columns])
+        self.assertEqual([col.dtype for col in unpacked], [col.dtype for col in columns])
+        self.assertRaises(ValueError, unpack_columns, pack_columns(columns) + "\x00", len(columns))
+
+    def test_smaller_than_compressed_pickles(self):
+        for objects in [1, 10, 300]:
+            v, e = pdf_graph(objects)
+            graph = CompactGraph.from_lists(v, e)
+            self.assertLess(len(graph.pack_vertices()), len(zlib.compress(cPickle.dumps(v, 2))))
+            self.assertLess(len(graph.pack_edges()), len(zlib.compress(cPickle.dumps(e, 2))))
+
+    def test_digests(self):
+        v, e = pdf_graph(50)
+        v_md5, e_md5 = CompactGraph.from_lists(v, e).digests()
+        self.assertEqual(CompactGraph.from_lists(list(v), list(e)).digests(), (v_md5, e_md5))
+        # The same edges with other vertices are the same family
+        other = [("extra", ["object"])] + v[:1] + [(label, ["object"]) for label, attrs in v[1:]]
+        other_v, other_e = CompactGraph.from_lists(other, e).digests()
+        self.assertNotEqual(other_v, v_md5)
+        self.assertEqual(other_e, e_md5)
+        # Other edges are not
+        self.assertNotEqual(CompactGraph.from_lists(v, e[:-1]).digests()[1], e_md5)
+        self.assertNotEqual(CompactGraph.from_lists(v, [(dst, src) for src, dst in e]).digests()[1], e_md5)
+        self.assertNotEqual(CompactGraph.from_lists(v, e[1:] + e[:1]).digests()[1], e_md5)
+
+    def test_networkx(self):
+        v, e = pdf_graph(40)
+        graph = CompactGraph.from_lists(v, e).to_networkx()
+        expected = networkx.Graph()
+        for label, attrs in v:
+            expected.add_node(label, contains=attrs)
+        expected.add_edges_from(e)
+        self.assertEqual(sorted(graph.nodes(data=True)), sorted(expected.nodes(data=True)))
+        self.assertEqual(sorted(map(sorted, graph.edges())), sorted(map(sorted, expected.edges())))
+        back = CompactGraph.from_networkx(graph).to_networkx()
+        self.assertEqual(sorted(back.nodes(data=True)), sorted(expected.nodes(data=True)))
+        self.assertEqual(sorted(map(sorted, back.edges())), sorted(map(sorted, expected.edges())))
+
+
+if __name__ == "__main__":
+    unittest.main()
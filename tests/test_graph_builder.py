@@ -0,0 +1,151 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import os
+import shutil
+import tempfile
+import unittest
+from xml.etree.ElementTree import TreeBuilder, XMLParser
+
+from process.graph import GraphBuilder
+from process.parsers import pdfminer
+from process.pdf import PDF
+
+"""
+Element trees as PDFMinerParser builds them, with the cases PDF.get_nodes_edges and PDF.get_javascript have to handle
+"""
+TREES = {
+    "plain": '<pdf><object id="1"><dict><Root><ref id="2"/></Root></dict></object>'
+             '<object id="2"><dict><Kids><list><ref id="3"/><ref id="1"/></list></Kids></dict></object>'
+             '<object id="3"><stream><props><dict/></props><data>abc</data></stream></object></pdf>',
+    "no root": '<pdf><object id="1"><dict><ref id="2"/></dict></object><object id="2"><number>4</number></object></pdf>',
+    "root without ref": '<pdf><object id="1"><Root><dict/></Root><ref id="2"/></object><object id="2"/></pdf>',
+    "second root": '<pdf><object id="1"><Root/></object><object id="2"><Root><ref id="9"/></Root></object></pdf>',
+    "nested root ref": '<pdf><object id="1"><Root><dict><list><ref id="7"/></list></dict></Root><ref id="8"/>'
+                       '</object></pdf>',
+    "duplicate ids": '<pdf><object id="1"><ref id="1"/></object><object id="1"><ref id="1_"/></object>'
+                     '<object id="1"><ref id="2"/></object></pdf>',
+    "missing targets": '<pdf><object id="1"><ref id="5"/><ref id="2"/><ref id="5"/></object>'
+                       '<object id="2"><ref id="6"/><ref id="1"/></object></pdf>',
+    "refs outside objects": '<pdf><trailer><ref id="1"/></trailer><object id="1"><ref id="2"/></object></pdf>',
+    "javascript": '<pdf><object id="1"><stream><js enc="raw">app.alert(1);</js></stream></object>'
+                  '<object id="2"><stream><data>x</data></stream></object>'
+                  '<object id="3"><stream><js enc="raw">var a = 1;<b/>tail</js></stream></object></pdf>',
+    "empty": '<pdf/>',
+}
+
+
+def feed(xml, target):
+    parser = XMLParser(target=target)
+    parser.feed(xml)
+    return parser.close()
+
+
+def make_pdf(path, objects, root=1):
+    """ Write a PDF of the given object bodies, with an xref table """
+    out = "%PDF-1.4\n"
+    offsets = {}
+    for objid in sorted(objects):
+        offsets[objid] = len(out)
+        out += "%d 0 obj\n%s\nendobj\n" % (objid, objects[objid])
+    xref = len(out)
+    size = max(objects) + 1
+    out += "xref\n0 %d\n0000000000 65535 f \n" % size
+    for objid in xrange(1, size):
+        out += "%010d 00000 n \n" % offsets[objid] if objid in offsets else "0000000000 65535 f \n"
+    out += "trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, root, xref)
+    with open(path, "wb") as fp:
+        fp.write(out)
+
+
+def stream(data):
+    return "<< /Length %d >>\nstream\n%s\nendstream" % (len(data), data)
+
+
+class GraphBuilderTest(unittest.TestCase):
+    """
+    GraphBuilder has to give what PDF.get_nodes_edges and PDF.get_javascript take from the element tree
+    """
+
+    def test_trees(self):
+        for name, xml in sorted(TREES.items()):
+            pdf = PDF("", name)
+            pdf.xml = feed(xml, TreeBuilder())
+            builder = GraphBuilder()
+            self.assertEqual(feed(xml, builder), pdf.get_nodes_edges(), name)
+            self.assertEqual(builder.get_javascript(), pdf.get_javascript(), name)
+
+    def test_tag_mismatch(self):
+        for target in [TreeBuilder(), GraphBuilder()]:
+            target.start("pdf", {})
+            target.start("object", {"id": "1"})
+            self.assertRaises(AssertionError, target.end, "pdf")
+
+    def test_missing_end_tags(self):
+        builder = GraphBuilder()
+        builder.start("pdf", {})
+        self.assertRaises(AssertionError, builder.close)
+
+    def test_attributes(self):
+        builder = GraphBuilder()
+        builder.start("pdf", {})
+        attrs = builder.start("object", {"id": "1"})
+        attrs.set("type", "malformed")
+        self.assertEqual(attrs, {"id": "1", "type": "malformed"})
+
+
+class GraphOnlyParseTest(unittest.TestCase):
+    """
+    Parsing with graph_only gives the same graph, javascript and features as parsing into an element tree
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.outputdir = pdfminer.OUTPUTDIR
+        pdfminer.OUTPUTDIR = self.tmp
+
+    def tearDown(self):
+        pdfminer.OUTPUTDIR = self.outputdir
+        shutil.rmtree(self.tmp)
+
+    def check(self, objects, root=1):
+        path = os.path.join(self.tmp, "sample.pdf")
+        make_pdf(path, objects, root)
+        tree = pdfminer.parse_and_hash(path)
+        graph = pdfminer.parse_and_hash(path, graph_only=True)
+        self.assertTrue(tree.parsed and graph.parsed)
+        self.assertEqual(graph.get_nodes_edges(), tree.get_nodes_edges())
+        self.assertEqual(graph.get_javascript(), tree.get_javascript())
+        self.assertEqual(map(repr, graph.ftr_vec), map(repr, tree.ftr_vec))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, "sample.pdf.xml.zip")))
+        return tree
+
+    def test_document(self):
+        pdf = self.check({
+            1: "<< /Type /Catalog /Pages 2 0 R /OpenAction 5 0 R >>",
+            2: "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+            3: "<< /Type /Page /Parent 2 0 R /Resources << /Font << /F1 4 0 R /F2 9 0 R >> >> /Contents 6 0 R >>",
+            4: "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+            5: "<< /S /JavaScript /JS 7 0 R >>",
+            6: stream("BT /F1 12 Tf (hello) Tj ET"),
+            7: stream("var x = unescape('%41'); function f(a) { if (a) { return eval(a); } } f(x);"),
+        })
+        self.assertIn(("9", ["missing_target"]), pdf.v)
+        self.assertIn("eval", pdf.get_javascript())
+
+    def test_missing_root(self):
+        self.check({1: "<< /Type /Pages /Kids [] /Count 0 >>", 2: "[1 0 R 3 0 R]"}, root=8)
+
+
+if __name__ == "__main__":
+    unittest.main()
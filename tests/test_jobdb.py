@@ -0,0 +1,119 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from storage import dbgw
+from storage.dbgw import JobDb
+
+
+class JobDbTest(unittest.TestCase):
+    """
+    Job statuses: the upgrade of the original jobs table, the streaming resume check and the reset before a build
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tmp, "nabu-jobs.sqlite")
+        self.job_db = None
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        if self.job_db:
+            self.job_db.close()
+        shutil.rmtree(self.tmp)
+
+    def open_db(self):
+        self.job_db = JobDb(self.dbpath)
+        self.assertTrue(self.job_db.init(self.job_db.table, self.job_db.cols))
+        return self.job_db
+
+    def rows(self):
+        return sorted(self.job_db.query("select job_name, sample_path, status from %s" % JobDb.table, ()))
+
+    def test_upgrade(self):
+        # The original table had no key, so a sample could be listed as done more than once
+        conn = sqlite3.connect(self.dbpath)
+        conn.execute("create table jobs(job_name text, sample_path text)")
+        conn.executemany("insert into jobs values(?, ?)",
+                         [("a", "/s/1.pdf"), ("a", "/s/2.pdf"), ("a", "/s/1.pdf"), ("b", "/s/1.pdf"), ("a", "/s/1.pdf")])
+        conn.commit()
+        conn.close()
+
+        job_db = self.open_db()
+        self.assertEqual(self.rows(), [("a", "/s/1.pdf", dbgw.DONE), ("a", "/s/2.pdf", dbgw.DONE),
+                                       ("b", "/s/1.pdf", dbgw.DONE)])
+        self.assertEqual(job_db.get_completed("a"), set(["/s/1.pdf", "/s/2.pdf"]))
+        self.assertEqual(job_db.counts("a"), {dbgw.DONE: 2})
+        tables = [row[0] for row in job_db.query("select name from sqlite_master where type='table'", ())]
+        self.assertEqual(tables, [JobDb.table])
+        self.assertTrue(job_db.mark_many("a", [("/s/3.pdf", dbgw.FAILED, "bad", 1.5)]))
+        self.assertEqual(job_db.counts("a"), {dbgw.DONE: 2, dbgw.FAILED: 1})
+
+        # Upgraded once
+        job_db.close()
+        self.open_db()
+        self.assertEqual(len(self.rows()), 4)
+
+    def test_unfinished(self):
+        job_db = self.open_db()
+        job_db.mark_many("a", [("/s/1.pdf", dbgw.DONE, None, 1.0), ("/s/2.pdf", dbgw.FAILED, "bad", 1.0)])
+        job_db.mark_many("b", [("/s/3.pdf", dbgw.DONE, None, 1.0)])
+        samples = ["/s/%d.pdf" % (idx % 5) for idx in xrange(12)]
+        # Small chunks, so repeats span chunks
+        self.assertEqual(list(job_db.unfinished("a", iter(samples), chunk=2)), ["/s/0.pdf", "/s/3.pdf", "/s/4.pdf"])
+        self.assertEqual(job_db.counts("a"), {dbgw.DONE: 1, dbgw.FAILED: 1, dbgw.QUEUED: 3})
+        # Queued now, so a second pass over the same samples has nothing to do
+        self.assertEqual(list(job_db.unfinished("a", iter(samples))), [])
+
+    def test_unfinished_is_lazy(self):
+        job_db = self.open_db()
+
+        def samples():
+            for idx in xrange(10):
+                yield "/s/%d.pdf" % idx
+            self.fail("read past the samples taken")
+
+        todo = job_db.unfinished("a", samples(), chunk=3)
+        self.assertEqual([todo.next() for idx in xrange(3)], ["/s/0.pdf", "/s/1.pdf", "/s/2.pdf"])
+        self.assertEqual(job_db.counts("a"), {dbgw.QUEUED: 3})
+
+    def test_reset(self):
+        job_db = self.open_db()
+        job_db.mark_many("a", [("/s/1.pdf", dbgw.DONE, None, 1.0), ("/s/2.pdf", dbgw.RUNNING, None, None),
+                               ("/s/3.pdf", dbgw.FAILED, "bad", 1.0), ("/s/4.pdf", dbgw.TIMEOUT, "slow", 1.0)])
+        job_db.mark_many("b", [("/s/2.pdf", dbgw.RUNNING, None, None)])
+        list(job_db.unfinished("a", ["/s/5.pdf"]))
+
+        # The running and queued samples are forgotten, and the next build requeues them
+        self.assertEqual(job_db.reset("a"), 2)
+        self.assertEqual(job_db.counts("a"), {dbgw.DONE: 1, dbgw.FAILED: 1, dbgw.TIMEOUT: 1})
+        self.assertEqual(job_db.counts("b"), {dbgw.RUNNING: 1})
+        samples = ["/s/%d.pdf" % idx for idx in xrange(1, 6)]
+        self.assertEqual(list(job_db.unfinished("a", samples)), ["/s/2.pdf", "/s/5.pdf"])
+        self.assertEqual(job_db.reset("a"), 2)
+
+        # --update redoes the finished ones too
+        self.assertEqual(job_db.reset("a", everything=True), 3)
+        self.assertEqual(job_db.counts("a"), {})
+        self.assertEqual(list(job_db.unfinished("a", samples)), samples)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from util import metrics
+from util.metrics import BOUNDS, STAGES, BuildMetrics, Histogram
+
+"""
+A sample line of the Prometheus text format: name, optional labels and value
+"""
+SAMPLE = re.compile(r'^([a-z_]+)(\{[a-z]+="[^"]*"\})? (\S+)$')
+
+"""
+Stats line of a build, e.g. "3 docs 1.5/s 0.01 MB/s | parse p50 2ms p95 20ms p99 20ms | commit p95 - | queue 4 | ..."
+"""
+LINE = re.compile(r"^(\d+) docs [\d.]+/s [\d.]+ MB/s \| parse p50 (\S+) p95 (\S+) p99 (\S+) \| commit p95 (\S+) \| "
+                  r"queue (\d+) \| (.*)$")
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    The stats line and the metrics file of a build, in JSON and in the Prometheus text format
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        metrics.take_stages()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def build(self, path=None):
+        build = BuildMetrics(path, every=0)
+        # Latencies on bucket bounds, which are what the percentiles report
+        build.add(None, 1000, BOUNDS[3], {"read": 0.5, "xml": 1.5})
+        build.add("failed", 3000, BOUNDS[13], {"read": 1.0, "features": 1.0})
+        build.add(None, 2000, BOUNDS[3], {})
+        build.duplicates = 1
+        build.queue_depth = 4
+        build.commits.observe(0.5)
+        return build
+
+    def test_histogram(self):
+        hist = Histogram()
+        self.assertEqual(hist.percentile(50), None)
+        # Buckets hold their upper bound
+        for value in [0.0, 0.001, 0.0011, 5.0, 1e6]:
+            hist.observe(value)
+        self.assertEqual(hist.count, 5)
+        self.assertAlmostEqual(hist.total, 1e6 + 5.0021)
+        self.assertEqual(hist.counts[0], 2)
+        self.assertEqual(hist.counts[1], 1)
+        self.assertEqual(hist.counts[len(BOUNDS)], 1)
+        self.assertEqual(hist.percentile(40), BOUNDS[0])
+        self.assertEqual(hist.percentile(60), BOUNDS[1])
+        self.assertEqual(hist.percentile(100), float("inf"))
+
+    def test_stages(self):
+        with metrics.stage("graph"):
+            pass
+        metrics.add_stage("graph", 1.0)
+        metrics.add_stage("row", 2.0)
+        stages = metrics.take_stages()
+        self.assertEqual(sorted(stages), ["graph", "row"])
+        self.assertTrue(1.0 <= stages["graph"] < 1.5)
+        self.assertEqual(metrics.take_stages(), {})
+
+    def test_line(self):
+        stream = StringIO()
+        self.build().report(stream)
+        text = stream.getvalue()
+        self.assertTrue(text.endswith("\n"))
+        match = LINE.match(text.rstrip("\n"))
+        self.assertTrue(match, text)
+        docs, p50, p95, p99, commit, queue, stages = match.groups()
+        self.assertEqual((docs, p50, p95, p99, commit, queue), ("4", "2ms", "20ms", "20ms", "501ms", "4"))
+        self.assertEqual(stages, "read 38% tokenize 0% xml 38% graph 0% features 25% xml_file 0% row 0%")
+        self.assertEqual(metrics.seconds(None), "-")
+        self.assertEqual(metrics.seconds(float("inf")), "inf")
+        self.assertEqual(metrics.seconds(2.5), "2.5s")
+
+    def test_json(self):
+        path = os.path.join(self.tmp, "metrics.json")
+        self.build(path).report(StringIO())
+        with open(path) as fp:
+            snap = json.load(fp)
+        self.assertEqual(os.listdir(self.tmp), ["metrics.json"])
+        self.assertEqual((snap["docs"], snap["duplicates"], snap["failed"], snap["bytes"], snap["queue_depth"]),
+                         (3, 1, 1, 6000, 4))
+        self.assertEqual(snap["parse_seconds"]["count"], 3)
+        self.assertEqual(snap["commit_seconds"]["count"], 1)
+        self.assertEqual(sorted(snap["stage_seconds"]), sorted(STAGES))
+        self.assertEqual(snap["stage_seconds"]["read"], 1.5)
+        self.assertAlmostEqual(sum(snap["stage_share"].values()), 1.0)
+
+    def test_prometheus(self):
+        path = os.path.join(self.tmp, "nabu.prom")
+        self.build(path).report(StringIO())
+        with open(path) as fp:
+            text = fp.read()
+        self.assertEqual(os.listdir(self.tmp), ["nabu.prom"])
+        self.assertTrue(text.endswith("\n"))
+
+        types, samples = {}, {}
+        for line in text.rstrip("\n").split("\n"):
+            if line.startswith("# "):
+                kind, name, rest = line[2:].split(" ", 2)
+                self.assertTrue(kind in ["HELP", "TYPE"], line)
+                if kind == "TYPE":
+                    types[name] = rest
+                else:
+                    # Every metric is documented before its samples
+                    self.assertFalse(any(key[0].startswith(name) for key in samples), line)
+                continue
+            match = SAMPLE.match(line)
+            self.assertTrue(match, line)
+            name, labels, value = match.groups()
+            self.assertTrue(any(name == metric or name.startswith(metric + "_") for metric in types), line)
+            samples[(name, labels)] = float(value)
+
+        self.assertEqual(types["nabu_build_docs"], "counter")
+        self.assertEqual(types["nabu_build_queue_depth"], "gauge")
+        self.assertEqual(types["nabu_build_parse_seconds"], "histogram")
+        self.assertEqual(samples[("nabu_build_docs", None)], 3)
+        self.assertEqual(samples[("nabu_build_failed", None)], 1)
+        self.assertEqual(samples[("nabu_build_bytes", None)], 6000)
+        self.assertEqual(samples[("nabu_build_stage_seconds", '{stage="xml"}')], 1.5)
+        self.assertEqual(len([key for key in samples if key[0] == "nabu_build_stage_seconds"]), len(STAGES))
+
+        # Cumulative buckets, ending in +Inf with the count
+        buckets = [(key[1], value) for key, value in samples.items() if key[0] == "nabu_build_parse_seconds_bucket"]
+        buckets.sort(key=lambda (labels, value): float(labels[5:-2]))
+        self.assertEqual(len(buckets), len(BOUNDS) + 1)
+        self.assertEqual(buckets[-1], ('{le="+Inf"}', 3))
+        self.assertEqual([value for labels, value in buckets], sorted(value for labels, value in buckets))
+        self.assertEqual(samples[("nabu_build_parse_seconds_count", None)], 3)
+        self.assertAlmostEqual(samples[("nabu_build_parse_seconds_sum", None)], 2 * BOUNDS[3] + BOUNDS[13], places=6)
+        self.assertEqual(samples[("nabu_build_commit_seconds_count", None)], 1)
+
+    def test_unwritable(self):
+        logging.disable(logging.ERROR)
+        try:
+            self.build(os.path.join(self.tmp, "missing", "nabu.prom")).report(StringIO())
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
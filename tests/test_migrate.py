@@ -0,0 +1,118 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import cPickle
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from storage import dbgw, migrate
+from storage.dbgw import PdfDb
+from util.str_utils import get_hash
+from tests.test_graph import pdf_graph
+
+
+def old_rows():
+    """ Rows the way schema 0 stored them, pickled features and graphs. pdf-1 and pdf-2 have the same edges, so they
+    are one family.
+    """
+    rows = []
+    graphs = [pdf_graph(30)]
+    v, e = graphs[0]
+    graphs.append(([("other", ["object"])] + v, e))
+    graphs.append(pdf_graph(12, seed=1))
+    graphs.append(([], []))
+    for idx, (v, e) in enumerate(graphs):
+        pv, pe = cPickle.dumps(v, 2), cPickle.dumps(e, 2)
+        ftrs = [float(idx)] * len(dbgw.FEATURE_NAMES)
+        rows.append(("pdf-%d" % idx, get_hash(pv), get_hash(pe), pv, pe, "", cPickle.dumps(ftrs, 2)))
+    return graphs, rows
+
+
+class MigrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tmp, "nabu-graphdb.sqlite")
+        self.graphs, rows = old_rows()
+        conn = sqlite3.connect(self.dbpath)
+        conn.execute("create table %s(%s)" % (PdfDb.table, ",".join(PdfDb.cols)))
+        conn.executemany("insert into %s values (?, ?, ?, ?, ?, ?, ?)" % PdfDb.table,
+                         [row[:3] + tuple(buffer(col) for col in row[3:5]) + (row[5], buffer(row[6])) for row in rows])
+        conn.execute("insert into %s values ('bad', '', '', ?, ?, '', ?)" % PdfDb.table,
+                     (buffer("not a pickle"), buffer("not a pickle"), buffer("not a pickle")))
+        conn.commit()
+        conn.close()
+        self.pdf_db = PdfDb(self.dbpath)
+        self.assertTrue(self.pdf_db.init(self.pdf_db.table, self.pdf_db.cols))
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        self.pdf_db.close()
+        shutil.rmtree(self.tmp)
+
+    def families(self):
+        # The row that could not be read is migrated to an empty graph, the family of any other empty graph
+        rows = self.pdf_db.query("select pdf_id, e_md5 from %s where pdf_id != 'bad' order by pdf_id" % PdfDb.table, ())
+        groups = {}
+        for pdf_id, e_md5 in rows:
+            groups.setdefault(e_md5, []).append(pdf_id)
+        return sorted(groups.values())
+
+    def test_migrate(self):
+        self.assertEqual(self.pdf_db.schema_version(), 0)
+        self.assertTrue(self.pdf_db.outdated())
+        before = self.families()
+        self.assertTrue(migrate.migrate(self.pdf_db))
+        self.assertEqual(self.pdf_db.schema_version(), dbgw.SCHEMA_VERSION)
+        self.assertFalse(self.pdf_db.outdated())
+        self.assertEqual(self.families(), before)
+        for idx, (v, e) in enumerate(self.graphs):
+            name, v_md5, e_md5, verts, edges, ftrs = self.pdf_db.load_pdf_graph("pdf-%d" % idx)
+            self.assertEqual((verts, edges), (v, e))
+            self.assertEqual(list(ftrs), [float(idx)] * len(dbgw.FEATURE_NAMES))
+            # The same as a fresh build stores
+            self.assertEqual((v_md5, e_md5), PdfDb.pack_graph(v, e)[:2])
+        name, v_md5, e_md5, verts, edges, ftrs = self.pdf_db.load_pdf_graph("bad")
+        self.assertEqual((verts, edges, len(ftrs)), ([], [], 0))
+
+    def test_rerun(self):
+        self.assertTrue(migrate.migrate(self.pdf_db))
+        cmd = "select * from %s order by pdf_id" % PdfDb.table
+        rows = [map(str, row) for row in self.pdf_db.query(cmd, ())]
+        self.assertTrue(migrate.migrate(self.pdf_db))
+        self.assertEqual([map(str, row) for row in self.pdf_db.query(cmd, ())], rows)
+
+    def test_failed_step_rolls_back(self):
+        def broken(pdf_db, conn):
+            conn.execute("update %s set js='changed'" % pdf_db.table)
+            raise ValueError("broken step")
+        migrations = migrate.MIGRATIONS
+        migrate.MIGRATIONS = migrations[:1] + [(2, broken)]
+        try:
+            self.assertFalse(migrate.migrate(self.pdf_db))
+        finally:
+            migrate.MIGRATIONS = migrations
+        # The first step is kept, the broken one left nothing behind
+        self.assertEqual(self.pdf_db.schema_version(), 1)
+        self.assertEqual(self.pdf_db.query("select count(*) from %s where js='changed'" % PdfDb.table, ()), [(0,)])
+        self.assertTrue(migrate.migrate(self.pdf_db))
+        self.assertEqual(self.pdf_db.schema_version(), dbgw.SCHEMA_VERSION)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import unittest
+
+import networkx
+import numpy
+
+from process import netsimile
+from process.netsimile import adjacency, blocks, random_graphs, validate
+from process.pdf import PDF
+
+"""
+Node features per node, as the networkx implementation computed them before process.netsimile and GraphContext
+"""
+NUMFEATURES = 7
+
+
+def baseline_graph_features(v, e):
+    """ PDF.get_graph_features_networkx as it was before it was optimized, kept as it was so the tests have an oracle
+    that does not change along with the code under test
+    """
+    graph = networkx.Graph()
+    for label, attrs in v:
+        graph.add_node(label, contains=attrs)
+    for edge in e:
+        graph.add_edge(*edge)
+
+    """
+    Transforms matrix from paper, so that each row is a feature, and each col is a node
+    """
+    features = [[] for i in range(NUMFEATURES)]
+    for node in graph.nodes_iter():
+        for idx, ftr in enumerate(baseline_node_features(graph, node)):
+            features[idx].append(ftr)
+
+    return features
+
+
+def baseline_node_features(graph, node):
+    """ PDF.get_node_features as it was before it was optimized """
+    neighbors = graph.neighbors(node)
+
+    degree = graph.degree(node)
+
+    cl_coef = networkx.clustering(graph, node)
+
+    nbrs_two_hops = 0.0
+    nbrs_cl_coef = 0.0
+    for neighbor in neighbors:
+        nbrs_two_hops += graph.degree(neighbor)
+        nbrs_cl_coef += networkx.clustering(graph, neighbor)
+
+    try:
+        avg_two_hops = nbrs_two_hops / degree
+        avg_cl_coef = nbrs_cl_coef / degree
+    except ZeroDivisionError:
+        avg_two_hops = 0.0
+        avg_cl_coef = 0.0
+
+    egonet = networkx.ego_graph(graph, node)
+
+    ego_size = egonet.size()
+
+    ego_out = 0
+    ego_nbrs = set()
+    for ego_node in egonet:
+        for nbr in graph.neighbors(ego_node):
+            if nbr not in neighbors:
+                ego_out += 1
+                ego_nbrs.add(nbr)
+
+    return [degree, cl_coef, avg_two_hops, avg_cl_coef, ego_size, ego_out, len(ego_nbrs)]
+
+
+def hub_graph(pages):
+    """ One hub linked to every page, and some pages linked to the next, like a page tree with a shared resource """
+    v = [("hub", ["object"])] + [("p%d" % i, ["object"]) for i in xrange(pages)]
+    e = [("hub", "p%d" % i) for i in xrange(pages)] + [("p%d" % i, "p%d" % (i + 1)) for i in xrange(0, pages - 1, 7)]
+    return v, e
+
+
+class NetSimileTest(unittest.TestCase):
+    """
+    graph_features, and PDF.get_graph_features_networkx, have to give exactly what the original networkx
+    implementation gives, down to the bit
+    """
+
+    def setUp(self):
+        self.pdf = PDF("")
+
+    def assertSame(self, pairs):
+        pairs = list(pairs)
+        graphs, bad, slow, fast = validate(pairs, baseline_graph_features, self.pdf.aggregate_ftr_matrix)
+        self.assertTrue(graphs)
+        self.assertEqual(bad, [])
+        for name, v, e in pairs:
+            expected = baseline_graph_features(v, e)
+            got = self.pdf.get_graph_features_networkx(v, e)
+            self.assertEqual([map(repr, ftr) for ftr in got], [map(repr, ftr) for ftr in expected], name)
+
+    def test_random_graphs(self):
+        self.assertSame(random_graphs(200))
+
+    def test_pdf_shaped(self):
+        v = [("PDF", ["start"]), ("1", ["object", "dict", "ref"]), ("2", ["object", "list", "ref", "ref"]),
+             ("3", ["object", "stream"]), ("4", ["object"]), ("missing", ["missing_target"])]
+        e = [("PDF", "1"), ("1", "2"), ("2", "3"), ("2", "missing"), ("3", "3"), ("2", "3")]
+        self.assertSame([("pdf", v, e)])
+
+    def test_hub(self):
+        v, e = hub_graph(500)
+        self.assertSame([("hub", v, e)])
+
+    def test_small_blocks(self):
+        # Blocks of a row or a few rows at a time give the same features as one block
+        block_entries = netsimile.BLOCK_ENTRIES
+        try:
+            for cap in [1, 3, 50]:
+                netsimile.BLOCK_ENTRIES = cap
+                self.assertSame(random_graphs(50, seed=cap))
+                v, e = hub_graph(100)
+                self.assertSame([("hub", v, e)])
+        finally:
+            netsimile.BLOCK_ENTRIES = block_entries
+
+    def test_node_order(self):
+        # Nodes and neighbours come in the order networkx iterates them, so sums over neighbours round the same way
+        for name, v, e in random_graphs(20, seed=1):
+            graph = networkx.Graph()
+            for label, attrs in v:
+                graph.add_node(label, contains=attrs)
+            graph.add_edges_from(e)
+            labels, matrix = adjacency(v, e)
+            self.assertEqual(labels, graph.nodes())
+            for idx, label in enumerate(labels):
+                nbrs = matrix.indices[matrix.indptr[idx]:matrix.indptr[idx + 1]]
+                self.assertEqual([labels[nbr] for nbr in nbrs], graph.neighbors(label))
+
+
+class BlocksTest(unittest.TestCase):
+
+    def test_cap(self):
+        self.assertEqual(list(blocks(numpy.array([1, 5, 2, 9, 1, 1]), 6)), [(0, 2), (2, 3), (3, 4), (4, 6)])
+
+    def test_rows_over_the_cap(self):
+        self.assertEqual(list(blocks(numpy.array([10, 10, 1]), 6)), [(0, 1), (1, 2), (2, 3)])
+
+    def test_covers_every_row(self):
+        work = numpy.random.RandomState(0).randint(0, 100, 1000)
+        for cap in [1, 50, 1000, 10 ** 6]:
+            parts = list(blocks(work, cap))
+            self.assertEqual([lo for lo, hi in parts], [0] + [hi for lo, hi in parts[:-1]])
+            self.assertEqual(parts[-1][1], len(work))
+            for lo, hi in parts:
+                self.assertTrue(hi - lo == 1 or work[lo:hi].sum() <= cap)
+
+    def test_empty(self):
+        self.assertEqual(list(blocks(numpy.zeros(0, dtype=numpy.int64), 6)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
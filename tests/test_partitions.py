@@ -0,0 +1,52 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import unittest
+
+from main import PARTITION_SPLIT, partitions
+
+
+class PartitionsTest(unittest.TestCase):
+
+    def check(self, num_rows, num_procs, min_rows):
+        parts = list(partitions(num_rows, num_procs, min_rows))
+        # Consecutive, covering every row once
+        self.assertEqual([start for start, end in parts], [0] + [end for start, end in parts[:-1]] if parts else [])
+        self.assertEqual(parts[-1][1] if parts else 0, num_rows)
+        sizes = [end - start for start, end in parts]
+        self.assertTrue(all(size > 0 for size in sizes))
+        # Each a share of what is left, shrinking to min_rows; only the last may be smaller
+        self.assertTrue(all(size >= min_rows for size in sizes[:-1]))
+        self.assertEqual(sizes[:-1], sorted(sizes[:-1], reverse=True))
+        return sizes
+
+    def test_guided(self):
+        sizes = self.check(100000, 4, 100)
+        self.assertEqual(sizes[0], 100000 // (PARTITION_SPLIT * 4))
+        self.assertEqual(sizes[-2], 100)
+        self.assertLess(len(sizes), 100000 // 100)
+
+    def test_shapes(self):
+        for num_rows in [0, 1, 7, 99, 100, 101, 1023, 4096, 12345]:
+            for num_procs in [1, 2, 3, 8]:
+                for min_rows in [1, 10, 1024]:
+                    self.check(num_rows, num_procs, min_rows)
+
+    def test_small(self):
+        self.assertEqual(list(partitions(0, 4, 10)), [])
+        self.assertEqual(list(partitions(5, 4, 10)), [(0, 5)])
+        self.assertEqual(list(partitions(25, 1, 10)), [(0, 10), (10, 20), (20, 25)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+
+import numpy
+
+from storage.results import ResultWriter, read_columnar
+
+Families = namedtuple("Families", ["families", "candidates"])
+
+
+class ResultWriterTest(unittest.TestCase):
+    """
+    ResultWriter writes every block it is given, or fails the run with the first error instead of dropping blocks
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.families = Families(["fam-%d" % (row % 3) for row in xrange(10)], ["pdf-%d" % row for row in xrange(10)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def writer(self, path, fmt):
+        writer = ResultWriter(path, fmt)
+        writer.families = self.families
+        writer.open()
+        return writer
+
+    def put_blocks(self, put, count):
+        for block in xrange(count):
+            rows = numpy.arange(10, dtype=numpy.int64)
+            put(["subject-%d" % block], numpy.zeros(10, dtype=numpy.intp), rows, rows / 10.0)
+
+    def test_columnar(self):
+        path = os.path.join(self.tmp, "scores")
+        writer = self.writer(path, "columnar")
+        self.put_blocks(writer.put, 3)
+        writer.drain()
+        writer.close()
+        self.assertEqual(writer.error, None)
+        with open(path, "rb") as fp:
+            blocks = list(read_columnar(fp))
+        self.assertEqual(len(blocks), 3)
+        self.assertEqual(list(blocks[2]["subject"]), ["subject-2"] * 10)
+        self.assertEqual(list(blocks[2]["candidate"]), self.families.candidates)
+        self.assertEqual(list(blocks[2]["score"]), [row / 10.0 for row in xrange(10)])
+
+    @unittest.skipUnless(os.path.exists("/dev/full"), "needs /dev/full")
+    def test_full(self):
+        logging.disable(logging.ERROR)
+        try:
+            for fmt in ["csv", "csv.gz", "columnar"]:
+                writer = self.writer("/dev/full", fmt)
+                # More than the file buffer, so some write fails before the flush. Put as the scoring workers do,
+                # straight on the queue, and every block is still taken off it.
+                self.put_blocks(lambda *block: writer.queue.put(block), 200)
+                self.assertRaises(IOError, writer.drain)
+                error = writer.error
+                self.assertTrue(isinstance(error, IOError), fmt)
+                self.assertRaises(IOError, self.put_blocks, writer.put, 1)
+                self.assertRaises(IOError, writer.close)
+                self.assertTrue(writer.error is error, fmt)
+        finally:
+            logging.disable(logging.NOTSET)
+
+
+if __name__ == "__main__":
+    unittest.main()
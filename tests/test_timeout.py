@@ -0,0 +1,152 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+from functools import partial
+
+import matplotlib
+matplotlib.use("Agg")
+
+import main
+from lib.parse.pdfminer.pdfdocument import PDFXRef
+from process.parsers import pdfminer
+from storage import dbgw
+from storage.writer import Failed, RowQueue, Running
+from tests.test_graph_builder import make_pdf
+
+"""
+Build timeout in seconds for the tests, and how long a slow parse would take without it
+"""
+TIMEOUT = 0.05
+SLOW = 2.0
+
+
+def spin(seconds):
+    """ Busy wait, so the alarm goes off in Python code rather than in a sleep """
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+def slow_parse(path):
+    spin(SLOW)
+
+
+def swallowing_parse(path):
+    # Like the catch-all handlers in some parsers, it carries on whatever went wrong
+    try:
+        spin(SLOW)
+    except BaseException:
+        pass
+    spin(SLOW)
+
+
+def cleanup_error_parse(path):
+    # Like cleanup code that fails on the half-built state the alarm left behind
+    try:
+        spin(SLOW)
+    finally:
+        len(None)
+
+
+def failing_parse(path):
+    raise ValueError("bad sample")
+
+
+class ParseTimeoutTest(unittest.TestCase):
+    """
+    A sample that runs out of time in main.parse_row is recorded as a timeout, whatever the parser does with the alarm
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.outputdir = pdfminer.OUTPUTDIR
+        pdfminer.OUTPUTDIR = self.tmp
+        self.path = os.path.join(self.tmp, "sample.pdf")
+        make_pdf(self.path, {1: "<< /Type /Catalog /Pages 2 0 R >>", 2: "<< /Type /Pages /Kids [] /Count 0 >>"})
+        self.handler = signal.signal(signal.SIGALRM, main.alarm)
+        main.ROWS = RowQueue()
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        main.ROWS = None
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self.handler)
+        pdfminer.OUTPUTDIR = self.outputdir
+        shutil.rmtree(self.tmp)
+
+    def run_row(self, pfunc, timeout=TIMEOUT):
+        started = time.time()
+        path, status, size, seconds, stages = main.parse_row(pfunc, (self.path, "md5"), timeout=timeout)
+        self.assertTrue(time.time() - started < SLOW)
+        self.assertIsInstance(main.ROWS.get()[2], Running)
+        row = main.ROWS.get()[2]
+        self.assertEqual(main.ROWS.qsize(), 0)
+        if status:
+            self.assertIsInstance(row, Failed)
+            self.assertEqual(row.status, status)
+        return status, row
+
+    def test_slow_parse(self):
+        status, row = self.run_row(slow_parse)
+        self.assertEqual(status, dbgw.TIMEOUT)
+        self.assertEqual(row.error, "timed out after %ss" % TIMEOUT)
+
+    def test_swallowed_alarm(self):
+        self.assertEqual(self.run_row(swallowing_parse)[0], dbgw.TIMEOUT)
+
+    def test_error_after_alarm(self):
+        self.assertEqual(self.run_row(cleanup_error_parse)[0], dbgw.TIMEOUT)
+
+    def test_failure(self):
+        status, row = self.run_row(failing_parse)
+        self.assertEqual(status, dbgw.FAILED)
+        self.assertEqual(row.error, "ValueError: bad sample")
+        # The flag of an earlier timeout does not stick
+        self.run_row(slow_parse)
+        self.assertEqual(self.run_row(failing_parse)[0], dbgw.FAILED)
+
+    def test_pdfminer(self):
+        status, row = self.run_row(partial(pdfminer.parse_and_hash, graph_only=True))
+        self.assertEqual(status, None)
+        get_pos = PDFXRef.get_pos
+
+        def slow_get_pos(xref, objid):
+            # Slow only where PDFMinerParser looks up the location of an object for the XML
+            if sys._getframe(1).f_code.co_name == "get_obj_loc":
+                spin(SLOW / 4)
+            return get_pos(xref, objid)
+
+        # A one-shot alarm, the parser has to let it through the first time
+        repeat = main.ALARM_REPEAT
+        PDFXRef.get_pos = slow_get_pos
+        main.ALARM_REPEAT = 0
+        try:
+            for graph_only in [True, False]:
+                status, row = self.run_row(partial(pdfminer.parse_and_hash, graph_only=graph_only))
+                self.assertEqual(status, dbgw.TIMEOUT)
+        finally:
+            PDFXRef.get_pos = get_pos
+            main.ALARM_REPEAT = repeat
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from process.similarity import canberra_rows
+from process.vptree import VPTree
+
+
+def feature_matrix(rows, seed=0):
+    """ Rows shaped like family signatures: clusters of nearby vectors, with some features 0 in both u and v """
+    rng = numpy.random.RandomState(seed)
+    centers = rng.exponential(10.0, (8, 35))
+    features = centers[rng.randint(0, len(centers), rows)] * rng.uniform(0.8, 1.2, (rows, 35))
+    features[:, ::7] = 0.0
+    features[rng.rand(rows) < 0.1, 3] *= -1
+    return features
+
+
+def brute_force(features, q, k=0, radius=0):
+    dists = canberra_rows(q, features)
+    pairs = sorted((float(d), int(row)) for row, d in enumerate(dists) if not radius or d <= radius)
+    return pairs[:k] if k else pairs
+
+
+class VPTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.features = feature_matrix(700)
+        self.tree = VPTree.build(self.features, leaf_size=16)
+        self.queries = feature_matrix(20, seed=1)
+
+    def test_covers_every_row(self):
+        self.assertEqual(sorted(self.tree.order.tolist()), range(len(self.features)))
+        self.assertEqual(self.tree.tail, 0)
+        self.assertGreater(self.tree.depth(), 3)
+
+    def test_top_k(self):
+        for q in self.queries:
+            self.assertEqual(self.tree.search(q, k=10), brute_force(self.features, q, k=10))
+
+    def test_radius(self):
+        for q in self.queries:
+            radius = brute_force(self.features, q)[30][0]
+            self.assertEqual(self.tree.search(q, radius=radius), brute_force(self.features, q, radius=radius))
+
+    def test_top_k_within_radius(self):
+        for q in self.queries:
+            radius = brute_force(self.features, q)[5][0]
+            self.assertEqual(self.tree.search(q, k=10, radius=radius),
+                             brute_force(self.features, q, k=10, radius=radius))
+
+    def test_prunes(self):
+        self.tree.search(self.features[0], k=1)
+        self.assertLess(self.tree.stats["distances"], len(self.features))
+        self.assertGreater(self.tree.pruned(), 0.0)
+
+    def test_checks_bound_the_search(self):
+        exact = dict((row, dist) for dist, row in brute_force(self.features, self.queries[0]))
+        found = self.tree.search(self.queries[0], k=10, checks=2)
+        self.assertLessEqual(self.tree.stats["leaves"], 2)
+        self.assertTrue(found)
+        for dist, row in found:
+            self.assertEqual(dist, exact[row])
+
+    def test_tail(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "tree.npz")
+            self.tree.save(path, generation=numpy.array(1))
+            grown = numpy.vstack([self.features, feature_matrix(50, seed=2)])
+            tree, extra = VPTree.load(path, grown)
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(tree.tail, 50)
+        self.assertEqual(int(extra["generation"]), 1)
+        for q in self.queries:
+            self.assertEqual(tree.search(q, k=10), brute_force(grown, q, k=10))
+        self.assertEqual(tree.search(grown[-1], k=1), [(0.0, len(grown) - 1)])
+
+    def test_empty(self):
+        tree = VPTree.build(numpy.zeros((0, 35)))
+        self.assertEqual(tree.search(self.queries[0], k=5), [])
+
+    def test_wrong_width(self):
+        self.assertRaises(ValueError, self.tree.search, numpy.zeros(34), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import cPickle
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from multiprocessing import Process
+
+from storage import dbgw
+from storage.dbgw import JobDb, PdfDb
+from storage.spill import Spill, discard_row, remove_spills, spill_prefix, spill_row, unspill_row
+from storage.writer import Alias, BatchWriter, Failed, Finished, RowQueue, Running, write_rows
+from tests.test_ftrcache import make_row
+
+
+class WriterTest(unittest.TestCase):
+    """
+    The storage writer of a build: rows, aliases of stored content and failures, and the job statuses they leave
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pdf_dbpath = os.path.join(self.tmp, "nabu-graphdb.sqlite")
+        self.job_dbpath = os.path.join(self.tmp, "nabu-jobs.sqlite")
+        self.pdf_db, self.job_db = self.open_dbs()
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        self.pdf_db.close()
+        self.job_db.close()
+        shutil.rmtree(self.tmp)
+
+    def open_dbs(self):
+        pdf_db, job_db = PdfDb(self.pdf_dbpath), JobDb(self.job_dbpath)
+        self.assertTrue(pdf_db.init(pdf_db.table, pdf_db.cols) and job_db.init(job_db.table, job_db.cols))
+        return pdf_db, job_db
+
+    def jobs(self):
+        return dict((path, (status, error)) for path, status, error in
+                    self.job_db.query("select sample_path, status, error from %s where job_name='job'" % JobDb.table,
+                                      ()))
+
+    def pdfs(self):
+        return dict(self.pdf_db.query("select pdf_id, e_md5 from %s" % PdfDb.table, ()))
+
+    def test_alias(self):
+        writer = BatchWriter(self.pdf_db, self.job_db, "job", batch_size=10)
+        # Nothing to copy before the content is stored
+        self.assertFalse(writer.alias("/s/b.pdf", "md5-a", "b.pdf"))
+        writer.save("/s/a.pdf", make_row("a.pdf", "fam-a", 1), "md5-a")
+        # Stored in the open batch is good enough
+        self.assertTrue(writer.alias("/s/b.pdf", "md5-a", "b.pdf"))
+        self.assertTrue(writer.flush())
+        self.assertTrue(writer.alias("/s/c.pdf", "md5-a", "c.pdf"))
+        self.assertTrue(writer.flush())
+        self.assertEqual(self.pdfs(), {"a.pdf": "fam-a", "b.pdf": "fam-a", "c.pdf": "fam-a"})
+        self.assertEqual(self.jobs(), {"/s/a.pdf": (dbgw.DONE, None), "/s/b.pdf": (dbgw.DONE, None),
+                                       "/s/c.pdf": (dbgw.DONE, None)})
+        self.assertEqual(self.pdf_db.lookup_content("md5-a"), "a.pdf")
+        self.assertEqual(writer.batches, 2)
+
+    def test_fail(self):
+        writer = BatchWriter(self.pdf_db, self.job_db, "job", batch_size=10)
+        writer.running("/s/a.pdf", time.time() - 5)
+        writer.running("/s/b.pdf", time.time())
+        writer.fail("/s/a.pdf", "timed out after 5s", dbgw.TIMEOUT)
+        writer.fail("/s/c.pdf", "ValueError: bad")
+        # Nothing saved, the statuses are committed all the same
+        self.assertTrue(writer.flush())
+        self.assertEqual(self.pdfs(), {})
+        self.assertEqual(self.jobs(), {"/s/a.pdf": (dbgw.TIMEOUT, "timed out after 5s"),
+                                       "/s/b.pdf": (dbgw.RUNNING, None), "/s/c.pdf": (dbgw.FAILED, "ValueError: bad")})
+        durations = dict(self.job_db.query("select sample_path, duration from %s" % JobDb.table, ()))
+        self.assertTrue(durations["/s/a.pdf"] >= 5)
+        self.assertEqual(durations["/s/c.pdf"], None)
+        self.assertEqual(writer.started.keys(), ["/s/b.pdf"])
+
+    def test_batches(self):
+        writer = BatchWriter(self.pdf_db, self.job_db, "job", batch_size=2)
+        for idx in xrange(5):
+            writer.save("/s/%d.pdf" % idx, make_row("%d.pdf" % idx, "fam-%d" % idx, idx))
+        self.assertEqual(writer.batches, 2)
+        self.assertEqual(len(self.jobs()), 4)
+        self.assertTrue(writer.flush())
+        self.assertEqual(len(self.jobs()), 5)
+        self.assertEqual(len(self.pdfs()), 5)
+
+    def write(self, rows, complete=True):
+        """ Run write_rows in its own process, as a build does """
+        self.pdf_db.close()
+        self.job_db.close()
+        queue = RowQueue()
+        writer = Process(target=write_rows, args=(queue, self.pdf_dbpath, self.job_dbpath, "job", 2))
+        writer.start()
+        for row in rows + [(None, None, Finished(complete))]:
+            queue.put(row)
+        writer.join()
+        self.pdf_db, self.job_db = self.open_dbs()
+        return writer.exitcode
+
+    def test_write_rows(self):
+        prefix = spill_prefix(self.tmp)
+        started = time.time()
+        rows = [("/s/a.pdf", "md5-a", Running(started)),
+                ("/s/b.pdf", "md5-a", Alias("b.pdf")),
+                ("/s/c.pdf", "md5-c", Running(started)),
+                ("/s/d.pdf", "md5-d", Running(started)),
+                ("/s/a.pdf", "md5-a", spill_row(make_row("a.pdf", "fam-a", 1), prefix, limit=4)),
+                ("/s/e.pdf", "md5-a", Alias("e.pdf")),
+                ("/s/f.pdf", "md5-f", Alias("f.pdf")),
+                ("/s/c.pdf", "md5-c", Failed("ValueError: bad", dbgw.FAILED))]
+        self.assertEqual(self.write(rows), 0)
+        self.assertEqual(self.pdfs(), {"a.pdf": "fam-a", "b.pdf": "fam-a", "e.pdf": "fam-a"})
+        self.assertEqual(self.jobs(), {"/s/a.pdf": (dbgw.DONE, None), "/s/b.pdf": (dbgw.DONE, None),
+                                       "/s/c.pdf": (dbgw.FAILED, "ValueError: bad"),
+                                       "/s/d.pdf": (dbgw.FAILED, "its row never reached the storage writer"),
+                                       "/s/e.pdf": (dbgw.DONE, None)})
+        # The spilled fields were read back, and their files removed
+        expected = make_row("a.pdf", "fam-a", 1)
+        row = self.pdf_db.query("select vertices, edges, features from %s where pdf_id='a.pdf'" % PdfDb.table, ())[0]
+        self.assertEqual(map(str, row), [expected.vertices, expected.edges, expected.features])
+        self.assertEqual(remove_spills(prefix), 0)
+
+    def test_write_rows_terminated(self):
+        rows = [("/s/a.pdf", "md5-a", Running(time.time())), ("/s/b.pdf", "md5-b", Running(time.time())),
+                ("/s/b.pdf", "md5-b", make_row("b.pdf", "fam-b", 2))]
+        self.assertEqual(self.write(rows, complete=False), 0)
+        # Left for the next resume to redo
+        self.assertEqual(self.jobs(), {"/s/a.pdf": (dbgw.RUNNING, None), "/s/b.pdf": (dbgw.DONE, None)})
+
+
+class SpillTest(unittest.TestCase):
+    """
+    Big fields of a row go through spill files and come back byte for byte, leaving no file behind
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.prefix = spill_prefix(self.tmp)
+        self.row = make_row("a.pdf", "fam-a", 1)._replace(vertices="".join(map(chr, xrange(256))) * 64)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        spilled = spill_row(self.row, self.prefix, limit=1024)
+        self.assertTrue(isinstance(spilled.vertices, Spill))
+        self.assertEqual(spilled[:3] + spilled[4:], self.row[:3] + self.row[4:])
+        self.assertEqual(len(os.listdir(self.tmp)), 1)
+        self.assertTrue(os.listdir(self.tmp)[0].startswith(os.path.basename(self.prefix)))
+        # It goes through the queue as a handle, not the field
+        spilled = cPickle.loads(cPickle.dumps(spilled, 2))
+        self.assertTrue(len(cPickle.dumps(spilled, 2)) < 1024)
+        self.assertEqual(unspill_row(spilled), self.row)
+        self.assertEqual(os.listdir(self.tmp), [])
+        # Only once
+        self.assertRaises(IOError, unspill_row, spilled)
+
+    def test_small_fields(self):
+        self.assertEqual(spill_row(self.row, self.prefix), self.row)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_short_file(self):
+        spilled = spill_row(self.row, self.prefix, limit=1024)
+        with open(spilled.vertices.path, "r+b") as fp:
+            fp.truncate(10)
+        self.assertRaises(IOError, unspill_row, spilled)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_discard(self):
+        discard_row(spill_row(self.row, self.prefix, limit=1024))
+        self.assertEqual(os.listdir(self.tmp), [])
+        # Whatever a killed worker left behind
+        for idx in xrange(4):
+            spill_row(self.row, self.prefix, limit=1024)
+        self.assertEqual(remove_spills(self.prefix), 4)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_spill_dir_missing(self):
+        logging.disable(logging.WARNING)
+        try:
+            prefix = spill_prefix(os.path.join(self.tmp, "missing"))
+            self.assertEqual(spill_row(self.row, prefix, limit=1024), self.row)
+        finally:
+            logging.disable(logging.NOTSET)
+
+
+if __name__ == "__main__":
+    unittest.main()
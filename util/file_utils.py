@@ -0,0 +1,66 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import logging
+import sys
+
+from lib.scandir import scandir
+
+FS_ENCODING = sys.getfilesystemencoding() or "utf-8"
+
+
+def parse_extensions(exts):
+    """
+
+    :param exts: comma separated extensions, with or without the dot, e.g. "pdf,.bin"
+    :return: tuple of lower case extensions with the dot, for str.endswith
+    """
+    if not exts:
+        return ()
+    return tuple([".%s" % ext.strip().lstrip(".").lower() for ext in exts.split(",") if ext.strip()])
+
+
+def walk_samples(top, exts=(), min_size=0, max_size=0, followlinks=False):
+    """ Walk a directory tree for sample files, as lazily as os.walk but without its stat of every entry. File type
+    comes from the d_type scandir reads along with the names, and the extension from the name, so a file is only
+    stat'ed when there are size limits and it passed the extension filter.
+
+    :param exts: from parse_extensions, empty for any extension
+    :param min_size: skip files smaller than this many bytes
+    :param max_size: skip files larger than this many bytes, 0 for no limit
+    :param followlinks: descend into symlinked directories
+    :return: generator of file paths
+    """
+    stat_needed = min_size > 0 or max_size > 0
+    todo = [top]
+    while todo:
+        directory = todo.pop()
+        try:
+            for entry in scandir(directory):
+                if entry.is_dir():
+                    if followlinks or not entry.is_symlink():
+                        todo.append(entry.path)
+                    continue
+                if exts and not entry.name.lower().endswith(exts):
+                    continue
+                if not entry.is_file():
+                    continue
+                if stat_needed:
+                    size = entry.stat().st_size
+                    if size < min_size or (max_size and size > max_size):
+                        continue
+                path = entry.path
+                yield path.encode(FS_ENCODING) if isinstance(path, unicode) else path
+        except (OSError, UnicodeError) as e:
+            # The rest of the directory is lost too, the scandir generator cannot be resumed after an error
+            logging.warning("file_utils.walk_samples error listing %s: %s" % (directory, e))
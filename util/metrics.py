@@ -0,0 +1,247 @@
+#  Copyright 2011-2015 by Carnegie Mellon University
+#
+#  NO WARRANTY
+#
+#  THIS CARNEGIE MELLON UNIVERSITY AND SOFTWARE ENGINEERING INSTITUTE
+#  MATERIAL IS FURNISHED ON AN "AS-IS" BASIS.  CARNEGIE MELLON
+#  UNIVERSITY MAKES NO WARRANTIES OF ANY KIND, EITHER EXPRESSED OR
+#  IMPLIED, AS TO ANY MATTER INCLUDING, BUT NOT LIMITED TO, WARRANTY
+#  OF FITNESS FOR PURPOSE OR MERCHANTABILITY, EXCLUSIVITY, OR RESULTS
+#  OBTAINED FROM USE OF THE MATERIAL.  CARNEGIE MELLON UNIVERSITY
+#  DOES NOT MAKE ANY WARRANTY OF ANY KIND WITH RESPECT TO FREEDOM
+#  FROM PATENT, TRADEMARK, OR COPYRIGHT INFRINGEMENT.
+
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+
+
+"""
+Stages a sample goes through in a build worker, in order. read opens the document and its xref tables, tokenize parses
+its objects, xml builds the element tree from them, graph and features turn the tree into the feature vector, xml_file
+writes the tree to xml-output and row serializes and hashes what is stored.
+"""
+STAGES = ["read", "tokenize", "xml", "graph", "features", "xml_file", "row"]
+
+"""
+Upper bounds in seconds of the latency histogram buckets, 10 per decade from 1ms to about 2 hours
+"""
+BOUNDS = [0.001 * 10 ** (i / 10.0) for i in range(70)]
+
+"""
+Seconds between stats lines and metrics file updates by default
+"""
+METRICS_EVERY = 10
+
+"""
+Seconds spent in each stage by this process since the last take_stages()
+"""
+_stages = {}
+
+
+def add_stage(name, seconds):
+    _stages[name] = _stages.get(name, 0.0) + seconds
+
+
+class stage(object):
+    """
+    Times a block as one of STAGES, e.g. "with stage('graph'):"
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        add_stage(self.name, time.time() - self.start)
+        return False
+
+
+def take_stages():
+    """
+
+    :return: dict of stage to seconds since the last call
+    """
+    global _stages
+    stages, _stages = _stages, {}
+    return stages
+
+
+class Histogram(object):
+    """
+    Latencies counted in BOUNDS buckets. The counts can live in a multiprocessing.Array of len(BOUNDS) + 2 doubles, so
+    another process can observe into it: the buckets, then one for anything slower, then the sum of all observations.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = counts if counts is not None else [0.0] * (len(BOUNDS) + 2)
+
+    @staticmethod
+    def shared():
+        """
+
+        :return: counts for Histogram() to share between processes
+        """
+        from multiprocessing import Array
+        return Array('d', len(BOUNDS) + 2, lock=False)
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BOUNDS, seconds)] += 1
+        self.counts[-1] += seconds
+
+    @property
+    def count(self):
+        return int(sum(self.counts[:-1]))
+
+    @property
+    def total(self):
+        return self.counts[-1]
+
+    def percentile(self, q):
+        """
+
+        :param q: 0 to 100
+        :return: upper bound of the bucket holding the q-th percentile, None if nothing was observed
+        """
+        counts = self.counts[:-1]
+        target = sum(counts) * q / 100.0
+        if not target:
+            return None
+        seen = 0
+        for idx, cnt in enumerate(counts):
+            seen += cnt
+            if seen >= target:
+                return BOUNDS[idx] if idx < len(BOUNDS) else float("inf")
+        return float("inf")
+
+    def summary(self):
+        return {"count": self.count, "sum": self.total,
+                "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99)}
+
+    def prometheus(self, name, help_):
+        lines = ["# HELP %s %s" % (name, help_), "# TYPE %s histogram" % name]
+        seen = 0
+        for bound, cnt in zip(BOUNDS, self.counts):
+            seen += cnt
+            lines.append('%s_bucket{le="%g"} %d' % (name, bound, seen))
+        lines.append('%s_bucket{le="+Inf"} %d' % (name, self.count))
+        lines.append("%s_sum %f" % (name, self.total))
+        lines.append("%s_count %d" % (name, self.count))
+        return lines
+
+
+class BuildMetrics(object):
+    """
+    Throughput and latency of a build, fed by the parent from what the workers send back. Reports a stats line every
+    `every` seconds and, with a path, rewrites a metrics file at the same time: Prometheus text format if the path
+    ends in .prom, JSON otherwise.
+    """
+
+    def __init__(self, path=None, every=METRICS_EVERY, commits=None):
+        """
+
+        :param commits: shared counts the storage writer observes its commit latencies into, from Histogram.shared
+        """
+        self.path = path
+        self.every = every
+        self.started = self.reported = time.time()
+        self.docs = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.bytes = 0
+        self.queue_depth = 0
+        self.parse = Histogram()
+        self.commits = Histogram(commits)
+        self.stages = dict((name, 0.0) for name in STAGES)
+
+    def add(self, status, size, seconds, stages):
+        """ Account for a sample a worker is done with """
+        self.docs += 1
+        if status:
+            self.failed += 1
+        self.bytes += size
+        self.parse.observe(seconds)
+        for name, spent in stages.items():
+            self.stages[name] = self.stages.get(name, 0.0) + spent
+
+    def due(self):
+        return self.every > 0 and time.time() - self.reported >= self.every
+
+    def snapshot(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        staged = sum(self.stages.values())
+        return {
+            "elapsed": elapsed,
+            "docs": self.docs,
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+            "bytes": self.bytes,
+            "docs_per_sec": (self.docs + self.duplicates) / elapsed,
+            "bytes_per_sec": self.bytes / elapsed,
+            "queue_depth": self.queue_depth,
+            "parse_seconds": self.parse.summary(),
+            "commit_seconds": self.commits.summary(),
+            "stage_seconds": dict(self.stages),
+            "stage_share": dict((name, spent / staged if staged else 0.0) for name, spent in self.stages.items()),
+        }
+
+    def line(self, snap):
+        parse, commit = snap["parse_seconds"], snap["commit_seconds"]
+        share = snap["stage_share"]
+        return "%d docs %.1f/s %.2f MB/s | parse p50 %s p95 %s p99 %s | commit p95 %s | queue %d | %s" % (
+            snap["docs"] + snap["duplicates"], snap["docs_per_sec"], snap["bytes_per_sec"] / (1 << 20),
+            seconds(parse["p50"]), seconds(parse["p95"]), seconds(parse["p99"]), seconds(commit["p95"]),
+            snap["queue_depth"], " ".join(["%s %d%%" % (name, round(100 * share.get(name, 0.0)))
+                                           for name in STAGES]))
+
+    def report(self, stream):
+        """ Write a stats line to stream, and the metrics file if there is one """
+        self.reported = time.time()
+        snap = self.snapshot()
+        stream.write("%s\n" % self.line(snap))
+        if self.path:
+            self.write(snap)
+
+    def write(self, snap):
+        text = self.prometheus(snap) if self.path.endswith(".prom") else json.dumps(snap, indent=1, sort_keys=True)
+        tmp = "%s.tmp" % self.path
+        try:
+            with open(tmp, "w") as fp:
+                fp.write(text + "\n")
+            # Readers always see a whole file
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            logging.error("BuildMetrics.write could not write %s: %s" % (self.path, e))
+
+    def prometheus(self, snap):
+        lines = []
+        for name, kind, help_ in [("docs", "counter", "Samples parsed"),
+                                  ("duplicates", "counter", "Samples stored as copies of identical content"),
+                                  ("failed", "counter", "Samples that failed or timed out"),
+                                  ("bytes", "counter", "Bytes of samples parsed"),
+                                  ("queue_depth", "gauge", "Rows waiting for the storage writer"),
+                                  ("elapsed", "gauge", "Seconds since the build started")]:
+            metric = "nabu_build_%s" % name
+            lines.extend(["# HELP %s %s" % (metric, help_), "# TYPE %s %s" % (metric, kind),
+                          "%s %s" % (metric, snap[name])])
+        lines.extend(["# HELP nabu_build_stage_seconds Seconds workers spent in each stage",
+                      "# TYPE nabu_build_stage_seconds counter"])
+        lines.extend(['nabu_build_stage_seconds{stage="%s"} %f' % (name, snap["stage_seconds"].get(name, 0.0))
+                      for name in STAGES])
+        lines.extend(self.parse.prometheus("nabu_build_parse_seconds", "Seconds to parse a sample"))
+        lines.extend(self.commits.prometheus("nabu_build_commit_seconds", "Seconds to commit a batch"))
+        return "\n".join(lines)
+
+
+def seconds(value):
+    """ Format a latency for a stats line """
+    if value is None:
+        return "-"
+    if value == float("inf"):
+        return "inf"
+    return "%.0fms" % (value * 1000) if value < 1 else "%.1fs" % value
@@ -28,8 +28,7 @@ def check_decoding(string):
         rv = string.encode("base64")
     except AttributeError:
         pass
-    finally:
-        return rv
+    return rv
 
 
 def prettify_dict(dic):
@@ -87,6 +86,20 @@ def get_hash(data):
     return md5.hexdigest()
 
 
+def get_file_hash(path, bufsize=1 << 20):
+    """
+
+    :param path: file to hash, read a buffer at a time so memory stays flat whatever its size
+    :return: the MD5 hash of the file contents as a hexidecimal string
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(bufsize), ""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
 def isFlash (content):
     """
     Check for swf content in a string by searching for CWS or FWS